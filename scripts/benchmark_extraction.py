@@ -0,0 +1,73 @@
+"""compare EntityExtractor and FastEntityExtractor on synthetic catalog rows, e.g.
+
+python scripts/benchmark_extraction.py --rows 100000
+"""
+import argparse
+import random
+import time
+
+from xinhua.data import ColumnHeader
+from xinhua.data.cql import EntityExtractor
+from xinhua.data.extraction import FastEntityExtractor
+
+
+def synthetic_rows(n: int, seed: int = 0):
+    rnd = random.Random(seed)
+    rows = list()
+    for i in range(n):
+        row = {x.value: "" for x in ColumnHeader}
+        row[ColumnHeader.BOOK_ID.value] = str(i)
+        row[ColumnHeader.BOOK_NAME_STR.value] = f"书名{i}" + (f"/丛书{rnd.randrange(1000)}" if rnd.random() < .3 else "")
+        writers = "//".join(
+            (f"({rnd.choice(['清', '美', '英'])})" if rnd.random() < .2 else "") + f"作者{rnd.randrange(20_000)}"
+            for _ in range(rnd.randint(1, 3)))
+        row[ColumnHeader.AUTHOR_STR.value] = writers + (f"|主编:编者{rnd.randrange(2000)}" if rnd.random() < .5 else "")
+        publisher = rnd.randrange(500)
+        row[ColumnHeader.PUBLISHER_ID.value] = str(publisher)
+        row[ColumnHeader.PUBLISHER_NAME.value] = f"出版社{publisher}"
+        row[ColumnHeader.TOPIC_STR.value] = "//".join(f"{j}主题{rnd.randrange(5000)}" for j in range(rnd.randint(0, 4)))
+        row[ColumnHeader.CN_CATEGORY.value] = f"I{rnd.randrange(300)}" if rnd.random() < .8 else ""
+        category = rnd.randrange(200)
+        row[ColumnHeader.CATEGORY3_ID.value] = str(category)
+        row[ColumnHeader.CATEGORY3_NAME.value] = f"分类{category}"
+        rows.append(row)
+    return rows
+
+
+def canonical(nodes, relations):
+    return (sorted((x.label, x.identifier_value, tuple(sorted(x.properties.items()))) for x in nodes),
+            sorted((s.label, s.identifier_value, r, d.label, d.identifier_value) for s, r, d in relations))
+
+
+def consume(extract, rows):
+    for row in rows:
+        extract(row)
+
+
+def bench(name: str, f, rows, repeat: int):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        f(rows)
+        best = min(best, time.perf_counter() - start)
+    print(f"{name:>40}: {best:.3f}s, {len(rows) / best:,.0f} rows/s")
+    return best
+
+
+def main(n_rows: int, repeat: int):
+    rows = synthetic_rows(n_rows)
+    reference, fast = EntityExtractor(), FastEntityExtractor()
+    for row in rows[:1000]:
+        assert canonical(*reference.extract(row)) == canonical(*fast.extract(row)), row
+
+    baseline = bench("EntityExtractor.extract", lambda x: consume(reference.extract, x), rows, repeat)
+    t = bench("FastEntityExtractor.extract", lambda x: consume(fast.extract, x), rows, repeat)
+    print(f"{'speedup':>40}: {baseline / t:.2f}x")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=100_000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    main(args.rows, args.repeat)
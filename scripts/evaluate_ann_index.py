@@ -0,0 +1,93 @@
+"""report memory, recall (the overlap of the top k with the exact float32 search) and latency of approximate faiss
+indexes and quantized embedding storage against the exact float32 flat index on the real embeddings, e.g.
+
+python scripts/evaluate_ann_index.py --config "HNSW32:efSearch=16,64,256" --config "IVF4096,Flat:nprobe=1,8,32"
+python scripts/evaluate_ann_index.py --config float16 --config SQ8 --config SQfp16 --config PQ16
+
+Every configuration is a faiss index_factory string and optionally a search parameter with the values to try, or an
+embedding storage of xinhua.backend.index.build_storage_index. Queries against a quantized storage are reconstructed
+from it, as the backend does.
+"""
+import argparse
+import time
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from xinhua.backend.index import (build_index, build_storage_index, index_nbytes, is_quantized_storage,
+                                  set_search_parameters)
+from xinhua.backend.embedding import book_rows, get_book_embeddings, read_books
+
+
+def parse_config(config: str) -> Tuple[str, Optional[str], List[Optional[int]]]:
+    if ":" not in config:
+        return config, None, [None]
+    factory, parameter = config.split(":")
+    name, values = parameter.split("=")
+    return factory, name, [int(x) for x in values.split(",")]
+
+
+def measure(index, queries: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """search one query at a time, like a request does
+
+    :return: neighbours and latency of every query in ms
+    """
+    neighbours = np.empty((queries.shape[0], k), dtype="int64")
+    latencies = np.empty(queries.shape[0])
+    for i in range(queries.shape[0]):
+        start = time.perf_counter()
+        _, neighbours[i] = index.search(queries[i: i + 1], k)
+        latencies[i] = (time.perf_counter() - start) * 1000
+    return neighbours, latencies
+
+
+def recall(neighbours: np.ndarray, truth: np.ndarray) -> float:
+    return np.mean([len(np.intersect1d(a, b)) / truth.shape[1] for a, b in zip(neighbours, truth)])
+
+
+def main(entities_path: Path, embeddings_path: Path, configs: List[str], n_queries: int, k: int):
+    _, book_positions = read_books(entities_path)
+    embeddings = book_rows(get_book_embeddings(embeddings_path), book_positions)
+    query_positions = np.random.RandomState(0).choice(embeddings.shape[0], min(n_queries, embeddings.shape[0]),
+                                                      replace=False)
+    queries = embeddings[query_positions]
+
+    flat = build_index(embeddings)
+    truth, flat_latencies = measure(flat, queries, k)
+    print(f"{embeddings.shape[0]} book vectors of dimension {embeddings.shape[1]}, {len(queries)} queries, k={k}")
+    print(f"{'index':<24}{'parameter':<16}{'build s':>10}{'memory MB':>10}{'recall':>10}{'mean ms':>10}"
+          f"{'p99 ms':>10}")
+    print(f"{'Flat':<24}{'':<16}{'':>10}{index_nbytes(flat) / 2 ** 20:>10.1f}{1:>10.3f}{flat_latencies.mean():>10.3f}"
+          f"{np.percentile(flat_latencies, 99):>10.3f}")
+
+    for config in configs:
+        factory, name, values = parse_config(config)
+        start = time.perf_counter()
+        if is_quantized_storage(factory):
+            index = build_storage_index(embeddings, factory)
+            index_queries = np.vstack([index.reconstruct(int(x)) for x in query_positions]).astype("float32")
+        else:
+            index = build_index(embeddings, factory)
+            index_queries = queries
+        build_time = time.perf_counter() - start
+        memory = index_nbytes(index) / 2 ** 20
+        for value in values:
+            if name is not None:
+                set_search_parameters(index, **{{"nprobe": "nprobe", "efSearch": "ef_search"}[name]: value})
+            neighbours, latencies = measure(index, index_queries, k)
+            parameter = "" if name is None else f"{name}={value}"
+            print(f"{factory:<24}{parameter:<16}{build_time:>10.1f}{memory:>10.1f}{recall(neighbours, truth):>10.3f}"
+                  f"{latencies.mean():>10.3f}{np.percentile(latencies, 99):>10.3f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--entities", type=Path, default=Path("data/entities"))
+    parser.add_argument("--embeddings", type=Path, default=Path("data/ckpts/DistMult_book_0/book_DistMult_entity.npy"))
+    parser.add_argument("--config", action="append", dest="configs")
+    parser.add_argument("--queries", type=int, default=1000)
+    parser.add_argument("-k", type=int, default=10)
+    args = parser.parse_args()
+    configs = args.configs or ["HNSW32:efSearch=16,64,256", "IVF1024,Flat:nprobe=1,8,32", "IVF1024,PQ64:nprobe=8,32"]
+    main(args.entities, args.embeddings, configs, args.queries, args.k)
@@ -1,24 +1,12 @@
-import neo4j
+"""export all triplets of the graph to data/triplets.txt. The export is partitioned, parallel and resumable, see
+xinhua.data.export; run it again after an interruption and it continues from data/triplets/checkpoint.json
+"""
+import logging
+from pathlib import Path
 
+from xinhua.data.export import main
 
-driver = neo4j.GraphDatabase.driver("neo4j://localhost:7687", auth=("neo4j", "2much4ME"))
 
-
-f = open("./data/triplets.txt", "w")
-
-with driver.session() as session:
-    cql = "MATCH (h)-[r]->(t) RETURN h, r, t"
-    results = session.run(cql)
-    for i, record in enumerate(results):
-        h, r, t = record
-        h_str = next(iter(h.labels)) + "/" + (h.get("id") if h.get("id") is not None else h.get("name"))
-        r_str = r.type
-        t_str = next(iter(t.labels)) + "/" + (t.get("id") if t.get("id") is not None else t.get("name"))
-        f.write("\t".join([h_str, r_str, t_str]))
-        f.write("\n")
-
-        if i % 1_000 == 0:
-            print(i)
-
-f.close()
-driver.close()
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    main(Path("data/triplets"), n_sessions=4, range_size=1_000_000, merge=Path("data/triplets.txt"))
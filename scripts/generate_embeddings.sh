@@ -1,9 +1,11 @@
+# encode the exported triplets first, it writes the dglke input and the entity table the backend reads:
+# python -m xinhua.data.triples --input data/triplets --output data
 DGLBACKEND=pytorch dglke_train \
   --model_name DistMult \
   --data_path ../data \
   --dataset book \
-  --format raw_udd_hrt \
-  --data_files triplets.txt \
+  --format udd_hrt \
+  --data_files entities.dict relations.dict train.tsv \
   --batch_size 1000 \
   --neg_sample_size 200 \
   --hidden_dim 512 \
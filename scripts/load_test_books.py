@@ -0,0 +1,167 @@
+"""load test /books against a stub elasticsearch, comparing the async endpoint with the previous blocking
+implementation (sync client, one es.get per relevant book) at the same concurrency. Needs uvicorn, e.g.
+
+python scripts/load_test_books.py --concurrency 200 --requests 5000 --es-latency-ms 5
+"""
+import argparse
+import asyncio
+import json
+import os
+import tempfile
+import threading
+import time
+import zlib
+from pathlib import Path
+
+import numpy as np
+from aiohttp import ClientSession, TCPConnector, web
+
+
+def write_embeddings(directory: Path, n_books: int, dim: int):
+    with (directory / "entities.tsv").open("w") as f:
+        for i in range(n_books):
+            f.write(f"{i}\tBook/{i}\n")
+    np.save(str(directory / "embeddings.npy"), np.random.RandomState(0).randn(n_books, dim).astype("float32"))
+
+
+def stub_elasticsearch(n_books: int, latency: float) -> web.Application:
+    def source(book_id: str):
+        return {"name": f"book {book_id}", "author": f"author {book_id}", "topic": f"topic {book_id}"}
+
+    def search(body):
+        book_id = str(zlib.crc32(json.dumps(body).encode()) % n_books)
+        return {"hits": {"hits": [{"_id": book_id, "_source": source(book_id)}]}}
+
+    async def handle(request: web.Request) -> web.Response:
+        await asyncio.sleep(latency)
+        path = request.path
+        if path.endswith("/_msearch"):
+            lines = [json.loads(x) for x in (await request.text()).splitlines() if x.strip()]
+            result = {"responses": [search(x) for x in lines[1::2]]}
+            return web.json_response(result, headers={"X-Elastic-Product": "Elasticsearch"})
+        body = await request.json() if request.can_read_body else dict()
+        if path.endswith("/_search"):
+            result = search(body)
+        elif path.endswith("/_mget"):
+            result = {"docs": [{"_id": x, "found": True, "_source": source(x)} for x in body["ids"]]}
+        else:
+            book_id = path.rsplit("/", 1)[-1]
+            result = {"_id": book_id, "found": True, "_source": source(book_id)}
+        return web.json_response(result, headers={"X-Elastic-Product": "Elasticsearch"})
+
+    es_app = web.Application()
+    es_app.router.add_route("*", "/{tail:.*}", handle)
+    return es_app
+
+
+def run_in_thread(coroutine_factory):
+    loop = asyncio.new_event_loop()
+    started = threading.Event()
+
+    def run():
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(coroutine_factory(started))
+        loop.run_forever()
+
+    threading.Thread(target=run, daemon=True).start()
+    started.wait()
+
+
+def start_stub(port: int, n_books: int, latency: float):
+    async def serve(started: threading.Event):
+        runner = web.AppRunner(stub_elasticsearch(n_books, latency))
+        await runner.setup()
+        await web.TCPSite(runner, "127.0.0.1", port).start()
+        started.set()
+    run_in_thread(serve)
+
+
+def add_blocking_endpoint(backend, es_hosts):
+    """the implementation before the async path, for comparison"""
+    import elasticsearch
+
+    from xinhua.backend.app import Book
+
+    sync_es = elasticsearch.Elasticsearch(es_hosts, maxsize=100)
+
+    @backend.app.get("/books_blocking")
+    def search_book_blocking(q: str, max_hit: int = 1, max_relevant: int = 2):
+        res = sync_es.search(index="book", body={"query": {"match": {"name": q}}})
+        books_hit = [Book(id=x["_id"], **x["_source"]) for x in res["hits"]["hits"][:max_hit]]
+        books_relevant = list()
+        if len(books_hit) > 0:
+            for book_id in backend.reloader.current.get_nearest_k(books_hit[0].id, max_relevant):
+                res = sync_es.get("book", book_id)
+                books_relevant.append(Book(id=res["_id"], **res["_source"]))
+        return {"books_hit": books_hit, "books_relevant": books_relevant}
+
+
+async def hammer(url: str, n_requests: int, concurrency: int, max_relevant: int):
+    latencies = list()
+    queue = asyncio.Queue()
+    for i in range(n_requests):
+        queue.put_nowait(f"{url}?q=book{i % 1000}&max_relevant={max_relevant}")
+
+    async with ClientSession(connector=TCPConnector(limit=concurrency)) as session:
+        async def worker():
+            while not queue.empty():
+                request_url = queue.get_nowait()
+                start = time.perf_counter()
+                async with session.get(request_url) as response:
+                    assert response.status == 200, await response.text()
+                    await response.read()
+                latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await asyncio.gather(*[worker() for _ in range(concurrency)])
+        elapsed = time.perf_counter() - start
+
+    latencies = np.array(latencies) * 1000
+    print(f"{url:<45}{n_requests / elapsed:>10.0f}{np.percentile(latencies, 50):>10.1f}"
+          f"{np.percentile(latencies, 99):>10.1f}")
+
+
+def main(n_books: int, n_requests: int, concurrencies, es_latency: float, max_relevant: int):
+    import uvicorn
+
+    es_port, app_port = 19200, 18000
+    directory = Path(tempfile.mkdtemp())
+    write_embeddings(directory, n_books, 64)
+    start_stub(es_port, n_books, es_latency)
+
+    es_hosts = [f"127.0.0.1:{es_port}"]
+    os.environ["XINHUA_ES_HOSTS"] = json.dumps(es_hosts)
+    os.environ["XINHUA_ENTITIES_PATH"] = str(directory / "entities.tsv")
+    os.environ["XINHUA_EMBEDDINGS_PATH"] = str(directory / "embeddings.npy")
+    # measure the uncached path unless asked otherwise
+    os.environ.setdefault("XINHUA_RESPONSE_CACHE_SIZE", "0")
+    from xinhua.backend import app as backend
+
+    add_blocking_endpoint(backend, es_hosts)
+    server = uvicorn.Server(uvicorn.Config(backend.app, port=app_port, log_level="warning"))
+
+    async def serve(started: threading.Event):
+        started.set()
+        await server.serve()
+    run_in_thread(serve)
+    while not server.started:
+        time.sleep(.1)
+    backend.extractor_ready.wait()
+
+    print(f"stub elasticsearch latency {es_latency * 1000:.0f}ms, {n_books} books, max_relevant={max_relevant}")
+    for concurrency in concurrencies:
+        print(f"concurrency {concurrency}")
+        print(f"{'endpoint':<45}{'req/s':>10}{'p50 ms':>10}{'p99 ms':>10}")
+        for endpoint in ["books_blocking", "books"]:
+            asyncio.run(hammer(f"http://127.0.0.1:{app_port}/{endpoint}", n_requests, concurrency, max_relevant))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--books", type=int, default=100_000)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[10, 100, 200])
+    parser.add_argument("--es-latency-ms", type=float, default=5)
+    parser.add_argument("--max-relevant", type=int, default=5)
+    args = parser.parse_args()
+    main(args.books, args.requests, args.concurrency, args.es_latency_ms / 1000, args.max_relevant)
@@ -1,16 +1,13 @@
-import csv
+import sys
 from pathlib import Path
 
 from xinhua.data import ColumnHeader
+from xinhua.data.pipeline import iter_catalog_rows
 
 OUTPUT_FOLDER = Path("data/comprehend_input")
+CATALOG = Path(sys.argv[1]) if len(sys.argv) > 1 else Path("data/1000.csv")
 
 
-with open("data/1000.csv") as f:
-    reader = csv.DictReader(f, fieldnames=[x.value for x in ColumnHeader])
-    next(reader)
-    for i, row in enumerate(reader):
-        with open(OUTPUT_FOLDER/f"{row[ColumnHeader.BOOK_ID.value]}.txt", "w") as f_book:
-            f_book.write(row[ColumnHeader.SUMMARY.value])
-
-
+for row in iter_catalog_rows(CATALOG):
+    with open(OUTPUT_FOLDER/f"{row[ColumnHeader.BOOK_ID.value]}.txt", "w") as f_book:
+        f_book.write(row[ColumnHeader.SUMMARY.value])
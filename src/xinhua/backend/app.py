@@ -1,16 +1,44 @@
+import asyncio
+import json
+import logging
+import threading
+import time
+from enum import Enum
 from pathlib import Path
-from typing import Optional, List
+from typing import AsyncIterator, Dict, Optional, List
 
-from fastapi import FastAPI
-from pydantic import BaseModel
+from fastapi import FastAPI, HTTPException, Query, Request, Response
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, Field
+from starlette.concurrency import run_in_threadpool
 import elasticsearch
-import numpy as np
 import faiss
 
+from ..metrics import CONTENT_TYPE, REGISTRY, SamplingProfiler
+from .bundle import MANIFEST_FILE, load_bundle
+from .embedding import get_book_embeddings, load_books
+from .graph import OFFSETS_FILE, TARGETS_FILE, BookGraph, blend
+from .metadata import BookMetadata, BookMetadataStore
+from .relevance import RelevantBookExtractor
+from .reload import ExtractorReloader
+from .response_cache import InProcessBackend, KeyValueBackend, ResponseCache, redis_client
+from .settings import MetadataSource, Settings
+from .topk import NEIGHBOURS_FILE, TopKTable
+
+
+logger = logging.getLogger(__name__)
 
 app = FastAPI()
 
-es = elasticsearch.Elasticsearch()
+REQUEST_SECONDS = REGISTRY.histogram("xinhua_request_seconds", "seconds until the response starts", ["path", "status"])
+# /books/batch observes its stages once per chunk of queries
+STAGE_SECONDS = REGISTRY.histogram("xinhua_books_stage_seconds", "seconds spent in a stage of answering /books",
+                                   ["endpoint", "stage"])
+RELOADS = REGISTRY.counter("xinhua_reloads_total", "relevant book extractor reloads, swapped in or failed",
+                           ["outcome"])
+RELOAD_SECONDS = REGISTRY.gauge("xinhua_reload_last_duration_seconds", "duration of the last successful reload")
+BOOKS = REGISTRY.gauge("xinhua_books", "books the current relevant book extractor holds")
+RESPONSE_CACHE_LOOKUPS = REGISTRY.counter("xinhua_response_cache_lookups_total", "response cache lookups", ["result"])
 
 
 class Book(BaseModel):
@@ -20,66 +48,378 @@ class Book(BaseModel):
     topic: str
 
 
-class RelevantBookExtractor:
+class BookQuery(BaseModel):
+    q: str
+    max_hit: int = 1
+    max_relevant: int = Field(2, ge=0)
+
+
+class BookBatchQuery(BaseModel):
+    queries: List[BookQuery]
+
+
+class RelevanceSource(str, Enum):
+    """where /books finds the relevant books: embedding neighbours, books sharing an author, topic or series in the
+    graph, or both fused by rank"""
+    embedding = "embedding"
+    graph = "graph"
+    blend = "blend"
+
+
+settings = Settings()
+
+es = elasticsearch.AsyncElasticsearch(settings.es_hosts, maxsize=settings.es_maxsize)
+
+# all are loaded in the background by load_models, /books answers 503 until the extractor is ready, and the graph
+# for source=graph, and falls back to _mget until the metadata store is. The graph is reloaded with the extractor
+book_metadata_store: Optional[BookMetadataStore] = None
+book_graph: Optional[BookGraph] = None
+extractor_ready = threading.Event()
+load_error: Optional[str] = None
+event_loop: Optional[asyncio.AbstractEventLoop] = None
+
+
+def build_relevant_book_extractor() -> RelevantBookExtractor:
+    if settings.bundle_path is not None:
+        return load_bundle(settings.bundle_path, settings.nprobe, settings.ef_search)
+    book_ids, entity_positions = load_books(settings.entities_path, settings.book_table_path)
+    if settings.topk_path is not None:
+        return RelevantBookExtractor(book_ids, entity_positions, topk_table=TopKTable.load(settings.topk_path))
+    return RelevantBookExtractor(
+        book_ids,
+        entity_positions,
+        node_embeddings=get_book_embeddings(settings.embeddings_path),
+        index=faiss.read_index(str(settings.index_path)) if settings.index_path is not None else None,
+        nprobe=settings.nprobe,
+        ef_search=settings.ef_search,
+        storage=settings.embedding_storage
+    )
+
+
+def watched_paths() -> List[Path]:
+    """the files build_relevant_book_extractor and load_book_graph read, a new bundle replaces the manifest"""
+    if settings.bundle_path is not None:
+        paths = [settings.bundle_path / MANIFEST_FILE]
+    elif settings.topk_path is not None:
+        paths = [settings.entities_path, settings.topk_path / NEIGHBOURS_FILE]
+    else:
+        paths = [x for x in [settings.entities_path, settings.embeddings_path, settings.index_path] if x is not None]
+    if settings.graph_path is not None:
+        paths += [settings.graph_path / OFFSETS_FILE, settings.graph_path / TARGETS_FILE]
+    return paths
+
+
+def load_book_graph():
+    """on failure the previous graph, if any, keeps serving"""
+    global book_graph
+    if settings.graph_path is None:
+        return
+    try:
+        book_graph = BookGraph.load(settings.graph_path, settings.graph_max_hub_degree)
+        logger.info(f"graph of {book_graph.n_books} books and {book_graph.n_edges} edges loaded")
+    except Exception:
+        logger.exception("failed to load the book graph")
+
+
+def on_extractor_swapped(_: RelevantBookExtractor):
+    """the graph is rebuilt from the same triples as the embeddings, it is reloaded with them. Responses cached before
+    a reload name the neighbours of the previous embeddings"""
+    load_book_graph()
+    extractor_ready.set()
+    if response_cache is not None and event_loop is not None:
+        asyncio.run_coroutine_threadsafe(response_cache.invalidate(), event_loop)
+
+
+reloader = ExtractorReloader(build_relevant_book_extractor, settings.reload_max_book_change, on_extractor_swapped)
+
+
+def build_book_metadata_store() -> Optional[BookMetadataStore]:
+    if settings.metadata_source == MetadataSource.catalog:
+        return BookMetadataStore.from_catalog(settings.metadata_catalog_path, settings.metadata_max_size)
+    if settings.metadata_source == MetadataSource.elasticsearch:
+        sync_es = elasticsearch.Elasticsearch(settings.es_hosts)
+        try:
+            return BookMetadataStore.from_elasticsearch(sync_es, maxsize=settings.metadata_max_size)
+        finally:
+            sync_es.close()
+    return None
+
+
+def load_models():
+    global book_metadata_store, load_error
+    if settings.reload_watch_interval is not None:
+        reloader.watch(watched_paths, settings.reload_watch_interval)
+    start = time.monotonic()
+    try:
+        reloader.reload()
+    except Exception as e:
+        logger.exception("failed to load the relevant book extractor")
+        load_error = repr(e)
+        return
+    logger.info(f"relevant book extractor ready after {time.monotonic() - start:.1f}s")
+    try:
+        book_metadata_store = build_book_metadata_store()
+    except Exception:
+        logger.exception("failed to load the book metadata store, books are fetched with _mget")
+
+
+@app.on_event("startup")
+async def start_loading_models():
+    global event_loop
+    event_loop = asyncio.get_event_loop()
+    if profiler is not None:
+        profiler.start()
+    threading.Thread(target=load_models, name="load-models", daemon=True).start()
+
+
+def build_response_cache() -> Optional[ResponseCache]:
+    if settings.response_cache_url is not None:
+        return ResponseCache(KeyValueBackend(redis_client(settings.response_cache_url), settings.response_cache_ttl))
+    if settings.response_cache_size > 0:
+        return ResponseCache(InProcessBackend(settings.response_cache_size, settings.response_cache_ttl))
+    return None
+
+
+response_cache = build_response_cache()
+
 
-    def __init__(self, node_ids: List[str], node_embeddings: np.ndarray):
-        self._node_ids = node_ids
-        self._node_id_to_index = {node_id: i for i, node_id in enumerate(node_ids)}
-        self._node_embeddings = node_embeddings
-        self._embedding_dim = node_embeddings.shape[1]
+if settings.profile_slow_request_seconds is not None:
+    profiler = SamplingProfiler(settings.profile_output, settings.profile_interval)
+else:
+    profiler = None
 
-        self._index = faiss.IndexFlatL2(self._embedding_dim)
-        self._index.add(node_embeddings)
+# labelling by raw path would add a series for every path scanned by a bot, the routes are read on the first request
+_route_paths = None
 
-    def get_nearest_k(self, book_id: str, k: int):
-        book_id = f"Book/{book_id}"
-        book_index = self._node_id_to_index[book_id]
-        _, nearest_book_indices = self._index.search(
-            self._node_embeddings[book_index].reshape(1, self._embedding_dim), k+1)
-        nearest_book_indices = nearest_book_indices[0, 1:]
-        nearest_book_ids = [self._node_ids[x] for x in nearest_book_indices]
-        print(nearest_book_ids)
-        nearest_book_ids = [x.replace("Book/", "") for x in nearest_book_ids if x.startswith("Book/")]
-        return nearest_book_ids
 
+@app.middleware("http")
+async def observe_request(request: Request, call_next):
+    global _route_paths
+    if _route_paths is None:
+        _route_paths = {x.path for x in app.routes}
+    start = time.monotonic()
+    path = request.url.path if request.url.path in _route_paths else "other"
+    try:
+        response = await call_next(request)
+    except Exception:
+        # the exception middleware answers it with a 500 after this one
+        REQUEST_SECONDS.observe(time.monotonic() - start, path=path, status="500")
+        raise
+    end = time.monotonic()
+    REQUEST_SECONDS.observe(end - start, path=path, status=str(response.status_code))
+    if profiler is not None and end - start > settings.profile_slow_request_seconds:
+        dumped = await run_in_threadpool(profiler.dump, start, end, path.strip("/").replace("/", "_") or "root")
+        if dumped is not None:
+            logger.info(f"{request.url.path} took {end - start:.3f}s, stacks dumped to {dumped}")
+    return response
 
-def get_book_ids(entities_path: Path):
-    with entities_path.open("r") as f:
-        lines = f.readlines()
-    return [line.split("\t")[1].strip() for line in lines]
 
+@app.on_event("shutdown")
+async def close_elasticsearch():
+    await es.close()
 
-def get_book_embeddings(embedding_path: Path):
-    return np.load(str(embedding_path))
 
+async def get_book_metadata(book_ids: List[str]) -> Dict[str, BookMetadata]:
+    """hydrate books from the metadata store, the books which are not resident are fetched with a single _mget"""
+    if book_metadata_store is not None:
+        found, missing = book_metadata_store.get_many(book_ids)
+    else:
+        found, missing = dict(), book_ids
+    if len(missing) > 0:
+        res = await es.mget(body={"ids": missing}, index="book", _source_includes=list(BookMetadata._fields))
+        for doc in res["docs"]:
+            if doc.get("found"):
+                metadata = BookMetadata(**doc["_source"])
+                found[doc["_id"]] = metadata
+                if book_metadata_store is not None:
+                    book_metadata_store.put(doc["_id"], metadata)
+    return found
 
-relevant_book_extractor = RelevantBookExtractor(
-    node_ids=get_book_ids(Path("data/entities.tsv")),
-    node_embeddings=get_book_embeddings(Path("data/ckpts/DistMult_book_0/book_DistMult_entity.npy"))
-)
+
+async def get_books(book_ids: List[str]) -> List[Book]:
+    found = await get_book_metadata(book_ids)
+    return [Book(id=x, **found[x]._asdict()) for x in book_ids if x in found]
+
+
+def _hit_to_book(hit: Dict) -> Book:
+    return Book(
+        id=hit["_id"],
+        name=hit["_source"]["name"],
+        author=hit["_source"]["author"],
+        topic=hit["_source"]["topic"]
+    )
+
+
+def _require_ready() -> RelevantBookExtractor:
+    """the current extractor, a request keeps using it even if a reload swaps in another one meanwhile"""
+    extractor = reloader.current
+    if extractor is None:
+        raise HTTPException(status_code=503, detail="the relevant book extractor is still loading")
+    return extractor
+
+
+@app.get("/ready")
+def ready():
+    """readiness probe, 503 until the relevant book extractor is loaded"""
+    if load_error is not None and reloader.current is None:
+        raise HTTPException(status_code=503, detail=f"loading failed: {load_error}")
+    _require_ready()
+    return {"ready": True, "metadata_store": book_metadata_store is not None, "graph": book_graph is not None}
+
+
+def _require_graph(source: RelevanceSource) -> Optional[BookGraph]:
+    if source == RelevanceSource.embedding:
+        return None
+    if settings.graph_path is None:
+        raise HTTPException(status_code=400, detail="no book graph is configured, see XINHUA_GRAPH_PATH")
+    # read once, like the extractor, a reload may swap in another graph meanwhile
+    graph = book_graph
+    if graph is None:
+        raise HTTPException(status_code=503, detail="the book graph is still loading or failed to load")
+    return graph
+
+
+def _relevant_book_ids(relevant_book_extractor: RelevantBookExtractor, graph: Optional[BookGraph], book_id: str,
+                       k: int, source: RelevanceSource) -> List[str]:
+    if source == RelevanceSource.embedding:
+        return relevant_book_extractor.get_nearest_k(book_id, k)
+    related = graph.get_related_k(book_id, k)
+    if source == RelevanceSource.graph:
+        return related
+    try:
+        nearest = relevant_book_extractor.get_nearest_k(book_id, k)
+    except KeyError:
+        # a book without an embedding, e.g. one added after the training, is still in the graph
+        return related
+    return blend([nearest, related], k)
 
 
 @app.get("/books")
-def search_book(q: str, max_hit: int = 1, max_relevant: int = 2):
-    res = es.search(index="book", body={"query": {"match": {"name": q}}})
-    books_hit = list()
-    for hit in res["hits"]["hits"][:max_hit]:
-        books_hit.append(Book(
-            id=hit["_id"],
-            name=hit["_source"]["name"],
-            author=hit["_source"]["author"],
-            topic=hit["_source"]["topic"]
-        ))
+async def search_book(q: str, max_hit: int = 1, max_relevant: int = Query(2, ge=0),
+                      source: RelevanceSource = RelevanceSource.embedding):
+    relevant_book_extractor = _require_ready()
+    graph = _require_graph(source)
+    cache_key = None
+    if response_cache is not None:
+        cache_key, content = await response_cache.get(q, max_hit, max_relevant, source.value)
+        if content is not None:
+            return Response(content, media_type="application/json")
+
+    with STAGE_SECONDS.time(endpoint="books", stage="es_search"):
+        res = await es.search(index="book", body={"query": {"match": {"name": q}}}, size=max_hit)
+    books_hit = [_hit_to_book(hit) for hit in res["hits"]["hits"][:max_hit]]
     books_relevant = list()
     if len(books_hit) > 0:
-        relevant_book_ids = relevant_book_extractor.get_nearest_k(books_hit[0].id, 500)[:max_relevant]
-        for book_id in relevant_book_ids:
-            res = es.get("book", book_id)
-            books_relevant.append(Book(
-                id=res["_id"],
-                name=res["_source"]["name"],
-                author=res["_source"]["author"],
-                topic=res["_source"]["topic"]
-            ))
-
-    return {"books_hit": books_hit, "books_relevant": books_relevant}
+        with STAGE_SECONDS.time(endpoint="books", stage="knn"):
+            # the search holds the GIL only partly, run it off the event loop
+            relevant_book_ids = await run_in_threadpool(
+                _relevant_book_ids, relevant_book_extractor, graph, books_hit[0].id, max_relevant, source)
+        with STAGE_SECONDS.time(endpoint="books", stage="hydrate"):
+            books_relevant = await get_books(relevant_book_ids)
+
+    with STAGE_SECONDS.time(endpoint="books", stage="serialize"):
+        content = json.dumps({
+            "books_hit": [x.dict() for x in books_hit],
+            "books_relevant": [x.dict() for x in books_relevant]
+        }, ensure_ascii=False).encode("utf-8")
+    if response_cache is not None:
+        await response_cache.set(cache_key, content)
+    return Response(content, media_type="application/json")
+
+
+async def _search_book_batch(queries: List[BookQuery],
+                             relevant_book_extractor: RelevantBookExtractor) -> AsyncIterator[bytes]:
+    """answer a batch of queries with one _msearch, one batched neighbour search and one _mget"""
+    body = list()
+    for query in queries:
+        body.append({})
+        body.append({"query": {"match": {"name": query.q}}, "size": query.max_hit})
+    with STAGE_SECONDS.time(endpoint="books_batch", stage="es_search"):
+        res = await es.msearch(body=body, index="book")
+
+    books_hit = [[_hit_to_book(hit) for hit in x.get("hits", {}).get("hits", [])[:query.max_hit]]
+                 for x, query in zip(res["responses"], queries)]
+    with_hits = [i for i, x in enumerate(books_hit) if len(x) > 0]
+    relevant_book_ids = [list() for _ in queries]
+    if len(with_hits) > 0:
+        with STAGE_SECONDS.time(endpoint="books_batch", stage="knn"):
+            nearest = await run_in_threadpool(
+                relevant_book_extractor.get_nearest_k_batch,
+                [books_hit[i][0].id for i in with_hits], max(queries[i].max_relevant for i in with_hits))
+        for i, book_ids in zip(with_hits, nearest):
+            relevant_book_ids[i] = book_ids[:queries[i].max_relevant]
+
+    with STAGE_SECONDS.time(endpoint="books_batch", stage="hydrate"):
+        metadata = await get_book_metadata(list({x for book_ids in relevant_book_ids for x in book_ids}))
+    # the time spent by the client reading the stream is not counted
+    serialize_seconds = 0.
+    for query, hits, book_ids in zip(queries, books_hit, relevant_book_ids):
+        start = time.perf_counter()
+        line = json.dumps({
+            "q": query.q,
+            "books_hit": [x.dict() for x in hits],
+            "books_relevant": [Book(id=x, **metadata[x]._asdict()).dict() for x in book_ids if x in metadata]
+        }, ensure_ascii=False).encode("utf-8") + b"\n"
+        serialize_seconds += time.perf_counter() - start
+        yield line
+    STAGE_SECONDS.observe(serialize_seconds, endpoint="books_batch", stage="serialize")
+
+
+@app.post("/books/batch")
+async def search_book_batch(batch: BookBatchQuery, chunk_size: int = 500):
+    """answer many queries at once, results are streamed as one json object per line, in the order of the queries.
+    Queries are processed chunk_size at a time, so only one chunk of results is held in memory"""
+    relevant_book_extractor = _require_ready()
+
+    async def stream() -> AsyncIterator[bytes]:
+        for i in range(0, len(batch.queries), chunk_size):
+            async for line in _search_book_batch(batch.queries[i: i + chunk_size], relevant_book_extractor):
+                yield line
+
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+
+@app.get("/metrics")
+async def metrics():
+    """prometheus text format, the reload and cache figures are kept by the reloader and the cache and copied here"""
+    stats = reloader.stats()
+    RELOADS.set(stats["reloads"], outcome="swapped")
+    RELOADS.set(stats["failures"], outcome="failed")
+    if stats["last_duration_seconds"] is not None:
+        RELOAD_SECONDS.set(stats["last_duration_seconds"])
+    if stats["n_books"] is not None:
+        BOOKS.set(stats["n_books"])
+    if response_cache is not None:
+        RESPONSE_CACHE_LOOKUPS.set(response_cache.hits, result="hit")
+        RESPONSE_CACHE_LOOKUPS.set(response_cache.misses, result="miss")
+    return Response(REGISTRY.render(), media_type=CONTENT_TYPE)
+
+
+@app.get("/admin/cache")
+async def response_cache_stats():
+    if response_cache is None:
+        return {"enabled": False}
+    return {"enabled": True, "hits": response_cache.hits, "misses": response_cache.misses,
+            "hit_rate": response_cache.hit_rate}
+
+
+@app.get("/admin/reload")
+async def reload_stats():
+    return reloader.stats()
+
+
+@app.post("/admin/reload", status_code=202)
+async def reload_relevant_book_extractor():
+    """rebuild the relevant book extractor from the configured files in the background, the current one serves until
+    the new one is validated and swapped in, see GET /admin/reload for the outcome"""
+    if not reloader.reload_in_background():
+        raise HTTPException(status_code=409, detail="a reload is already running")
+    return {"reloading": True}
+
+
+@app.post("/admin/cache/invalidate")
+async def invalidate_response_cache():
+    """call after the book index was reloaded, e.g. by the elasticsearch loader"""
+    if response_cache is not None:
+        await response_cache.invalidate()
+    return {"invalidated": response_cache is not None}
@@ -0,0 +1,154 @@
+import argparse
+import json
+import logging
+import os
+import shutil
+import time
+from pathlib import Path
+from typing import Optional
+
+import faiss
+import numpy as np
+
+from ..ids import IdTable
+from .embedding import book_rows, get_book_embeddings, read_books
+from .index import MappedFlatIndex, build_index, squared_norms
+from .relevance import RelevantBookExtractor
+from .topk import TopKTable
+
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_FILE = "manifest.json"
+BOOKS_DIR = "books"
+EMBEDDINGS_FILE = "book_embeddings.npy"
+NORMS_FILE = "norms.npy"
+INDEX_FILE = "index.faiss"
+TOPK_DIR = "topk"
+# output.v<time_ns> are the versions, output is a symlink to the current one
+VERSION_SEPARATOR = ".v"
+
+
+def publish_bundle(entities_path: Path, embeddings_path: Path, output: Path, index_path: Optional[Path] = None,
+                   factory: Optional[str] = None, topk_path: Optional[Path] = None, dtype: str = "float32",
+                   keep: int = 2) -> dict:
+    """write everything the backend serves from into one directory: the book id table, the book embeddings as a
+    contiguous matrix with their norms, optionally a faiss index and a top k table. Workers attach to it with
+    load_bundle and memory map the files read-only, so the pages are held once in the page cache however many workers
+    there are. Put output on a tmpfs, e.g. /dev/shm/xinhua, to keep the bundle in RAM.
+
+    Every publication is written to its own versioned directory next to output, and output is a symlink which is
+    swapped to the new version with one rename once it is complete. A worker resolves the link once when it attaches,
+    so it never sees a partial bundle nor files of two bundles, and workers which mapped the previous version keep
+    reading it until they attach again. Versions beyond the last keep are removed.
+
+    :param index_path: a prebuilt index over the book rows, see xinhua.backend.index
+    :param factory: build an index with this faiss index_factory string instead, e.g. IVF4096,Flat. Only IVF indexes
+    are memory mapped by faiss, other types are read into every worker. Without an index the workers search the
+    mapped embeddings exactly
+    :param dtype: float32 or float16, the type the book embeddings are stored in, float16 halves the bundle and the
+    exact search reads it as is
+    """
+    start = time.monotonic()
+    staging = output.parent / f"{output.name}{VERSION_SEPARATOR}{time.time_ns()}"
+    staging.mkdir(parents=True)
+
+    book_ids, entity_positions = read_books(entities_path)
+    book_ids.save(staging / BOOKS_DIR)
+    embeddings = np.lib.format.open_memmap(str(staging / EMBEDDINGS_FILE), mode="w+", dtype=dtype,
+                                           shape=(len(book_ids), get_book_embeddings(embeddings_path).shape[1]))
+    embeddings[:] = book_rows(get_book_embeddings(embeddings_path), entity_positions)
+    embeddings.flush()
+    np.save(str(staging / NORMS_FILE), squared_norms(embeddings))
+
+    index_type = None
+    if index_path is not None:
+        shutil.copyfile(str(index_path), str(staging / INDEX_FILE))
+        index_type = "prebuilt"
+    elif factory is not None:
+        faiss.write_index(build_index(np.asarray(embeddings, dtype="float32"), factory), str(staging / INDEX_FILE))
+        index_type = factory
+    if topk_path is not None:
+        shutil.copytree(str(topk_path), str(staging / TOPK_DIR))
+
+    manifest = {
+        "n_books": len(book_ids),
+        "dim": embeddings.shape[1],
+        "dtype": dtype,
+        "index": index_type,
+        "topk": topk_path is not None,
+        "published_at": time.time()
+    }
+    with (staging / MANIFEST_FILE).open("w") as f:
+        json.dump(manifest, f)
+    del embeddings
+
+    _swap_link(output, staging)
+    _remove_old_versions(output, keep)
+    logger.info(f"bundle of {manifest['n_books']} books published to {output} in {time.monotonic() - start:.1f}s")
+    return manifest
+
+
+def _swap_link(output: Path, version: Path):
+    if output.is_dir() and not output.is_symlink():
+        # a bundle published before bundles were versioned, the path is missing until the link replaces it
+        output.rename(output.parent / f"{output.name}{VERSION_SEPARATOR}0")
+    link = output.parent / f".{output.name}.link.{os.getpid()}"
+    if link.is_symlink():
+        link.unlink()
+    link.symlink_to(version.name)
+    os.replace(str(link), str(output))
+
+
+def _remove_old_versions(output: Path, keep: int):
+    current = output.resolve().name
+    versions = sorted(output.parent.glob(f"{output.name}{VERSION_SEPARATOR}*"),
+                      key=lambda x: int(x.name.rsplit(VERSION_SEPARATOR, 1)[1]))
+    for version in versions[:-keep] if keep > 0 else versions:
+        if version.name != current:
+            # files which are still mapped stay readable until the workers unmap them
+            shutil.rmtree(str(version))
+
+
+def load_bundle(bundle: Path, nprobe: Optional[int] = None, ef_search: Optional[int] = None,
+                use_topk: bool = True) -> RelevantBookExtractor:
+    """attach to a bundle written by publish_bundle, nothing but the index structures faiss cannot map is copied"""
+    # every file is read from the version the link points to now, even if it is swapped meanwhile
+    bundle = bundle.resolve()
+    with (bundle / MANIFEST_FILE).open("r") as f:
+        manifest = json.load(f)
+    book_ids = IdTable.load(bundle / BOOKS_DIR)
+    if len(book_ids) != manifest["n_books"]:
+        raise ValueError(f"bundle {bundle} lists {manifest['n_books']} books but its id table holds {len(book_ids)}")
+    if use_topk and manifest["topk"]:
+        return RelevantBookExtractor(book_ids, None, topk_table=TopKTable.load(bundle / TOPK_DIR))
+
+    embeddings = np.load(str(bundle / EMBEDDINGS_FILE), mmap_mode="r")
+    if manifest["index"] is not None:
+        index = faiss.read_index(str(bundle / INDEX_FILE), faiss.IO_FLAG_MMAP)
+    else:
+        index = MappedFlatIndex(embeddings, np.load(str(bundle / NORMS_FILE), mmap_mode="r"))
+    return RelevantBookExtractor(book_ids, None, node_embeddings=embeddings, index=index, nprobe=nprobe,
+                                 ef_search=ef_search)
+
+
+def main(entities_path: Path, embeddings_path: Path, output: Path, index_path: Optional[Path],
+         factory: Optional[str], topk_path: Optional[Path], dtype: str):
+    manifest = publish_bundle(entities_path, embeddings_path, output, index_path, factory, topk_path, dtype)
+    logger.info(f"start the workers with XINHUA_BUNDLE_PATH={output}, manifest {manifest}")
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    parser = argparse.ArgumentParser(description="publish the book ids, embeddings and index into one directory which "
+                                                 "all backend workers memory map, e.g. on /dev/shm")
+    parser.add_argument("--entities", type=Path, default=Path("data/entities"))
+    parser.add_argument("--embeddings", type=Path, default=Path("data/ckpts/DistMult_book_0/book_DistMult_entity.npy"))
+    parser.add_argument("--output", type=Path, default=Path("/dev/shm/xinhua"))
+    parser.add_argument("--index", type=Path, default=None, help="index built with xinhua.backend.index")
+    parser.add_argument("--factory", default=None, help="build an index, e.g. IVF4096,Flat; the default is an exact "
+                                                        "search over the mapped embeddings")
+    parser.add_argument("--topk", type=Path, default=None, help="table built with xinhua.backend.topk")
+    parser.add_argument("--dtype", choices=["float32", "float16"], default="float32")
+    args = parser.parse_args()
+    main(args.entities, args.embeddings, args.output, args.index, args.factory, args.topk, args.dtype)
@@ -0,0 +1,74 @@
+import logging
+from pathlib import Path
+from typing import Optional, Tuple
+
+import numpy as np
+
+from ..ids import IdTable, save_array
+
+
+logger = logging.getLogger(__name__)
+
+BOOK_PREFIX = "Book/"
+ENTITY_POSITIONS_FILE = "entity_positions.npy"
+
+
+def get_book_embeddings(embedding_path: Path) -> np.ndarray:
+    """the embeddings are memory mapped, only the rows which are read are paged in"""
+    return np.load(str(embedding_path), mmap_mode="r")
+
+
+def books_of_entity_table(entities: IdTable) -> Tuple[IdTable, np.ndarray]:
+    """select the books of an entity table written by xinhua.data.triples, without decoding a single id"""
+    prefix = BOOK_PREFIX.encode("utf-8")
+    width = entities.ids.dtype.itemsize
+    if width <= len(prefix):
+        return IdTable.from_ids([]), np.empty(0, dtype="int64")
+    # the fixed width ids as a matrix of bytes, one row per id
+    chars = np.ascontiguousarray(entities.ids).view("uint8").reshape(-1, width)
+    positions = np.flatnonzero(entities.prefix_mask(BOOK_PREFIX))
+    stripped = np.ascontiguousarray(chars[positions, len(prefix):]).view(f"S{width - len(prefix)}").ravel()
+    return IdTable.from_bytes(stripped), positions
+
+
+def read_books(entities_path: Path) -> Tuple[IdTable, np.ndarray]:
+    """the books of the entity file of the embedding training, either the entities.tsv of dglke or the entity
+    table directory written by xinhua.data.triples
+
+    :return: the book ids without the Book/ prefix, and the rows of the books in the entity embedding matrix
+    """
+    if entities_path.is_dir():
+        return books_of_entity_table(IdTable.load(entities_path))
+    book_ids, positions = list(), list()
+    with entities_path.open("r") as f:
+        for i, line in enumerate(f):
+            node_id = line.split("\t")[1].strip()
+            if node_id.startswith(BOOK_PREFIX):
+                book_ids.append(node_id[len(BOOK_PREFIX):])
+                positions.append(i)
+    return IdTable.from_ids(book_ids), np.array(positions, dtype="int64")
+
+
+def load_books(entities_path: Path, table_path: Optional[Path] = None) -> Tuple[IdTable, np.ndarray]:
+    """read_books, but the result is saved to table_path the first time and memory mapped from it afterwards"""
+    if table_path is None:
+        return read_books(entities_path)
+    positions_path = table_path / ENTITY_POSITIONS_FILE
+    # a table older than the entity file belongs to a previous training run
+    if IdTable.exists(table_path) and positions_path.exists() and \
+            positions_path.stat().st_mtime >= entities_path.stat().st_mtime:
+        return IdTable.load(table_path), np.load(str(positions_path), mmap_mode="r")
+    book_ids, positions = read_books(entities_path)
+    book_ids.save(table_path)
+    save_array(positions_path, positions)
+    logger.info(f"table of {len(book_ids)} book ids written to {table_path}")
+    return book_ids, positions
+
+
+def book_rows(node_embeddings: np.ndarray, entity_positions: np.ndarray, batch_size: int = 100_000) -> np.ndarray:
+    """copy the book rows out of the entity embeddings as float32, batch by batch so a memory mapped matrix is read
+    sequentially and never fully materialised as float64 or similar"""
+    rows = np.empty((len(entity_positions), node_embeddings.shape[1]), dtype="float32")
+    for start in range(0, len(entity_positions), batch_size):
+        rows[start: start + batch_size] = node_embeddings[entity_positions[start: start + batch_size]]
+    return rows
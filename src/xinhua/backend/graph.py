@@ -0,0 +1,152 @@
+import argparse
+import logging
+import time
+from pathlib import Path
+from typing import Dict, List, Sequence
+
+import numpy as np
+
+from ..data.triples import EncodedTriplets
+from ..ids import IdTable, save_array
+from .embedding import books_of_entity_table
+
+
+logger = logging.getLogger(__name__)
+
+OFFSETS_FILE = "offsets.npy"
+TARGETS_FILE = "targets.npy"
+BOOKS_DIR = "books"
+# the entities books are related through, a book linked to the same one of them as another book is a neighbour
+HUB_LABELS = ("Person", "Topic", "BookSeries")
+
+
+class BookGraph:
+    """the bipartite graph of books and the persons, topics and series they are linked to, as a CSR adjacency.
+
+    Nodes 0 to n_books - 1 are the books, in the order of the books table, the nodes after them are the hubs. The
+    neighbours of node i are targets[offsets[i]: offsets[i + 1]], hubs for a book and books for a hub. Loaded with
+    mmap the arrays are shared by all workers through the page cache.
+    """
+
+    def __init__(self, offsets: np.ndarray, targets: np.ndarray, books: IdTable, max_hub_degree: int = 10_000):
+        self.offsets = offsets
+        self.targets = targets
+        self.books = books
+        self.max_hub_degree = max_hub_degree
+
+    @property
+    def n_books(self) -> int:
+        return len(self.books)
+
+    @property
+    def n_edges(self) -> int:
+        return self.targets.shape[0] // 2
+
+    def get_related_k(self, book_id: str, k: int) -> List[str]:
+        """the k books sharing the most hubs with book_id, a shared hub counts 1 / log(1 + its degree) so a rare
+        series weighs more than a popular topic. Hubs of more than max_hub_degree books are skipped.
+
+        :return: book ids, best first, empty for a book which is unknown or shares no hub
+        """
+        node = self.books.position(book_id)
+        if node is None or k <= 0:
+            return list()
+        hubs = self.targets[self.offsets[node]: self.offsets[node + 1]]
+        starts, ends = self.offsets[hubs], self.offsets[hubs + 1]
+        degrees = ends - starts
+        keep = (degrees > 1) & (degrees <= self.max_hub_degree)
+        if not keep.any():
+            return list()
+        starts, ends, degrees = starts[keep], ends[keep], degrees[keep]
+        neighbours = np.concatenate([self.targets[s: e] for s, e in zip(starts, ends)])
+        weights = np.repeat(1. / np.log1p(degrees), degrees)
+        candidates, inverse = np.unique(neighbours, return_inverse=True)
+        scores = np.bincount(inverse, weights=weights)
+        scores[candidates == node] = -1.
+        if k < len(candidates):
+            top = np.argpartition(-scores, k)[:k]
+        else:
+            top = np.arange(len(candidates))
+        # ties are broken by node, so the answer does not depend on the partition
+        top = top[np.lexsort((candidates[top], -scores[top]))]
+        return [self.books[int(x)] for x in candidates[top] if x != node]
+
+    def save(self, directory: Path):
+        directory.mkdir(parents=True, exist_ok=True)
+        self.books.save(directory / BOOKS_DIR)
+        save_array(directory / OFFSETS_FILE, self.offsets)
+        save_array(directory / TARGETS_FILE, self.targets)
+
+    @classmethod
+    def load(cls, directory: Path, max_hub_degree: int = 10_000, mmap: bool = True) -> "BookGraph":
+        mmap_mode = "r" if mmap else None
+        return cls(np.load(str(directory / OFFSETS_FILE), mmap_mode=mmap_mode),
+                   np.load(str(directory / TARGETS_FILE), mmap_mode=mmap_mode),
+                   IdTable.load(directory / BOOKS_DIR, mmap),
+                   max_hub_degree)
+
+
+def build_book_graph(triplets: EncodedTriplets, hub_labels: Sequence[str] = HUB_LABELS,
+                     batch_size: int = 10_000_000) -> BookGraph:
+    """keep the triplets between a book and a hub, in either direction and of any relation, and build the CSR
+    adjacency of both directions. Repeated book-hub pairs, e.g. an author who is also the translator, are one edge"""
+    books, book_positions = books_of_entity_table(triplets.entities)
+    n_books = len(books)
+    is_hub = np.zeros(len(triplets.entities), dtype=bool)
+    for label in hub_labels:
+        is_hub |= triplets.entities.prefix_mask(f"{label}/")
+    hub_positions = np.flatnonzero(is_hub)
+    n_nodes = n_books + len(hub_positions)
+    # entity position -> graph node, -1 for the entities which are neither
+    nodes = np.full(len(triplets.entities), -1, dtype="int64")
+    nodes[book_positions] = np.arange(n_books)
+    nodes[hub_positions] = np.arange(n_books, n_nodes)
+
+    pairs = list()
+    for start in range(0, triplets.triples.shape[0], batch_size):
+        batch = np.asarray(triplets.triples[start: start + batch_size])
+        h, t = nodes[batch[:, 0]], nodes[batch[:, 2]]
+        forward = (h >= 0) & (h < n_books) & (t >= n_books)
+        backward = (t >= 0) & (t < n_books) & (h >= n_books)
+        book = np.concatenate([h[forward], t[backward]])
+        hub = np.concatenate([t[forward], h[backward]])
+        pairs.append(book * n_nodes + hub)
+    pairs = np.unique(np.concatenate(pairs)) if len(pairs) > 0 else np.empty(0, dtype="int64")
+    book, hub = pairs // n_nodes, pairs % n_nodes
+
+    # pairs are sorted by book, so the book rows come out in order, the hub rows need a sort
+    order = np.argsort(hub, kind="stable")
+    targets = np.concatenate([hub, book[order]]).astype("int32")
+    counts = np.bincount(np.concatenate([book, hub]), minlength=n_nodes)
+    offsets = np.zeros(n_nodes + 1, dtype="int32" if targets.shape[0] < 2 ** 31 else "int64")
+    np.cumsum(counts, out=offsets[1:])
+    return BookGraph(offsets, targets, books)
+
+
+def blend(rankings: List[List[str]], k: int, c: float = 60.) -> List[str]:
+    """reciprocal rank fusion, an id scores the sum of 1 / (c + rank) over the rankings it appears in"""
+    scores: Dict[str, float] = dict()
+    for ranking in rankings:
+        for rank, x in enumerate(ranking):
+            scores[x] = scores.get(x, 0.) + 1. / (c + rank + 1)
+    # sorted is stable, on a tie the id seen first wins
+    return sorted(scores, key=lambda x: -scores[x])[:k]
+
+
+def main(input_path: Path, output: Path, hub_labels: Sequence[str]):
+    start = time.monotonic()
+    graph = build_book_graph(EncodedTriplets.load(input_path), hub_labels)
+    graph.save(output)
+    logger.info(f"graph of {graph.n_books} books, {len(graph.offsets) - 1 - graph.n_books} hubs and {graph.n_edges} "
+                f"edges written to {output} in {time.monotonic() - start:.1f}s")
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    parser = argparse.ArgumentParser(description="build the book-hub graph the backend answers source=graph with, "
+                                                 "from the triples of xinhua.data.triples")
+    parser.add_argument("--input", type=Path, default=Path("data"))
+    parser.add_argument("--output", type=Path, default=Path("data/graph"))
+    parser.add_argument("--hubs", nargs="+", default=list(HUB_LABELS), help="labels of the entities books share")
+    args = parser.parse_args()
+    main(args.input, args.output, args.hubs)
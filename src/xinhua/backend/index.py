@@ -0,0 +1,144 @@
+import argparse
+import logging
+import re
+from pathlib import Path
+from typing import Optional, Tuple
+
+import faiss
+import numpy as np
+
+from .embedding import book_rows, get_book_embeddings, read_books
+
+
+logger = logging.getLogger(__name__)
+
+
+def build_index(embeddings: np.ndarray, factory: str = "Flat", n_train: Optional[int] = 100_000) -> faiss.Index:
+    """build a faiss index over the embeddings.
+
+    :param factory: a faiss index_factory string, e.g. Flat, IVF4096,Flat (IVF-Flat), IVF4096,PQ64 (IVF-PQ) or HNSW32
+    :param n_train: number of random vectors to train the index on, if it needs training; None trains on all of them
+    """
+    embeddings = np.ascontiguousarray(embeddings, dtype="float32")
+    index = faiss.index_factory(embeddings.shape[1], factory)
+    if not index.is_trained:
+        if n_train is not None and n_train < embeddings.shape[0]:
+            sample = embeddings[np.random.RandomState(0).choice(embeddings.shape[0], n_train, replace=False)]
+        else:
+            sample = embeddings
+        index.train(sample)
+    index.add(embeddings)
+    return index
+
+
+class MappedFlatIndex:
+    """exact L2 search over a (memory mapped) float32 or float16 matrix with numpy. A faiss flat index copies its
+    vectors into every process which reads it, this one leaves them in the page cache, where all workers share them.
+    It has the part of the faiss.Index interface the backend uses"""
+
+    def __init__(self, embeddings: np.ndarray, norms: Optional[np.ndarray] = None, block_size: int = 65_536):
+        """:param norms: the squared L2 norms of the rows of embeddings, computed if not given"""
+        self._embeddings = embeddings
+        self._norms = norms if norms is not None else squared_norms(embeddings)
+        self._block_size = block_size
+        self.ntotal, self.d = embeddings.shape
+
+    def search(self, queries: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        queries = np.ascontiguousarray(queries, dtype="float32")
+        k_total = min(k, self.ntotal)
+        best_distances = np.full((queries.shape[0], 0), np.inf, dtype="float32")
+        best_labels = np.full((queries.shape[0], 0), -1, dtype="int64")
+        for start in range(0, self.ntotal, self._block_size):
+            block = np.asarray(self._embeddings[start: start + self._block_size], dtype="float32")
+            # |q - x|^2 without the |q|^2 term, it does not change the order
+            distances = self._norms[start: start + self._block_size][None, :] - 2 * queries @ block.T
+            labels = np.broadcast_to(np.arange(start, start + block.shape[0]), distances.shape)
+            distances = np.concatenate([best_distances, distances], axis=1)
+            labels = np.concatenate([best_labels, labels], axis=1)
+            if distances.shape[1] > k_total:
+                top = np.argpartition(distances, k_total - 1, axis=1)[:, :k_total]
+                distances = np.take_along_axis(distances, top, axis=1)
+                labels = np.take_along_axis(labels, top, axis=1)
+            best_distances, best_labels = distances, labels
+        order = np.argsort(best_distances, axis=1, kind="stable")
+        distances = np.take_along_axis(best_distances, order, axis=1) + (queries ** 2).sum(axis=1, keepdims=True)
+        labels = np.take_along_axis(best_labels, order, axis=1)
+        if k_total < k:
+            n = queries.shape[0]
+            distances = np.hstack([distances, np.full((n, k - k_total), np.inf, dtype="float32")])
+            labels = np.hstack([labels, np.full((n, k - k_total), -1, dtype="int64")])
+        return distances, labels
+
+    def reconstruct(self, position: int) -> np.ndarray:
+        return np.asarray(self._embeddings[position], dtype="float32")
+
+    @property
+    def nbytes(self) -> int:
+        return self._embeddings.nbytes + self._norms.nbytes
+
+
+def squared_norms(embeddings: np.ndarray, batch_size: int = 100_000) -> np.ndarray:
+    norms = np.empty(embeddings.shape[0], dtype="float32")
+    for start in range(0, embeddings.shape[0], batch_size):
+        batch = np.asarray(embeddings[start: start + batch_size], dtype="float32")
+        norms[start: start + batch_size] = (batch ** 2).sum(axis=1)
+    return norms
+
+
+def is_quantized_storage(storage: str) -> bool:
+    return storage in ("float16", "SQ8", "SQfp16") or re.fullmatch(r"PQ\d+(x\d+)?", storage) is not None
+
+
+def build_storage_index(embeddings: np.ndarray, storage: str = "float32", n_train: Optional[int] = 100_000):
+    """an exact or quantized index which holds the only copy of the book vectors the backend keeps in memory.
+
+    :param storage: float32, a faiss flat index; float16, a MappedFlatIndex over a float16 copy, which converts every
+    block per query and is slower than SQfp16 of the same size, but can be memory mapped; SQ8 or SQfp16, faiss scalar
+    quantizers with 1 or 2 bytes per dimension; PQm, e.g. PQ16, a faiss product quantizer with m bytes per vector.
+    Queries against quantized storage are reconstructed from it
+    """
+    if storage == "float32":
+        return build_index(embeddings)
+    if storage == "float16":
+        return MappedFlatIndex(np.asarray(embeddings, dtype="float16"))
+    if is_quantized_storage(storage):
+        return build_index(embeddings, storage, n_train)
+    raise ValueError(f"unknown embedding storage {storage}, expected float32, float16, SQ8, SQfp16 or PQm")
+
+
+def index_nbytes(index) -> int:
+    """memory an index holds, faiss indexes are measured by their serialized size"""
+    if isinstance(index, MappedFlatIndex):
+        return index.nbytes
+    return faiss.serialize_index(index).size
+
+
+def set_search_parameters(index: faiss.Index, nprobe: Optional[int] = None, ef_search: Optional[int] = None):
+    """trade recall for latency, nprobe applies to IVF indexes and ef_search to HNSW indexes"""
+    parameter_space = faiss.ParameterSpace()
+    if nprobe is not None:
+        parameter_space.set_index_parameter(index, "nprobe", nprobe)
+    if ef_search is not None:
+        parameter_space.set_index_parameter(index, "efSearch", ef_search)
+
+
+def main(entities_path: Path, embeddings_path: Path, output: Path, factory: str, n_train: Optional[int]):
+    _, book_positions = read_books(entities_path)
+    embeddings = book_rows(get_book_embeddings(embeddings_path), book_positions)
+    logger.info(f"building {factory} over {embeddings.shape[0]} book vectors of dimension {embeddings.shape[1]}")
+    index = build_index(embeddings, factory, n_train)
+    faiss.write_index(index, str(output))
+    logger.info(f"index written to {output}")
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    parser = argparse.ArgumentParser(description="build a faiss index offline, the backend loads it with "
+                                                 "XINHUA_INDEX_PATH")
+    parser.add_argument("--entities", type=Path, default=Path("data/entities"))
+    parser.add_argument("--embeddings", type=Path, default=Path("data/ckpts/DistMult_book_0/book_DistMult_entity.npy"))
+    parser.add_argument("--output", type=Path, required=True)
+    parser.add_argument("--factory", default="HNSW32", help="faiss index_factory string, e.g. IVF4096,Flat")
+    parser.add_argument("--n-train", type=int, default=100_000)
+    args = parser.parse_args()
+    main(args.entities, args.embeddings, args.output, args.factory, args.n_train)
@@ -0,0 +1,72 @@
+import logging
+from pathlib import Path
+from typing import Dict, List, NamedTuple, Tuple
+
+import elasticsearch
+from elasticsearch.helpers import scan
+
+from ..cache import LRUCache
+from ..data import ColumnHeader
+from ..data.pipeline import iter_catalog_rows
+
+
+logger = logging.getLogger(__name__)
+
+
+class BookMetadata(NamedTuple):
+    name: str
+    author: str
+    topic: str
+
+
+class BookMetadataStore:
+    """name, author and topic of books keyed by book id, the same fields the book index stores. At most maxsize books
+    are resident, the least recently used ones are evicted"""
+
+    def __init__(self, maxsize: int = 10_000_000):
+        self._cache = LRUCache(maxsize)
+
+    def get_many(self, book_ids: List[str]) -> Tuple[Dict[str, BookMetadata], List[str]]:
+        """
+        :return: metadata of the resident books, and the ids of the books which are not resident
+        """
+        found, missing = dict(), list()
+        for book_id in book_ids:
+            metadata = self._cache.get(book_id)
+            if metadata is None:
+                missing.append(book_id)
+            else:
+                found[book_id] = metadata
+        return found, missing
+
+    def put(self, book_id: str, metadata: BookMetadata):
+        self._cache.put(book_id, metadata)
+
+    def __len__(self) -> int:
+        return len(self._cache)
+
+    @property
+    def cache(self) -> LRUCache:
+        return self._cache
+
+    @classmethod
+    def from_catalog(cls, catalog: Path, maxsize: int = 10_000_000) -> "BookMetadataStore":
+        store = cls(maxsize)
+        for row in iter_catalog_rows(catalog):
+            store.put(row[ColumnHeader.BOOK_ID.value], BookMetadata(
+                name=row[ColumnHeader.BOOK_NAME_STR.value],
+                author=row[ColumnHeader.AUTHOR_STR.value],
+                topic=row[ColumnHeader.TOPIC_STR.value]
+            ))
+        logger.info(f"loaded metadata of {len(store)} books from {catalog}")
+        return store
+
+    @classmethod
+    def from_elasticsearch(cls, es: elasticsearch.Elasticsearch, index: str = "book",
+                           maxsize: int = 10_000_000) -> "BookMetadataStore":
+        store = cls(maxsize)
+        query = {"_source": list(BookMetadata._fields), "query": {"match_all": {}}}
+        for hit in scan(es, query=query, index=index, size=5000):
+            store.put(hit["_id"], BookMetadata(**hit["_source"]))
+        logger.info(f"loaded metadata of {len(store)} books from index {index}")
+        return store
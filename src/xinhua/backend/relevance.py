@@ -0,0 +1,107 @@
+from typing import List, Optional
+
+import faiss
+import numpy as np
+
+from ..ids import IdTable
+from .embedding import book_rows
+from .index import build_storage_index, is_quantized_storage, set_search_parameters
+from .topk import TopKTable
+
+
+class RelevantBookExtractor:
+
+    def __init__(self, book_ids: IdTable, entity_positions: Optional[np.ndarray],
+                 node_embeddings: Optional[np.ndarray] = None, index: Optional[faiss.Index] = None,
+                 nprobe: Optional[int] = None, ef_search: Optional[int] = None,
+                 topk_table: Optional[TopKTable] = None, storage: str = "float32"):
+        """only the embeddings of books are indexed, so every neighbour a search returns is a book.
+
+        :param book_ids: ids of the books without the Book/ prefix, see embedding.read_books
+        :param entity_positions: the row of every book in node_embeddings, None if node_embeddings holds the book
+        rows only, in the order of book_ids
+        :param node_embeddings: embeddings of all entities, may be memory mapped, only the rows of queried books are
+        read unless a flat index has to be built
+        :param index: a prebuilt index over the book rows of node_embeddings, e.g. read with faiss.read_index or an
+        index.MappedFlatIndex; a flat index is built if it is not given
+        :param nprobe: number of inverted lists an IVF index visits per query
+        :param ef_search: size of the candidate list of an HNSW index
+        :param topk_table: serve neighbours from a precomputed table instead of searching, node_embeddings and index
+        are not needed then
+        :param storage: how the index built when none is given stores the vectors, see index.build_storage_index.
+        With a quantized storage node_embeddings is dropped once the index is built, and query vectors are
+        reconstructed from the index
+        """
+        self._book_ids = book_ids
+        self._entity_positions = entity_positions
+        self._node_embeddings = node_embeddings
+        self._topk_table = topk_table
+        self._index = None
+        self._embedding_dim = None
+
+        if topk_table is not None:
+            if len(topk_table) != len(book_ids):
+                raise ValueError(f"top k table of {len(topk_table)} rows does not match {len(book_ids)} books")
+            return
+
+        self._embedding_dim = node_embeddings.shape[1]
+        if index is None:
+            index = build_storage_index(book_rows(node_embeddings, entity_positions)
+                                        if entity_positions is not None else node_embeddings, storage)
+            if is_quantized_storage(storage):
+                self._node_embeddings = None
+        elif index.ntotal != len(book_ids) or index.d != self._embedding_dim:
+            raise ValueError(f"index of {index.ntotal} vectors of dimension {index.d} does not match "
+                             f"{len(book_ids)} book embeddings of dimension {self._embedding_dim}")
+        if isinstance(index, faiss.Index):
+            set_search_parameters(index, nprobe, ef_search)
+        self._index = index
+
+    @property
+    def n_books(self) -> int:
+        return len(self._book_ids)
+
+    @property
+    def dim(self) -> Optional[int]:
+        """the embedding dimension, None when neighbours come from a top k table"""
+        return self._embedding_dim
+
+    def book_id(self, position: int) -> str:
+        return self._book_ids[position]
+
+    def _queries(self, positions: np.ndarray) -> np.ndarray:
+        if self._node_embeddings is None:
+            return np.vstack([self._index.reconstruct(int(x)) for x in positions]).astype("float32")
+        if self._entity_positions is not None:
+            positions = self._entity_positions[positions]
+        return np.ascontiguousarray(self._node_embeddings[positions], dtype="float32")
+
+    def get_nearest_k(self, book_id: str, k: int) -> List[str]:
+        """ids of the k books nearest to the given one, the book itself excluded. A top k table answers at most its
+        own k"""
+        position = self._book_ids.position(book_id)
+        if position is None:
+            raise KeyError(book_id)
+        if k <= 0:
+            return list()
+        if self._topk_table is not None:
+            return [self._book_ids[x] for x in self._topk_table.neighbours[position, :k] if x >= 0]
+        _, nearest = self._index.search(self._queries(np.array([position])), k + 1)
+        return [self._book_ids[x] for x in nearest[0] if x != position and x >= 0][:k]
+
+    def get_nearest_k_batch(self, book_ids: List[str], k: int) -> List[List[str]]:
+        """get_nearest_k of many books with a single search, books without an embedding get no neighbours"""
+        all_positions = self._book_ids.positions(book_ids)
+        known = np.flatnonzero(all_positions >= 0)
+        positions = all_positions[known]
+        results = [list() for _ in book_ids]
+        if len(known) == 0 or k <= 0:
+            return results
+        if self._topk_table is not None:
+            # slicing clamps k to the k of the table
+            nearest = self._topk_table.neighbours[positions, :k]
+        else:
+            _, nearest = self._index.search(self._queries(positions), k + 1)
+        for i, position, row in zip(known, positions, nearest):
+            results[i] = [self._book_ids[x] for x in row if x != position and x >= 0][:k]
+        return results
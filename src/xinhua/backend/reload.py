@@ -0,0 +1,133 @@
+import logging
+import threading
+import time
+from pathlib import Path
+from typing import Callable, List, Optional, Tuple
+
+from .relevance import RelevantBookExtractor
+
+
+logger = logging.getLogger(__name__)
+
+
+def validate_replacement(old: Optional[RelevantBookExtractor], new: RelevantBookExtractor,
+                         max_book_change: float = .5):
+    """refuse an extractor which is empty, cannot answer a query, changes the embedding dimension, or whose number of
+    books differs by more than max_book_change (a fraction) from the one it replaces"""
+    if new.n_books == 0:
+        raise ValueError("the new extractor holds no books")
+    new.get_nearest_k(new.book_id(0), 1)
+    if old is None:
+        return
+    if old.dim is not None and new.dim is not None and old.dim != new.dim:
+        raise ValueError(f"embedding dimension changed from {old.dim} to {new.dim}")
+    change = abs(new.n_books - old.n_books) / old.n_books
+    if change > max_book_change:
+        raise ValueError(f"number of books changed from {old.n_books} to {new.n_books}, more than "
+                         f"{max_book_change:.0%}")
+
+
+class ExtractorReloader:
+    """holds the current RelevantBookExtractor and replaces it with a freshly built one.
+
+    The new extractor is built and validated while the old one keeps serving, then the reference is swapped. A request
+    reads current once and keeps that instance until it finishes, the old extractor is freed when the last of them
+    drops it. One reload runs at a time.
+    """
+
+    def __init__(self, build: Callable[[], RelevantBookExtractor], max_book_change: float = .5,
+                 on_swap: Optional[Callable[[RelevantBookExtractor], None]] = None):
+        self.current: Optional[RelevantBookExtractor] = None
+        self._build = build
+        self._max_book_change = max_book_change
+        self._on_swap = on_swap
+        self._lock = threading.Lock()
+        self.n_reloads = 0
+        self.n_failures = 0
+        self.last_duration: Optional[float] = None
+        self.last_reload_at: Optional[float] = None
+        self.last_error: Optional[str] = None
+
+    @property
+    def reloading(self) -> bool:
+        return self._lock.locked()
+
+    def reload(self) -> RelevantBookExtractor:
+        """build, validate and swap in a new extractor, on failure the current one is kept and the error is raised"""
+        with self._lock:
+            return self._reload()
+
+    def _reload(self) -> RelevantBookExtractor:
+        start = time.monotonic()
+        try:
+            new = self._build()
+            validate_replacement(self.current, new, self._max_book_change)
+        except Exception as e:
+            self.n_failures += 1
+            self.last_error = repr(e)
+            raise
+        self.current = new
+        self.n_reloads += 1
+        self.last_duration = time.monotonic() - start
+        self.last_reload_at = time.time()
+        self.last_error = None
+        logger.info(f"relevant book extractor of {new.n_books} books swapped in after {self.last_duration:.1f}s")
+        if self._on_swap is not None:
+            self._on_swap(new)
+        return new
+
+    def _reload_logged(self, locked: bool = False):
+        try:
+            if locked:
+                self._reload()
+            else:
+                self.reload()
+        except Exception:
+            logger.exception("reload failed, the current extractor is kept")
+        finally:
+            if locked:
+                self._lock.release()
+
+    def reload_in_background(self) -> bool:
+        """:return: False if a reload is already running"""
+        if not self._lock.acquire(blocking=False):
+            return False
+        threading.Thread(target=self._reload_logged, args=(True,), name="reload-extractor", daemon=True).start()
+        return True
+
+    def watch(self, paths: Callable[[], List[Path]], interval: float = 30.):
+        """poll the modification times of paths and reload once they changed and then stayed the same for one more
+        interval, so a file which is still being written is not picked up"""
+        def signature() -> Tuple:
+            result = list()
+            for path in paths():
+                try:
+                    stat = path.stat()
+                    result.append((str(path), stat.st_mtime_ns, stat.st_size))
+                except FileNotFoundError:
+                    result.append((str(path), None, None))
+            return tuple(result)
+
+        def run():
+            loaded, seen = signature(), None
+            while True:
+                time.sleep(interval)
+                current = signature()
+                if current != loaded and current == seen:
+                    logger.info("watched files changed, reloading the relevant book extractor")
+                    self._reload_logged()
+                    loaded = current
+                seen = current
+
+        threading.Thread(target=run, name="watch-extractor", daemon=True).start()
+
+    def stats(self) -> dict:
+        return {
+            "reloading": self.reloading,
+            "n_books": self.current.n_books if self.current is not None else None,
+            "reloads": self.n_reloads,
+            "failures": self.n_failures,
+            "last_duration_seconds": self.last_duration,
+            "last_reload_at": self.last_reload_at,
+            "last_error": self.last_error
+        }
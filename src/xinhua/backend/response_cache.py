@@ -0,0 +1,113 @@
+import json
+import logging
+import time
+from typing import Optional, Tuple
+
+from ..cache import LRUCache
+
+
+logger = logging.getLogger(__name__)
+
+GENERATION_KEY = "generation"
+
+
+class InProcessBackend:
+    """a size and ttl bounded LRU in the memory of this worker"""
+
+    def __init__(self, maxsize: int = 10_000, ttl: float = 300.):
+        self._cache = LRUCache(maxsize, ttl)
+        self._generation = 0
+
+    async def get(self, key: str) -> Optional[bytes]:
+        if key == GENERATION_KEY:
+            return str(self._generation).encode()
+        return self._cache.get(key)
+
+    async def set(self, key: str, value: bytes):
+        self._cache.put(key, value)
+
+    async def incr(self, key: str) -> int:
+        self._generation += 1
+        self._cache.clear()
+        return self._generation
+
+
+class KeyValueBackend:
+    """a store shared by all workers, client is anything with redis-style coroutines get(key), set(key, value, ex=ttl)
+    and incr(key), e.g. a redis.asyncio client, or a local stand-in in tests"""
+
+    def __init__(self, client, ttl: float = 300., prefix: str = "xinhua:books:"):
+        self._client = client
+        self._ttl = ttl
+        self._prefix = prefix
+
+    async def get(self, key: str) -> Optional[bytes]:
+        return await self._client.get(self._prefix + key)
+
+    async def set(self, key: str, value: bytes):
+        await self._client.set(self._prefix + key, value, ex=int(self._ttl))
+
+    async def incr(self, key: str) -> int:
+        return await self._client.incr(self._prefix + key)
+
+
+def redis_client(url: str):
+    """an asyncio redis client for a url like redis://host:6379/0, redis is only needed if a url is configured"""
+    try:
+        import redis.asyncio
+    except ImportError as e:
+        raise ImportError("a shared response cache needs the redis package, pip install redis") from e
+    return redis.asyncio.from_url(url)
+
+
+class ResponseCache:
+    """serialized /books responses keyed by (q, max_hit, max_relevant, source).
+
+    Keys also carry a generation number kept in the backend. invalidate() increments it, which makes every cached
+    response unreachable, for all workers sharing the backend; workers re-read the generation every
+    generation_refresh seconds.
+    """
+
+    def __init__(self, backend, generation_refresh: float = 1.):
+        self._backend = backend
+        self._generation_refresh = generation_refresh
+        self._generation = None
+        self._generation_read_at = 0.
+        self.hits = 0
+        self.misses = 0
+
+    async def _current_generation(self) -> int:
+        now = time.monotonic()
+        if self._generation is None or now - self._generation_read_at > self._generation_refresh:
+            self._generation = int(await self._backend.get(GENERATION_KEY) or 0)
+            self._generation_read_at = now
+        return self._generation
+
+    async def _key(self, q: str, max_hit: int, max_relevant: int, source: str) -> str:
+        return json.dumps([await self._current_generation(), q, max_hit, max_relevant, source], ensure_ascii=False)
+
+    async def get(self, q: str, max_hit: int, max_relevant: int,
+                  source: str = "embedding") -> Tuple[str, Optional[bytes]]:
+        """:return: the key, pass it to set to store the response computed on a miss, and the cached response"""
+        key = await self._key(q, max_hit, max_relevant, source)
+        value = await self._backend.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return key, value
+
+    async def set(self, key: str, value: bytes):
+        """:param key: the key get returned, a response computed before an invalidate() is stored under the previous
+        generation then, where no lookup finds it"""
+        await self._backend.set(key, value)
+
+    async def invalidate(self):
+        self._generation = await self._backend.incr(GENERATION_KEY)
+        self._generation_read_at = time.monotonic()
+        logger.info(f"response cache invalidated, generation {self._generation}")
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0.
@@ -0,0 +1,62 @@
+from enum import Enum
+from pathlib import Path
+from typing import List, Optional
+
+from pydantic import BaseSettings
+
+
+class MetadataSource(str, Enum):
+    catalog = "catalog"
+    elasticsearch = "elasticsearch"
+    none = "none"
+
+
+class Settings(BaseSettings):
+    """backend configuration, every field can be set with an environment variable, e.g. XINHUA_INDEX_PATH"""
+    # a json list, e.g. ["localhost:9200"], the default is localhost:9200
+    es_hosts: Optional[List[str]] = None
+    # keep-alive connections the async elasticsearch client pools
+    es_maxsize: int = 100
+    # a directory published by xinhua.backend.bundle, all workers memory map it and the paths below are ignored
+    bundle_path: Optional[Path] = None
+    # the entity table written by xinhua.data.triples, or the entities.tsv of a dglke run on raw triplets
+    entities_path: Path = Path("data/entities")
+    # the book ids of entities_path are saved here as a compact table the first time and memory mapped afterwards
+    book_table_path: Optional[Path] = None
+    embeddings_path: Path = Path("data/ckpts/DistMult_book_0/book_DistMult_entity.npy")
+    # a faiss index built offline with xinhua.backend.index, a flat index is built at startup if it is not set
+    index_path: Optional[Path] = None
+    # how the index built at startup stores the book vectors: float32, float16, SQ8, SQfp16 or PQm, e.g. PQ16, see
+    # index.build_storage_index and scripts/evaluate_ann_index.py for the memory and recall of each
+    embedding_storage: str = "float32"
+    nprobe: Optional[int] = None
+    ef_search: Optional[int] = None
+    # a table built with xinhua.backend.topk, neighbours are looked up in it instead of searched for if it is set
+    topk_path: Optional[Path] = None
+    # a graph built with xinhua.backend.graph, /books?source=graph or blend relates books through it
+    graph_path: Optional[Path] = None
+    # hubs linked to more books than this, e.g. a broad topic, relate nothing in the graph
+    graph_max_hub_degree: int = 10_000
+    # poll the files above every this many seconds and reload the extractor when they change, POST /admin/reload
+    # reloads on demand
+    reload_watch_interval: Optional[float] = None
+    # a reload is refused if the number of books changes by more than this fraction
+    reload_max_book_change: float = .5
+    # where the in-process book metadata store is loaded from: catalog, elasticsearch, or none to always use _mget
+    metadata_source: MetadataSource = MetadataSource.none
+    metadata_catalog_path: Path = Path("data/1000.csv")
+    metadata_max_size: int = 10_000_000
+    # responses cached in process, 0 turns the cache off
+    response_cache_size: int = 10_000
+    response_cache_ttl: float = 300.
+    # a redis url, e.g. redis://localhost:6379/0, to share the response cache and its invalidation between all
+    # workers instead of caching in process
+    response_cache_url: Optional[str] = None
+    # sample the stacks of all threads and dump them as collapsed stacks to profile_output for every request slower
+    # than this many seconds, off by default as sampling slows every request down a little
+    profile_slow_request_seconds: Optional[float] = None
+    profile_output: Path = Path("profiles")
+    profile_interval: float = .005
+
+    class Config:
+        env_prefix = "XINHUA_"
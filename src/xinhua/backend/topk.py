@@ -0,0 +1,84 @@
+import argparse
+import logging
+from pathlib import Path
+from typing import Optional
+
+import faiss
+import numpy as np
+
+from .embedding import book_rows, get_book_embeddings, read_books
+from .index import build_index, set_search_parameters
+
+
+logger = logging.getLogger(__name__)
+
+NEIGHBOURS_FILE = "neighbours.npy"
+SCORES_FILE = "scores.npy"
+
+
+class TopKTable:
+    """the k nearest books of every book, row i holds the book positions (int32, -1 if there are fewer than k) and the
+    L2 distances (float16) of the neighbours of book position i, nearest first. The files are memory mapped, so a
+    lookup reads one row and worker processes share the pages through the page cache"""
+
+    def __init__(self, neighbours: np.ndarray, scores: np.ndarray):
+        self.neighbours = neighbours
+        self.scores = scores
+
+    @property
+    def k(self) -> int:
+        return self.neighbours.shape[1]
+
+    def __len__(self) -> int:
+        return self.neighbours.shape[0]
+
+    @classmethod
+    def load(cls, directory: Path) -> "TopKTable":
+        return cls(np.load(str(directory / NEIGHBOURS_FILE), mmap_mode="r"),
+                   np.load(str(directory / SCORES_FILE), mmap_mode="r"))
+
+
+def build_topk_table(book_embeddings: np.ndarray, index: faiss.Index, k: int, output: Path,
+                     batch_size: int = 10_000) -> TopKTable:
+    """search the k nearest books of all books with large batched searches and write the table to output"""
+    output.mkdir(parents=True, exist_ok=True)
+    n = book_embeddings.shape[0]
+    neighbours = np.lib.format.open_memmap(str(output / NEIGHBOURS_FILE), mode="w+", dtype="int32", shape=(n, k))
+    scores = np.lib.format.open_memmap(str(output / SCORES_FILE), mode="w+", dtype="float16", shape=(n, k))
+    for start in range(0, n, batch_size):
+        positions = np.arange(start, min(start + batch_size, n))
+        distances, nearest = index.search(np.ascontiguousarray(book_embeddings[positions], dtype="float32"), k + 1)
+        # move the book itself behind its neighbours, the order of the others is kept
+        order = np.argsort(nearest == positions[:, None], axis=1, kind="stable")[:, :k]
+        neighbours[positions] = np.take_along_axis(nearest, order, axis=1)
+        scores[positions] = np.take_along_axis(distances, order, axis=1)
+        logger.info(f"searched {positions[-1] + 1} of {n} books")
+    neighbours.flush()
+    scores.flush()
+    return TopKTable.load(output)
+
+
+def main(entities_path: Path, embeddings_path: Path, index_path: Optional[Path], output: Path, k: int,
+         nprobe: Optional[int], ef_search: Optional[int]):
+    _, book_positions = read_books(entities_path)
+    book_embeddings = book_rows(get_book_embeddings(embeddings_path), book_positions)
+    index = faiss.read_index(str(index_path)) if index_path is not None else build_index(book_embeddings)
+    set_search_parameters(index, nprobe, ef_search)
+    build_topk_table(book_embeddings, index, k, output)
+    logger.info(f"top {k} table of {len(book_positions)} books written to {output}")
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    parser = argparse.ArgumentParser(description="precompute the related books of every book, the backend serves "
+                                                 "them with XINHUA_TOPK_PATH")
+    parser.add_argument("--entities", type=Path, default=Path("data/entities"))
+    parser.add_argument("--embeddings", type=Path, default=Path("data/ckpts/DistMult_book_0/book_DistMult_entity.npy"))
+    parser.add_argument("--index", type=Path, default=None, help="index built with xinhua.backend.index, "
+                                                                 "the default is an exact flat search")
+    parser.add_argument("--output", type=Path, default=Path("data/topk"))
+    parser.add_argument("-k", type=int, default=50)
+    parser.add_argument("--nprobe", type=int, default=None)
+    parser.add_argument("--ef-search", type=int, default=None)
+    args = parser.parse_args()
+    main(args.entities, args.embeddings, args.index, args.output, args.k, args.nprobe, args.ef_search)
@@ -0,0 +1,71 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Optional, Tuple
+
+
+class LRUCache:
+    """a bounded mapping that evicts the least recently used entry once it holds maxsize entries, and with a ttl
+    also entries older than ttl seconds. Hits and misses of get are counted, a membership test counts nothing"""
+
+    def __init__(self, maxsize: int = 100_000, ttl: Optional[float] = None):
+        self._maxsize = maxsize
+        self._ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            if self._ttl is not None:
+                value, expires_at = value
+                if expires_at < time.monotonic():
+                    del self._data[key]
+                    self.misses += 1
+                    return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: Hashable, value: Any):
+        if self._ttl is not None:
+            value = (value, time.monotonic() + self._ttl)
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            if len(self._data) > self._maxsize:
+                self._data.popitem(last=False)
+
+    def __contains__(self, key: Hashable) -> bool:
+        with self._lock:
+            value = self._data.get(key)
+        if value is None:
+            return False
+        return self._ttl is None or value[1] >= time.monotonic()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0.
+
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}(size={len(self)}, maxsize={self._maxsize}, hits={self.hits}, " \
+               f"misses={self.misses}, hit_rate={self.hit_rate:.2%})"
+
+
+def entity_key(node) -> Tuple[str, str, Any]:
+    """cache key of a graph node, (label, identifier, identifier value)"""
+    return node.label, node.identifier, node.identifier_value
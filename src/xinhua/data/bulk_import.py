@@ -0,0 +1,232 @@
+import argparse
+import csv
+import json
+import logging
+import shutil
+import zlib
+from collections import defaultdict
+from dataclasses import fields
+from pathlib import Path
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+from urllib.parse import quote
+
+from .cql import Node
+from .extraction import FastEntityExtractor
+from .pipeline import STAGE_SECONDS, extract_catalog
+
+
+logger = logging.getLogger(__name__)
+
+NEO4J_TYPES = {int: "int", float: "double", bool: "boolean"}
+NEPTUNE_TYPES = {int: "Int", float: "Double", bool: "Bool"}
+
+
+class SpillWriter:
+    """append lines to many files, lines are buffered in memory and written once max_buffered_lines is reached"""
+
+    def __init__(self, directory: Path, max_buffered_lines: int = 200_000):
+        self._directory = directory
+        self._max_buffered_lines = max_buffered_lines
+        self._buffers: Dict[Path, List[str]] = defaultdict(list)
+        self._n_buffered = 0
+
+    def write(self, path: Path, line: str):
+        self._buffers[path].append(line)
+        self._n_buffered += 1
+        if self._n_buffered >= self._max_buffered_lines:
+            self.flush()
+
+    def flush(self):
+        for path, lines in self._buffers.items():
+            path = self._directory / path
+            path.parent.mkdir(parents=True, exist_ok=True)
+            with path.open("a") as f:
+                f.writelines(lines)
+        self._buffers.clear()
+        self._n_buffered = 0
+
+
+class Column(NamedTuple):
+    name: str
+    python_type: type
+
+    def neo4j_header(self) -> str:
+        t = NEO4J_TYPES.get(self.python_type)
+        return self.name if t is None else f"{self.name}:{t}"
+
+    def neptune_header(self) -> str:
+        return f"{self.name}:{NEPTUNE_TYPES.get(self.python_type, 'String')}"
+
+
+class BulkImportGenerator:
+    """generate the files of an offline initial load, no database has to be running.
+
+    Nodes and edges are deduplicated in two passes with bounded memory: add spills every node and edge into one of
+    n_buckets files of its label or relation type, chosen by hashing its key; close then deduplicates one bucket at a
+    time and writes it as a shard in the formats of `neo4j-admin import` and of the Neptune bulk loader.
+    """
+
+    node_types = {x.__name__: x for x in Node.__subclasses__()}
+
+    def __init__(self, output: Path, n_buckets: int = 64, formats: Iterable[str] = ("neo4j", "neptune")):
+        self._output = output
+        self._spill_dir = output / "spill"
+        self._n_buckets = n_buckets
+        self._formats = set(formats)
+        self._spill = SpillWriter(self._spill_dir)
+        self._node_columns: Dict[str, Tuple[str, List[Column]]] = dict()
+        self._edge_types: Dict[str, Tuple[str, str, str]] = dict()
+        self.n_rows = 0
+
+    def _bucket(self, value) -> int:
+        return zlib.crc32(str(value).encode("utf-8")) % self._n_buckets
+
+    def add(self, nodes: List[Node], relations: List[Tuple[Node, str, Node]]):
+        """add the nodes and relations of a row, nodes can be Node dataclasses or extraction.Entity records"""
+        for node in nodes:
+            if node.label not in self._node_columns:
+                node_type = self.node_types[node.label]
+                columns = [Column(f.name, f.type) for f in fields(node_type) if f.name != node.identifier]
+                self._node_columns[node.label] = (node.identifier, columns)
+            self._spill.write(
+                Path("nodes", node.label, f"{self._bucket(node.identifier_value)}.jsonl"),
+                json.dumps([node.identifier_value, node.properties], ensure_ascii=False) + "\n")
+        for src, relation_label, dst in relations:
+            edge_type = quote(f"{src.label}|{relation_label}|{dst.label}", safe="")
+            self._edge_types[edge_type] = (src.label, relation_label, dst.label)
+            self._spill.write(
+                Path("edges", edge_type, f"{self._bucket(src.identifier_value)}.jsonl"),
+                json.dumps([src.identifier_value, dst.identifier_value], ensure_ascii=False) + "\n")
+        self.n_rows += 1
+
+    @staticmethod
+    def _read_bucket(path: Path) -> Dict:
+        """deduplicate the records of a bucket, the first occurrence of a key wins"""
+        records = dict()
+        with path.open("r") as f:
+            for line in f:
+                key, value = json.loads(line)
+                if key not in records:
+                    records[key] = value
+        return records
+
+    def _write_nodes(self, label: str) -> Dict[str, List[Path]]:
+        identifier, columns = self._node_columns[label]
+        files = defaultdict(list)
+        if "neo4j" in self._formats:
+            header = self._output / "neo4j" / f"nodes_{label}_header.csv"
+            header.parent.mkdir(parents=True, exist_ok=True)
+            with header.open("w", newline="") as f:
+                csv.writer(f).writerow(
+                    [f"{identifier}:ID({label})"] + [x.neo4j_header() for x in columns] + [":LABEL"])
+            files["neo4j"].append(header)
+
+        for bucket in sorted((self._spill_dir / "nodes" / label).glob("*.jsonl"), key=lambda x: int(x.stem)):
+            records = self._read_bucket(bucket)
+            shard = int(bucket.stem)
+            if "neo4j" in self._formats:
+                path = self._output / "neo4j" / f"nodes_{label}_{shard:04d}.csv"
+                with path.open("w", newline="") as f:
+                    writer = csv.writer(f)
+                    for key, properties in records.items():
+                        writer.writerow([key] + [properties.get(x.name) for x in columns] + [label])
+                files["neo4j"].append(path)
+            if "neptune" in self._formats:
+                path = self._output / "neptune" / f"vertices_{label}_{shard:04d}.csv"
+                path.parent.mkdir(parents=True, exist_ok=True)
+                with path.open("w", newline="") as f:
+                    writer = csv.writer(f)
+                    writer.writerow(
+                        ["~id", "~label", f"{identifier}:String"] + [x.neptune_header() for x in columns])
+                    for key, properties in records.items():
+                        writer.writerow([f"{label}/{key}", label, key] + [properties.get(x.name) for x in columns])
+                files["neptune"].append(path)
+        return files
+
+    def _write_edges(self, edge_type: str) -> Dict[str, List[Path]]:
+        src_label, relation_label, dst_label = self._edge_types[edge_type]
+        files = defaultdict(list)
+        if "neo4j" in self._formats:
+            header = self._output / "neo4j" / f"relationships_{edge_type}_header.csv"
+            with header.open("w", newline="") as f:
+                csv.writer(f).writerow([f":START_ID({src_label})", f":END_ID({dst_label})", ":TYPE"])
+            files["neo4j"].append(header)
+
+        for bucket in sorted((self._spill_dir / "edges" / edge_type).glob("*.jsonl"), key=lambda x: int(x.stem)):
+            records = defaultdict(dict)
+            with bucket.open("r") as f:
+                for line in f:
+                    src, dst = json.loads(line)
+                    records[src][dst] = None
+            shard = int(bucket.stem)
+            if "neo4j" in self._formats:
+                path = self._output / "neo4j" / f"relationships_{edge_type}_{shard:04d}.csv"
+                with path.open("w", newline="") as f:
+                    writer = csv.writer(f)
+                    for src, dsts in records.items():
+                        for dst in dsts:
+                            writer.writerow([src, dst, relation_label])
+                files["neo4j"].append(path)
+            if "neptune" in self._formats:
+                path = self._output / "neptune" / f"edges_{edge_type}_{shard:04d}.csv"
+                with path.open("w", newline="") as f:
+                    writer = csv.writer(f)
+                    writer.writerow(["~id", "~from", "~to", "~label"])
+                    for src, dsts in records.items():
+                        for dst in dsts:
+                            src_id, dst_id = f"{src_label}/{src}", f"{dst_label}/{dst}"
+                            writer.writerow([f"{src_id}|{relation_label}|{dst_id}", src_id, dst_id, relation_label])
+                files["neptune"].append(path)
+        return files
+
+    def close(self):
+        """deduplicate the spilled records and write the import files
+
+        :return: neo4j-admin import arguments
+        """
+        self._spill.flush()
+        arguments = list()
+        for label in self._node_columns:
+            files = self._write_nodes(label)
+            if "neo4j" in self._formats:
+                arguments.append("--nodes=" + ",".join(str(x) for x in files["neo4j"]))
+            logger.info(f"written nodes of {label}")
+        for edge_type in self._edge_types:
+            files = self._write_edges(edge_type)
+            if "neo4j" in self._formats:
+                arguments.append("--relationships=" + ",".join(str(x) for x in files["neo4j"]))
+            logger.info(f"written edges of {self._edge_types[edge_type]}")
+        shutil.rmtree(self._spill_dir)
+        return arguments
+
+
+def main(catalog: Path, output: Path, n_buckets: int = 64, formats: Iterable[str] = ("neo4j", "neptune"),
+         n_workers: Optional[int] = None):
+    if (output / "spill").exists():
+        shutil.rmtree(output / "spill")
+    extractor = FastEntityExtractor()
+    generator = BulkImportGenerator(output, n_buckets, formats)
+
+    for i, (_, nodes, relations) in enumerate(extract_catalog(catalog, extractor, n_workers, ordered=False)):
+        generator.add(nodes, relations)
+        if i % 100_000 == 0:
+            logger.info(f"processed {i} rows")
+
+    arguments = generator.close()
+    logger.info(f"stage summary: {STAGE_SECONDS.summary()}")
+    if "neo4j" in formats:
+        logger.info("import with: neo4j-admin import --database=neo4j --id-type=STRING --multiline-fields=true "
+                    + " ".join(arguments))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--catalog", type=Path, default=Path("data/1000.csv"), help="csv file, optionally gzipped")
+    parser.add_argument("--workers", type=int, default=None, help="extraction processes, 0 to extract in process")
+    parser.add_argument("--output", type=Path, default=Path("data/bulk_import"))
+    parser.add_argument("--buckets", type=int, default=64, help="shards per label and relation type")
+    parser.add_argument("--format", action="append", choices=["neo4j", "neptune"], dest="formats")
+    args = parser.parse_args()
+    main(catalog=args.catalog, output=args.output, n_buckets=args.buckets, formats=args.formats or ["neo4j", "neptune"],
+         n_workers=args.workers)
@@ -0,0 +1,73 @@
+import hashlib
+import sqlite3
+from pathlib import Path
+from typing import Dict, Iterable, Set, Tuple
+
+from . import ColumnHeader
+from .pipeline import FIELDNAMES
+
+
+def row_hash(row: Dict[str, str]) -> bytes:
+    """a digest of every field of a catalog row, a book whose digest is unchanged needs no write"""
+    h = hashlib.blake2b(digest_size=16)
+    for name in FIELDNAMES:
+        value = row.get(name)
+        h.update(b"\x00" if value is None else value.encode("utf-8"))
+        h.update(b"\x1f")
+    return h.digest()
+
+
+def catalog_fingerprint(path: Path) -> str:
+    """identifies a catalog file, a resume offset is only valid for the file it was recorded for"""
+    stat = path.stat()
+    return f"{path.resolve()}:{stat.st_size}:{stat.st_mtime_ns}"
+
+
+class CheckpointStore:
+    """a durable record, in a local sqlite file, of the content hash of every book written to each sink and of how
+    far into the current catalog the last committed batch reached.
+
+    Hashes and the offset are committed in one transaction after the sinks flushed the rows they cover, so after a
+    crash the store never claims a row that was not written. Hashes are kept per sink, a sink added to a later run
+    gets every book, not only the ones changed since.
+    """
+
+    def __init__(self, path: Path):
+        self._db = sqlite3.connect(str(path), check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS hashes (book_id TEXT NOT NULL, sink TEXT NOT NULL, "
+                         "hash BLOB NOT NULL, PRIMARY KEY (book_id, sink))")
+        self._db.execute("CREATE TABLE IF NOT EXISTS progress (catalog TEXT PRIMARY KEY, n_rows INTEGER NOT NULL)")
+        self._db.commit()
+
+    def unchanged_sinks(self, row: Dict[str, str], digest: bytes) -> Set[str]:
+        """:return: names of the sinks the row was written to with the same content"""
+        found = self._db.execute("SELECT sink, hash FROM hashes WHERE book_id = ?",
+                                 (row[ColumnHeader.BOOK_ID.value],)).fetchall()
+        return {sink for sink, value in found if value == digest}
+
+    def resume_offset(self, catalog: Path) -> int:
+        """rows of catalog committed by an interrupted run, 0 for a new or a completed catalog"""
+        found = self._db.execute("SELECT n_rows FROM progress WHERE catalog = ?",
+                                 (catalog_fingerprint(catalog),)).fetchone()
+        return 0 if found is None else found[0]
+
+    def commit(self, catalog: Path, n_rows: int, hashes: Iterable[Tuple[str, str, bytes]]):
+        """record that the first n_rows rows of catalog are written, with the sink, book id and hash of every book
+        written since the previous commit"""
+        with self._db:
+            self._db.executemany("INSERT OR REPLACE INTO hashes (sink, book_id, hash) VALUES (?, ?, ?)", hashes)
+            self._db.execute("INSERT OR REPLACE INTO progress (catalog, n_rows) VALUES (?, ?)",
+                             (catalog_fingerprint(catalog), n_rows))
+
+    def complete(self, catalog: Path):
+        """forget the offset once the catalog is fully written, a rerun relies on the hashes alone"""
+        with self._db:
+            self._db.execute("DELETE FROM progress WHERE catalog = ?", (catalog_fingerprint(catalog),))
+
+    def __len__(self) -> int:
+        """number of books written to any sink"""
+        return self._db.execute("SELECT count(DISTINCT book_id) FROM hashes").fetchone()[0]
+
+    def close(self):
+        self._db.close()
@@ -1,14 +1,20 @@
-import csv
+import argparse
 import logging
 from abc import ABC, abstractmethod
+from collections import defaultdict
 from dataclasses import dataclass
 from enum import Enum
+from pathlib import Path
 from typing import List, Dict, Optional, Tuple
 import re
 
 from neo4j import Session, Transaction, Driver, GraphDatabase
 
 from . import ColumnHeader
+from .extraction import FastEntityExtractor
+from .pipeline import STAGE_SECONDS, WRITE_BATCH_SIZE, extract_catalog, observe_write
+from ..cache import LRUCache, entity_key
+from .schema import ensure_schema
 
 
 logger = logging.getLogger(__name__)
@@ -21,32 +27,22 @@ class Node:
     def label(self) -> str:
         return self.__class__.__name__
 
-    def _created(self, tx) -> bool:
-        try:
-            q = f"MATCH (a:{self.label}) " \
-                f"WHERE a.{self.identifier}=$identifier_value " \
-                f"RETURN a.{self.identifier} LIMIT 1"
-            r = tx.run(q, identifier_value=self.identifier_value)
-        except Exception as e:
-            raise e
-        return len(list(r)) > 0
-
-    def _create_self(self, tx: Transaction):
-        cql = f"CREATE (n:{self.label}) "
-        for k, v in self.__dict__.items():
-            if v is not None:
-                cql += fr"SET n.{k}=${k} "
-        tx.run(cql, **self.__dict__)
-
-    def put(self, driver: Driver):
-        """add the node to neo4j server and return the vertex created; or return the vertex directly if the node
-        already exists. Existence of a node is decided by node id if this property exists, otherwise by name
-
-        :return identifier, identifier value
+    def _merge_self(self, tx: Transaction):
+        cql = f"MERGE (n:{self.label} {{{self.identifier}: $identifier_value}}) " \
+              f"ON CREATE SET n += $properties"
+        tx.run(cql, identifier_value=self.identifier_value, properties=self.properties)
+
+    def put(self, driver: Driver, cache: Optional[LRUCache] = None):
+        """add the node to neo4j server if it does not exist yet. Existence of a node is decided by node id if this
+        property exists, otherwise by name; the lookup is backed by the uniqueness constraints of schema.ensure_schema.
+        Nodes found in cache are known to be written already and skip the server round trip
         """
+        if cache is not None and cache.get(entity_key(self)) is not None:
+            return
         with driver.session() as session:
-            if not session.read_transaction(self._created):
-                session.write_transaction(self._create_self)
+            session.write_transaction(self._merge_self)
+        if cache is not None:
+            cache.put(entity_key(self), True)
 
     @property
     def identifier(self) -> str:
@@ -56,20 +52,40 @@ class Node:
     def identifier_value(self) -> str:
         return getattr(self, self.identifier)
 
-    def _connect_tx(self, tx: Transaction, dst: "Node", relation_label: str):
-        q = f"MATCH (a:{self.label}), (b:{dst.label}) " \
-            fr"WHERE a.{self.identifier}= $src_identifier_value and b.{dst.identifier}=$dst_identifier_value " \
-            f"MERGE (a)-[r:{relation_label}]->(b)"
-        tx.run(q, src_identifier_value=self.identifier_value, dst_identifier_value=dst.identifier_value)
-
-    def connect(self, dst: "Node", driver: Driver, relation_label: str):
-        """create an edge from self node to dst node if it does not exist.
-        :return: created edge or existed edge
+    @property
+    def properties(self) -> Dict:
+        return {k: v for k, v in self.__dict__.items() if v is not None}
+
+    def _endpoint(self, variable: str, known: bool) -> str:
+        """a known node is only matched, an unknown one is merged with its properties"""
+        pattern = f"({variable}:{self.label} {{{self.identifier}: ${variable}_identifier_value}})"
+        if known:
+            return f"MATCH {pattern} "
+        return f"MERGE {pattern} ON CREATE SET {variable} += ${variable}_properties "
+
+    def _connect_tx(self, tx: Transaction, dst: "Node", relation_label: str, src_known: bool = False,
+                    dst_known: bool = False):
+        endpoints = [self._endpoint("a", src_known), dst._endpoint("b", dst_known)]
+        # cypher reads before it writes, without a WITH in between
+        q = "".join(sorted(endpoints, key=lambda x: not x.startswith("MATCH"))) + \
+            f"MERGE (a)-[r:{relation_label}]->(b) RETURN count(r) AS n"
+        n = tx.run(q, a_identifier_value=self.identifier_value, a_properties=self.properties,
+                   b_identifier_value=dst.identifier_value, b_properties=dst.properties).single()["n"]
+        if n == 0 and (src_known or dst_known):
+            # a cached node was deleted on the server meanwhile, merge both
+            self._connect_tx(tx, dst, relation_label)
+
+    def connect(self, dst: "Node", driver: Driver, relation_label: str, cache: Optional[LRUCache] = None):
+        """create an edge from self node to dst node if it does not exist, both nodes are created as well if they do
+        not exist. Everything happens in a single transaction. Nodes found in cache are only matched, not merged
         """
-        self.put(driver)
-        dst.put(driver)
+        src_known = cache is not None and cache.get(entity_key(self)) is not None
+        dst_known = cache is not None and cache.get(entity_key(dst)) is not None
         with driver.session() as session:
-            session.write_transaction(self._connect_tx, dst, relation_label)
+            session.write_transaction(self._connect_tx, dst, relation_label, src_known, dst_known)
+        if cache is not None:
+            cache.put(entity_key(self), True)
+            cache.put(entity_key(dst), True)
 
 
 @dataclass
@@ -112,9 +128,148 @@ class Book(Node):
     name: str
 
 
+Relation = Tuple[Node, str, Node]
+
+
+class BulkLoader:
+    """buffer nodes and edges and write them to neo4j in batches. Nodes are grouped by label and edges by
+    (source label, relation label, destination label), every group is written with one parameterized
+    UNWIND ... MERGE statement per batch, one transaction per batch. Run schema.ensure_schema first, so the MERGE
+    and MATCH on identifiers are index lookups. With a cache, nodes written by an earlier batch are not merged again.
+    With update_properties, the properties of existing nodes are overwritten too, for re-ingesting changed rows.
+    """
+
+    def __init__(self, driver: Driver, batch_size: int = 1000, cache: Optional[LRUCache] = None,
+                 update_properties: bool = False):
+        self._driver = driver
+        self._update_properties = update_properties
+        self._batch_size = batch_size
+        self._cache = cache
+        # (label, identifier) -> identifier value -> properties
+        self._nodes: Dict[Tuple[str, str], Dict[str, Dict]] = defaultdict(dict)
+        # (src label, src identifier, relation label, dst label, dst identifier) -> (src value, dst value)
+        self._edges: Dict[Tuple[str, str, str, str, str], Dict[Tuple[str, str], None]] = defaultdict(dict)
+        self._n_pending = 0
+        self.n_nodes_written = 0
+        self.n_edges_written = 0
+
+    def add_node(self, node: Node):
+        if self._cache is not None and self._cache.get(entity_key(node)) is not None:
+            return
+        group = self._nodes[(node.label, node.identifier)]
+        if node.identifier_value not in group:
+            group[node.identifier_value] = node.properties
+            self._n_pending += 1
+            self._flush_if_full()
+
+    def add_edge(self, src: Node, relation_label: str, dst: Node):
+        self.add_node(src)
+        self.add_node(dst)
+        group = self._edges[(src.label, src.identifier, relation_label, dst.label, dst.identifier)]
+        key = (src.identifier_value, dst.identifier_value)
+        if key not in group:
+            group[key] = None
+            self._n_pending += 1
+            self._flush_if_full()
+
+    def _flush_if_full(self):
+        if self._n_pending >= self._batch_size:
+            self.flush()
+
+    @staticmethod
+    def _merge_nodes_tx(tx: Transaction, label: str, identifier: str, rows: List[Dict], update: bool = False):
+        q = f"UNWIND $rows AS r " \
+            f"MERGE (n:{label} {{{identifier}: r.identifier_value}}) " \
+            f"{'SET' if update else 'ON CREATE SET'} n += r.properties"
+        tx.run(q, rows=rows)
+
+    @staticmethod
+    def _merge_edges_tx(tx: Transaction, src_label: str, src_identifier: str, relation_label: str,
+                        dst_label: str, dst_identifier: str, rows: List[Dict]):
+        q = f"UNWIND $rows AS r " \
+            f"MATCH (a:{src_label} {{{src_identifier}: r.src}}) " \
+            f"MATCH (b:{dst_label} {{{dst_identifier}: r.dst}}) " \
+            f"MERGE (a)-[:{relation_label}]->(b)"
+        tx.run(q, rows=rows)
+
+    def _chunks(self, rows: List[Dict]):
+        for i in range(0, len(rows), self._batch_size):
+            yield rows[i: i + self._batch_size]
+
+    def flush(self):
+        """write all buffered nodes, then all buffered edges, so every edge finds both of its endpoints"""
+        if self._n_pending == 0:
+            return
+        with self._driver.session() as session:
+            for (label, identifier), group in self._nodes.items():
+                rows = [{"identifier_value": k, "properties": v} for k, v in group.items()]
+                for chunk in self._chunks(rows):
+                    with observe_write("neo4j", len(chunk)):
+                        session.write_transaction(self._merge_nodes_tx, label, identifier, chunk,
+                                                  self._update_properties)
+                self.n_nodes_written += len(rows)
+                if self._cache is not None:
+                    for k in group:
+                        self._cache.put((label, identifier, k), True)
+            for edge_type, group in self._edges.items():
+                rows = [{"src": src, "dst": dst} for src, dst in group]
+                for chunk in self._chunks(rows):
+                    with observe_write("neo4j", len(chunk)):
+                        session.write_transaction(self._merge_edges_tx, *edge_type, chunk)
+                self.n_edges_written += len(rows)
+        self._nodes.clear()
+        self._edges.clear()
+        self._n_pending = 0
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self) -> "BulkLoader":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
 class EntityExtractor:
-    def extract(self, row: Dict[str, str]):
-        pass
+    def extract(self, row: Dict[str, str]) -> Tuple[List[Node], List[Relation]]:
+        """extract all nodes of a row and the relations between them
+
+        :return: nodes and relations, a relation is a tuple of (source node, relation label, destination node)
+        """
+        book = self.extract_book(row)
+        nodes: List[Node] = [book]
+        relations: List[Relation] = list()
+
+        for relation, persons in self.extract_authors(row).items():
+            for person in persons:
+                nodes.append(person)
+                relations.append((person, relation, book))
+
+        book_series = self.extract_book_series(row)
+        if book_series is not None:
+            nodes.append(book_series)
+            relations.append((book, "IS_IN_SERIES", book_series))
+
+        publisher = self.extract_publisher(row)
+        nodes.append(publisher)
+        relations.append((publisher, "PUBLISH", book))
+
+        for topic in self.extract_topics(row):
+            nodes.append(topic)
+            relations.append((book, "HAS_TOPIC", topic))
+
+        cn_category = self.extract_cn_category(row)
+        if cn_category is not None:
+            nodes.append(cn_category)
+            relations.append((book, "IS_IN_CN_CATEGORY", cn_category))
+
+        category = self.extract_category(row)
+        if category is not None:
+            nodes.append(category)
+            relations.append((book, "IS_IN_CATEGORY", category))
+
+        return nodes, relations
 
     def extract_book(self, row: Dict[str, str]) -> Book:
         # assert row[ColumnHeader.BOOK_ID.value] == row[ColumnHeader.BOOK_ID2.value]
@@ -192,48 +347,52 @@ class EntityExtractor:
         )
 
 
-def main():
+def main(catalog: Path = Path("data/1000.csv"), bulk: bool = False, batch_size: int = 1000,
+         cache_size: int = 100_000, n_workers: Optional[int] = None):
+    """load the catalog into neo4j, either node by node and edge by edge, or in batches with a BulkLoader"""
     driver = GraphDatabase.driver("neo4j://localhost:7687", auth=("neo4j", "2much4ME"))
-
-    extractor = EntityExtractor()
-
-    with open("data/1000.csv") as f:
-        reader = csv.DictReader(f, fieldnames=[x.value for x in ColumnHeader])
-        next(reader)
-        for i, row in enumerate(reader):
-
-            book = extractor.extract_book(row)
-            book.put(driver)
-            authors = extractor.extract_authors(row)
-            for relation, persons in authors.items():
-                for person in persons:
-                    person.connect(book, driver, relation)
-
-            book_series = extractor.extract_book_series(row)
-            if book_series is not None:
-                book.connect(book_series, driver, "IS_IN_SERIES")
-
-            publisher = extractor.extract_publisher(row)
-            publisher.connect(book, driver, "PUBLISH")
-
-            topics = extractor.extract_topics(row)
-            for topic in topics:
-                book.connect(topic, driver, "HAS_TOPIC")
-
-            cn_category = extractor.extract_cn_category(row)
-            if cn_category is not None:
-                book.connect(cn_category, driver, "IS_IN_CN_CATEGORY")
-
-            category = extractor.extract_category(row)
-            if category is not None:
-                book.connect(category, driver, "IS_IN_CATEGORY")
-
-            if i % 100 == 0:
-                logger.info(f"processed {i} rows")
+    ensure_schema(driver, Node.__subclasses__())
+
+    cache = LRUCache(cache_size)
+    loader = BulkLoader(driver, batch_size, cache) if bulk else None
+    # the per row path needs Node dataclasses, batched writes only need tuple backed entities
+    extractor = EntityExtractor() if loader is None else FastEntityExtractor()
+
+    for i, (_, nodes, relations) in enumerate(extract_catalog(catalog, extractor, n_workers)):
+        if loader is None:
+            with observe_write("neo4j", 1 + len(relations)):
+                book = nodes[0]
+                book.put(driver, cache)
+                for src, relation, dst in relations:
+                    src.connect(dst, driver, relation, cache)
+        else:
+            for node in nodes:
+                loader.add_node(node)
+            for src, relation, dst in relations:
+                loader.add_edge(src, relation, dst)
+
+        if i % 100 == 0:
+            logger.info(f"processed {i} rows")
+
+    if loader is not None:
+        loader.close()
+        logger.info(f"written {loader.n_nodes_written} nodes and {loader.n_edges_written} edges")
+    # every hit is a node which was matched instead of merged, or a put which skipped the server
+    logger.info(f"entity cache: {cache}")
+    logger.info(f"stage summary: {STAGE_SECONDS.summary()}")
+    logger.info(f"write batch sizes: {WRITE_BATCH_SIZE.summary()}")
 
     driver.close()
 
 
 if __name__ == '__main__':
     logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
-    main()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--catalog", type=Path, default=Path("data/1000.csv"), help="csv file, optionally gzipped")
+    parser.add_argument("--workers", type=int, default=None, help="extraction processes, 0 to extract in process")
+    parser.add_argument("--bulk", action="store_true", help="write in batches of UNWIND ... MERGE statements")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--cache-size", type=int, default=100_000, help="entities remembered as already written")
+    args = parser.parse_args()
+    main(catalog=args.catalog, bulk=args.bulk, batch_size=args.batch_size, cache_size=args.cache_size,
+         n_workers=args.workers)
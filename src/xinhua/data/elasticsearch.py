@@ -1,9 +1,17 @@
-import csv
+import argparse
 import logging
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
 
 from elasticsearch import Elasticsearch
+from elasticsearch.helpers import streaming_bulk
 
 from . import ColumnHeader
+from .pipeline import STAGE_SECONDS, WRITE_BATCH_SIZE, iter_catalog_rows, observe_write
 
 
 logger = logging.getLogger(__name__)
@@ -25,25 +33,122 @@ def create_index():
     es.close()
 
 
-def load_books_information_to_elastic_search():
-    es = Elasticsearch()
+def book_document(row: Dict[str, str]) -> Dict[str, str]:
+    return {
+        "name": row[ColumnHeader.BOOK_NAME_STR.value],
+        "author": row[ColumnHeader.AUTHOR_STR.value],
+        "topic": row[ColumnHeader.TOPIC_STR.value],
+        "summary": row[ColumnHeader.SUMMARY.value]
+    }
+
+
+@contextmanager
+def bulk_load_settings(es: Elasticsearch, index: str = "book"):
+    """turn off refresh and replicas of the index while the block runs, and restore the previous values afterwards.
+    Values which were not set explicitly are restored to the default"""
+    keys = ["refresh_interval", "number_of_replicas"]
+    settings = es.indices.get_settings(index=index, flat_settings=True)[index]["settings"]
+    previous = {k: settings.get(f"index.{k}") for k in keys}
+    es.indices.put_settings(body={"index": {"refresh_interval": "-1", "number_of_replicas": 0}}, index=index)
+    try:
+        yield
+    finally:
+        es.indices.put_settings(body={"index": previous}, index=index)
+        es.indices.refresh(index=index)
+
+
+def index_chunk(es: Elasticsearch, actions: List[Dict], max_retries: int) -> Tuple[int, List[str]]:
+    """index a chunk with one _bulk request, documents rejected with 429 are retried with exponential backoff
+
+    :return: number of documents indexed and the ids of the documents which failed
+    """
+    n_ok, failed = 0, list()
+    with observe_write("elasticsearch", len(actions)):
+        for ok, info in streaming_bulk(es, actions, chunk_size=len(actions), max_retries=max_retries,
+                                       initial_backoff=1, max_backoff=60, raise_on_error=False):
+            if ok:
+                n_ok += 1
+            else:
+                # info is keyed by the op type, e.g. {"index": {"_id": ..., "status": 400, "error": ...}}
+                failed.append(next(iter(info.values())).get("_id"))
+                logger.warning(f"failed to index {info}")
+    return n_ok, failed
+
+
+def _chunks(actions: Iterable[Dict], chunk_size: int) -> Iterator[List[Dict]]:
+    chunk = list()
+    for action in actions:
+        chunk.append(action)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = list()
+    if len(chunk) > 0:
+        yield chunk
+
+
+def bulk_index_books(es: Elasticsearch, rows: Iterable[Dict[str, str]], chunk_size: int = 500, thread_count: int = 4,
+                     max_retries: int = 5, index: str = "book", op_type: str = "create") -> Tuple[int, int]:
+    """index books with _bulk requests of chunk_size documents, up to thread_count requests are in flight. Like
+    es.create, the default op_type fails for books which are indexed already, index overwrites them
+
+    :return: number of documents indexed and failed
+    """
+    actions = ({"_op_type": op_type, "_index": index, "_id": row[ColumnHeader.BOOK_ID.value],
+                "_source": book_document(row)}
+               for row in rows)
+    n_ok, n_failed = 0, 0
+    start = time.perf_counter()
+    with ThreadPoolExecutor(thread_count) as pool:
+        pending = deque()
+        for i, chunk in enumerate(_chunks(actions, chunk_size)):
+            pending.append(pool.submit(index_chunk, es, chunk, max_retries))
+            while len(pending) > 2 * thread_count:
+                ok, failed = pending.popleft().result()
+                n_ok, n_failed = n_ok + ok, n_failed + len(failed)
+            if i % 100 == 0:
+                logger.info(f"indexed {n_ok} documents, {n_ok / (time.perf_counter() - start):.0f} docs/s")
+        for future in pending:
+            ok, failed = future.result()
+            n_ok, n_failed = n_ok + ok, n_failed + len(failed)
+    return n_ok, n_failed
+
+
+def load_books_information_to_elastic_search(catalog: Path = Path("data/1000.csv"), hosts: Optional[List[str]] = None,
+                                             bulk: bool = False, chunk_size: int = 500, thread_count: int = 4,
+                                             max_retries: int = 5, tune_settings: bool = True):
+    """index the books of the catalog one by one, or with parallel _bulk requests if bulk is set. With tune_settings,
+    refresh and replicas are turned off during a bulk load"""
+    es = Elasticsearch(hosts, maxsize=thread_count)
 
-    with open("data/1000.csv") as f:
-        reader = csv.DictReader(f, fieldnames=[x.value for x in ColumnHeader])
-        next(reader)
-        for i, row in enumerate(reader):
-            es.create("book", row[ColumnHeader.BOOK_ID.value], body={
-                "name": row[ColumnHeader.BOOK_NAME_STR.value],
-                "author": row[ColumnHeader.AUTHOR_STR.value],
-                "topic": row[ColumnHeader.TOPIC_STR.value],
-                "summary": row[ColumnHeader.SUMMARY.value]
-            })
+    if bulk:
+        start = time.perf_counter()
+        with bulk_load_settings(es) if tune_settings else nullcontext():
+            n_ok, n_failed = bulk_index_books(es, iter_catalog_rows(catalog), chunk_size, thread_count, max_retries)
+        elapsed = time.perf_counter() - start
+        logger.info(f"indexed {n_ok} documents ({n_failed} failed) in {elapsed:.1f}s, {n_ok / elapsed:.0f} docs/s")
+    else:
+        for i, row in enumerate(iter_catalog_rows(catalog)):
+            with observe_write("elasticsearch", 1):
+                es.create("book", row[ColumnHeader.BOOK_ID.value], body=book_document(row))
 
             if i % 100 == 0:
                 logger.info(f"processed {i} rows")
+    logger.info(f"stage summary: {STAGE_SECONDS.summary()}")
+    logger.info(f"write batch sizes: {WRITE_BATCH_SIZE.summary()}")
     es.close()
 
 
 if __name__ == '__main__':
     logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
-    load_books_information_to_elastic_search()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--catalog", type=Path, default=Path("data/1000.csv"), help="csv file, optionally gzipped")
+    parser.add_argument("--hosts", nargs="*", default=None, help="default is localhost:9200")
+    parser.add_argument("--bulk", action="store_true", help="index with parallel _bulk requests")
+    parser.add_argument("--chunk-size", type=int, default=500)
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--max-retries", type=int, default=5, help="retries of documents rejected with 429")
+    parser.add_argument("--keep-settings", action="store_true",
+                        help="do not turn off refresh and replicas during a bulk load")
+    args = parser.parse_args()
+    load_books_information_to_elastic_search(args.catalog, args.hosts, args.bulk, args.chunk_size, args.threads,
+                                             args.max_retries, not args.keep_settings)
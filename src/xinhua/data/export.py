@@ -0,0 +1,171 @@
+"""export the triplets of the graph into gzip shards, partitioned by internal relationship id range.
+
+The partitions are not also split by relationship type: a per type partition needs the id bounds of that type, a
+full scan for each type, and its id seeks still visit every id of the range, whatever the type of the relationship
+behind it, so the seeks grow with the number of types times the whole id span. One partitioning of the global id
+range reads every relationship once and returns its type with it.
+"""
+import argparse
+import gzip
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+from typing import Dict, List, NamedTuple, Optional
+
+from neo4j import Driver, GraphDatabase
+
+
+logger = logging.getLogger(__name__)
+
+CHECKPOINT_FILE = "checkpoint.json"
+
+# every node is identified by its label and id, or name for the node types which have no id, like the old exporter.
+# A relationship id is looked up directly, the id seek reads no other relationship
+TRIPLET_QUERY = """
+UNWIND range($lo, $hi - 1) AS rid
+MATCH (h)-[r]->(t) WHERE id(r) = rid
+RETURN labels(h)[0] + '/' + coalesce(h.id, h.name) AS h, type(r) AS r, labels(t)[0] + '/' + coalesce(t.id, t.name) AS t
+"""
+# one pass over the relationship ids, whatever their type, no property is read
+ID_BOUND_QUERY = "MATCH ()-[r]->() RETURN max(id(r))"
+
+
+class Partition(NamedTuple):
+    """the relationships, of any type, with an internal id in [lo, hi)"""
+    lo: int
+    hi: int
+
+    @property
+    def name(self) -> str:
+        return f"{self.lo:012d}"
+
+
+def relationship_id_bound(driver: Driver) -> int:
+    """one past the highest internal relationship id, 0 for a graph without relationships"""
+    with driver.session() as session:
+        highest = session.run(ID_BOUND_QUERY).single()[0]
+    return 0 if highest is None else highest + 1
+
+
+def plan_partitions(hi: int, range_size: int = 1_000_000) -> List[Partition]:
+    """split the relationship ids [0, hi) into ranges of range_size ids"""
+    return [Partition(lo, min(lo + range_size, hi)) for lo in range(0, hi, range_size)]
+
+
+class TripletExporter:
+    """export the graph as head, relation, tail triplets for embedding training.
+
+    The relationship ids up to the highest one, found with one pass when the export starts, are split into
+    partitions of range_size ids. Each partition is read in its own session with one id seek per id, so every
+    relationship is read once whatever its type, and written to a gzip shard named after the partition. The id bound
+    and the finished partitions are recorded in a checkpoint; an interrupted export started again with the same
+    output plans the same partitions and skips the finished ones. Relationships created after the first run started
+    are not exported by a resumed one, export into a new output for a fresh snapshot.
+    """
+
+    def __init__(self, driver: Driver, output: Path, n_sessions: int = 4, range_size: int = 1_000_000,
+                 compress_level: int = 6):
+        self._driver = driver
+        self._output = output
+        self._n_sessions = n_sessions
+        self._range_size = range_size
+        self._compress_level = compress_level
+        self._lock = threading.Lock()
+        self._checkpoint = self._load_checkpoint()
+
+    def _load_checkpoint(self) -> Dict:
+        path = self._output / CHECKPOINT_FILE
+        if path.exists():
+            with path.open("r") as f:
+                return json.load(f)
+        return {"range_size": self._range_size, "hi": None, "done": dict()}
+
+    def _save_checkpoint(self):
+        tmp = self._output / f".{CHECKPOINT_FILE}"
+        with tmp.open("w") as f:
+            json.dump(self._checkpoint, f)
+        os.replace(str(tmp), str(self._output / CHECKPOINT_FILE))
+
+    def _export_partition(self, partition: Partition) -> int:
+        shard = self._output / f"{partition.name}.tsv.gz"
+        tmp = self._output / f"{partition.name}.tsv.gz.tmp"
+        n = 0
+        with self._driver.session() as session, \
+                gzip.open(str(tmp), "wt", encoding="utf-8", compresslevel=self._compress_level) as f:
+            result = session.run(TRIPLET_QUERY, lo=partition.lo, hi=partition.hi)
+            lines = list()
+            for record in result:
+                lines.append(f"{record['h']}\t{record['r']}\t{record['t']}\n")
+                if len(lines) >= 10_000:
+                    f.write("".join(lines))
+                    n += len(lines)
+                    lines = list()
+            f.write("".join(lines))
+            n += len(lines)
+        os.replace(str(tmp), str(shard))
+        with self._lock:
+            self._checkpoint["done"][partition.name] = n
+            self._save_checkpoint()
+        return n
+
+    def run(self) -> int:
+        """:return: number of triplets exported by this run"""
+        self._output.mkdir(parents=True, exist_ok=True)
+        if "hi" not in self._checkpoint:
+            raise ValueError(f"{self._output} was exported by an exporter which partitioned by relationship type, "
+                             f"use a new output")
+        if self._checkpoint["range_size"] != self._range_size:
+            raise ValueError(f"{self._output} was exported with range size {self._checkpoint['range_size']}, "
+                             f"resume with the same one or use a new output")
+        if self._checkpoint["hi"] is None:
+            self._checkpoint["hi"] = relationship_id_bound(self._driver)
+            self._save_checkpoint()
+        partitions = [x for x in plan_partitions(self._checkpoint["hi"], self._range_size)
+                      if x.name not in self._checkpoint["done"]]
+        logger.info(f"{len(partitions)} partitions to export, {len(self._checkpoint['done'])} done before")
+        start, total = time.monotonic(), 0
+        with ThreadPoolExecutor(self._n_sessions) as executor:
+            futures = {executor.submit(self._export_partition, x): x for x in partitions}
+            for i, future in enumerate(as_completed(futures)):
+                total += future.result()
+                logger.info(f"{futures[future].name} done, {i + 1}/{len(partitions)} partitions, {total} triplets, "
+                            f"{total / (time.monotonic() - start):.0f} triplets/s")
+        return total
+
+
+def merge_shards(output: Path, merged: Path):
+    """concatenate the shards into one plain text file in partition order, the format dglke reads"""
+    with merged.open("wb") as f:
+        for shard in sorted(output.glob("*.tsv.gz")):
+            with gzip.open(str(shard), "rb") as g:
+                shutil.copyfileobj(g, f)
+    logger.info(f"shards of {output} merged into {merged}")
+
+
+def main(output: Path, n_sessions: int, range_size: int, merge: Optional[Path] = None):
+    driver = GraphDatabase.driver("neo4j://localhost:7687", auth=("neo4j", "2much4ME"))
+    n = TripletExporter(driver, output, n_sessions, range_size).run()
+    driver.close()
+    logger.info(f"{n} triplets exported to {output}")
+    if merge is not None:
+        merge_shards(output, merge)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    parser = argparse.ArgumentParser(description="export all triplets of the graph into gzip shards, run it again "
+                                                 "with the same output to resume. Partitions are ranges of internal "
+                                                 "relationship ids of every type, they are not split by relationship "
+                                                 "type, which would seek every id once per type")
+    parser.add_argument("--output", type=Path, default=Path("data/triplets"))
+    parser.add_argument("--sessions", type=int, default=4, help="partitions exported in parallel")
+    parser.add_argument("--range-size", type=int, default=1_000_000, help="relationship ids per partition")
+    parser.add_argument("--merge", type=Path, default=None, help="also concatenate the shards into this file, "
+                                                                 "e.g. data/triplets.txt")
+    args = parser.parse_args()
+    main(args.output, args.sessions, args.range_size, args.merge)
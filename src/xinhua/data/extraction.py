@@ -0,0 +1,144 @@
+import logging
+import re
+import sys
+from typing import Any, Dict, List, NamedTuple, Tuple
+
+from . import ColumnHeader
+
+
+logger = logging.getLogger(__name__)
+
+BOOK_ID = ColumnHeader.BOOK_ID.value
+BOOK_NAME_STR = ColumnHeader.BOOK_NAME_STR.value
+AUTHOR_STR = ColumnHeader.AUTHOR_STR.value
+PUBLISHER_ID = ColumnHeader.PUBLISHER_ID.value
+PUBLISHER_NAME = ColumnHeader.PUBLISHER_NAME.value
+TOPIC_STR = ColumnHeader.TOPIC_STR.value
+CN_CATEGORY = ColumnHeader.CN_CATEGORY.value
+CATEGORY3_ID = ColumnHeader.CATEGORY3_ID.value
+CATEGORY3_NAME = ColumnHeader.CATEGORY3_NAME.value
+
+AUTHOR_PATTERN = re.compile(r"(?P<relation>.+):(?P<person_str>.+)")
+PERSON_PATTERN = re.compile(r"\((?P<country>.+)\)(?P<name>.+)")
+TOPIC_PATTERN = re.compile(r"[0-9]?(?P<topic_name>[^0-9].*)")
+
+WRITE = sys.intern("WRITE")
+IS_IN_SERIES = sys.intern("IS_IN_SERIES")
+PUBLISH = sys.intern("PUBLISH")
+HAS_TOPIC = sys.intern("HAS_TOPIC")
+IS_IN_CN_CATEGORY = sys.intern("IS_IN_CN_CATEGORY")
+IS_IN_CATEGORY = sys.intern("IS_IN_CATEGORY")
+
+
+class Entity(NamedTuple):
+    """a tuple backed graph node, it has the label, identifier, identifier_value and properties of a Node of cql.py
+    and gremlin.py, so loaders accept both"""
+    label: str
+    identifier: str
+    identifier_value: str
+    attributes: Tuple[Tuple[str, Any], ...] = ()
+
+    @property
+    def properties(self) -> Dict:
+        d = {self.identifier: self.identifier_value}
+        for k, v in self.attributes:
+            if v is not None:
+                d[k] = v
+        return d
+
+
+Relation = Tuple[Entity, str, Entity]
+
+# skips the python level __new__ of the named tuple
+_new_entity = tuple.__new__
+
+
+class FastEntityExtractor:
+    """produces the same nodes and relations as EntityExtractor.extract, with precompiled patterns, tuple backed
+    entities and interned names and relation labels. Interned strings are forgotten after max_interned of them"""
+
+    def __init__(self, max_interned: int = 1_000_000):
+        self._max_interned = max_interned
+        self._strings: Dict[str, str] = dict()
+
+    def extract(self, row: Dict[str, str]) -> Tuple[List[Entity], List[Relation]]:
+        """extract all nodes of a row and the relations between them
+
+        :return: nodes and relations, a relation is a tuple of (source node, relation label, destination node)
+        """
+        if len(self._strings) >= self._max_interned:
+            self._strings.clear()
+        intern = self._strings.setdefault
+        book_name_words = row[BOOK_NAME_STR].split("/")
+        book = _new_entity(Entity, ("Book", "id", row[BOOK_ID], (("name", book_name_words[0]),)))
+        nodes = [book]
+        relations = list()
+
+        for relation, persons in self._extract_authors(row[AUTHOR_STR]).items():
+            for person in persons:
+                nodes.append(person)
+                relations.append((person, relation, book))
+
+        if len(book_name_words) > 1:
+            book_series_name = "/".join(book_name_words[1:])
+            book_series = _new_entity(Entity, ("BookSeries", "name", intern(book_series_name, book_series_name), ()))
+            nodes.append(book_series)
+            relations.append((book, IS_IN_SERIES, book_series))
+
+        publisher_id, publisher_name = row[PUBLISHER_ID], row[PUBLISHER_NAME]
+        publisher = _new_entity(Entity, ("Publisher", "id", intern(publisher_id, publisher_id),
+                                         (("name", intern(publisher_name, publisher_name)),)))
+        nodes.append(publisher)
+        relations.append((publisher, PUBLISH, book))
+
+        topic_str = row[TOPIC_STR]
+        if topic_str != "":
+            topic_names = set()
+            for word in topic_str.split("//"):
+                m = TOPIC_PATTERN.match(word)
+                if m is None:
+                    logger.warning(f"cannot process {word}")
+                else:
+                    topic_names.add(m.group("topic_name"))
+            for topic_name in topic_names:
+                topic = _new_entity(Entity, ("Topic", "name", intern(topic_name, topic_name), ()))
+                nodes.append(topic)
+                relations.append((book, HAS_TOPIC, topic))
+
+        cn_category_id = row[CN_CATEGORY]
+        if cn_category_id != "":
+            cn_category = _new_entity(Entity, ("CNCategory", "id", intern(cn_category_id, cn_category_id), ()))
+            nodes.append(cn_category)
+            relations.append((book, IS_IN_CN_CATEGORY, cn_category))
+
+        category_id, category_name = row[CATEGORY3_ID], row[CATEGORY3_NAME]
+        category = _new_entity(Entity, ("Category", "id", intern(category_id, category_id),
+                                        (("name", intern(category_name, category_name)), ("level", 3))))
+        nodes.append(category)
+        relations.append((book, IS_IN_CATEGORY, category))
+
+        return nodes, relations
+
+    def _extract_authors(self, author_str: str) -> Dict[str, List[Entity]]:
+        d = dict()
+        for word in author_str.split("|"):
+            m = AUTHOR_PATTERN.match(word) if ":" in word else None
+            if m is not None:
+                relation = m.group("relation")
+                d[self._strings.setdefault(relation, relation)] = self._extract_persons(m.group("person_str"))
+            else:
+                d[WRITE] = self._extract_persons(word)
+        return d
+
+    def _extract_persons(self, s: str) -> List[Entity]:
+        intern = self._strings.setdefault
+        persons = list()
+        for word in s.split("//"):
+            m = PERSON_PATTERN.match(word) if word.startswith("(") else None
+            if m is not None:
+                name, country = m.group("name", "country")
+                persons.append(_new_entity(Entity, ("Person", "name", intern(name, name),
+                                                    (("country", intern(country, country)),))))
+            else:
+                persons.append(_new_entity(Entity, ("Person", "name", intern(word, word), (("country", None),))))
+        return persons
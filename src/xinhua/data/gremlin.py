@@ -1,18 +1,26 @@
-import csv
+import argparse
 import logging
+import random
+import time
 from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor, wait
 from dataclasses import dataclass
 from enum import Enum
-from typing import List, Dict, Optional, Tuple
+from pathlib import Path
+from typing import Callable, List, Dict, Optional, Tuple
 import re
 
 from gremlin_python.driver.driver_remote_connection import DriverRemoteConnection
+from gremlin_python.driver.protocol import GremlinServerError
 from gremlin_python.process.anonymous_traversal import traversal
-from gremlin_python.process.graph_traversal import GraphTraversalSource
+from gremlin_python.process.graph_traversal import GraphTraversal, GraphTraversalSource, __
 from gremlin_python.process.traversal import Cardinality
 from gremlin_python.structure.graph import Vertex, Edge
 
 from . import ColumnHeader
+from .extraction import FastEntityExtractor
+from .pipeline import STAGE_SECONDS, WRITE_BATCH_SIZE, extract_catalog, observe_write
+from ..cache import LRUCache, entity_key
 
 
 logger = logging.getLogger(__name__)
@@ -25,36 +33,47 @@ class Node:
     def label(self) -> str:
         return self.__class__.__name__
 
-    def put(self, g: GraphTraversalSource) -> Vertex:
+    def put(self, g: GraphTraversalSource, cache: Optional[LRUCache] = None) -> Vertex:
         """add the node to gremlin server and return the vertex created; or return the vertex directly if the node
-        already exists. Existence of a node is decided by node id if this property exists, otherwise by name"""
+        already exists. Existence of a node is decided by node id if this property exists, otherwise by name.
+        Vertices found in cache are returned without a server round trip"""
+        if cache is not None:
+            v = cache.get(entity_key(self))
+            if v is not None:
+                return v
         try:
-            v = g.V().has(self.label, self.identifier, getattr(self, self.identifier)).next()
+            v = g.V().has(self.label, self.identifier, self.identifier_value).next()
         except StopIteration:
-            return self._add(g)
-        else:
-            return v
+            v = self._add(g)
+        if cache is not None:
+            cache.put(entity_key(self), v)
+        return v
 
     def _add(self, g: GraphTraversalSource) -> Vertex:
-        t = g.addV(self.label)
-        for k, v in self.__dict__.items():
-            if v is not None:
-                t = t.property(Cardinality.single, k, v)
-        return t.next()
+        return _with_properties(g.addV(self.label), self).next()
 
     @property
     def identifier(self):
         return "id" if "id" in self.__dict__ else "name"
 
-    def connect(self, dst: "Node", g: GraphTraversalSource, relation_label: str) -> Edge:
+    @property
+    def identifier_value(self) -> str:
+        return getattr(self, self.identifier)
+
+    @property
+    def properties(self) -> Dict:
+        return {k: v for k, v in self.__dict__.items() if v is not None}
+
+    def connect(self, dst: "Node", g: GraphTraversalSource, relation_label: str,
+                cache: Optional[LRUCache] = None) -> Edge:
         """create an edge from self node to dst node if it does not exist.
         :return: created edge or existed edge
         """
-        src_v = self.put(g)
-        dst_v = dst.put(g)
+        src_v = self.put(g, cache)
+        dst_v = dst.put(g, cache)
         try:
-            edge = g.V(src_v).outE(relation_label).outV().has(dst.label, dst.identifier, getattr(dst, dst.identifier))\
-                .next()
+            edge = g.V(src_v).outE(relation_label)\
+                .where(__.inV().has(dst.label, dst.identifier, dst.identifier_value)).next()
         except StopIteration:
             edge = g.addE(relation_label).from_(src_v).to(dst_v).next()
             return edge
@@ -62,6 +81,123 @@ class Node:
             return edge
 
 
+def _with_properties(t: GraphTraversal, node: Node) -> GraphTraversal:
+    for k, v in node.properties.items():
+        t = t.property(Cardinality.single, k, v)
+    return t
+
+
+Relation = Tuple[Node, str, Node]
+
+
+class BatchWriter:
+    """upsert vertices and edges in batches. Every request is one traversal that chains get-or-create
+    (fold/coalesce) steps for a whole batch, each in its own sideEffect, up to max_in_flight requests are sent
+    concurrently and requests failing with ConcurrentModificationException are retried with exponential backoff.
+
+    Buffered vertices are always written before the buffered edges, so the edge traversals can look their endpoints up.
+    The connection behind g should have a pool of at least max_in_flight connections.
+    """
+
+    def __init__(self, g: GraphTraversalSource, batch_size: int = 100, max_in_flight: int = 8,
+                 max_retries: int = 5, cache: Optional[LRUCache] = None):
+        self._g = g
+        self._batch_size = batch_size
+        self._max_in_flight = max_in_flight
+        self._max_retries = max_retries
+        # remembers vertices written by this writer, the values are not vertex handles
+        self._cache = cache
+        self._executor = ThreadPoolExecutor(max_in_flight)
+        self._vertices: Dict[Tuple, Node] = dict()
+        self._edges: Dict[Tuple, Relation] = dict()
+        self.n_vertices_written = 0
+        self.n_edges_written = 0
+        self.n_retries = 0
+
+    def add_vertex(self, node: Node):
+        key = entity_key(node)
+        if key in self._vertices or (self._cache is not None and self._cache.get(key) is not None):
+            return
+        self._vertices[key] = node
+        self._flush_if_full()
+
+    def add_edge(self, src: Node, relation_label: str, dst: Node):
+        self.add_vertex(src)
+        self.add_vertex(dst)
+        key = (entity_key(src), relation_label, entity_key(dst))
+        if key not in self._edges:
+            self._edges[key] = (src, relation_label, dst)
+            self._flush_if_full()
+
+    def _flush_if_full(self):
+        if len(self._vertices) + len(self._edges) >= self._batch_size * self._max_in_flight:
+            self.flush()
+
+    # every upsert runs in its own sideEffect on a single injected traverser, so an upsert which yields no traverser,
+    # e.g. an edge with a missing endpoint, or several, e.g. a duplicated vertex, does not change what the following
+    # upserts of the batch run on
+    def _upsert_vertices(self, nodes: List[Node]) -> GraphTraversal:
+        t = self._g.inject(0)
+        for node in nodes:
+            t = t.sideEffect(__.V().has(node.label, node.identifier, node.identifier_value).fold()
+                             .coalesce(__.unfold(), _with_properties(__.addV(node.label), node)))
+        return t
+
+    def _upsert_edges(self, relations: List[Relation]) -> GraphTraversal:
+        t = self._g.inject(0)
+        for src, relation_label, dst in relations:
+            t = t.sideEffect(__.V().has(src.label, src.identifier, src.identifier_value).as_("src")
+                             .V().has(dst.label, dst.identifier, dst.identifier_value)
+                             .coalesce(__.inE(relation_label).where(__.outV().as_("src")),
+                                       __.addE(relation_label).from_("src")))
+        return t
+
+    def _send(self, build: Callable[[List], GraphTraversal], items: List):
+        with observe_write("gremlin", len(items)):
+            self._send_with_retries(build, items)
+
+    def _send_with_retries(self, build: Callable[[List], GraphTraversal], items: List):
+        for attempt in range(self._max_retries + 1):
+            try:
+                build(items).iterate()
+                return
+            except GremlinServerError as e:
+                if "ConcurrentModificationException" not in str(e) or attempt == self._max_retries:
+                    raise e
+                self.n_retries += 1
+                time.sleep(min(0.1 * 2 ** attempt, 5.) * random.uniform(0.5, 1.))
+
+    def _send_all(self, build: Callable[[List], GraphTraversal], items: List):
+        futures = [self._executor.submit(self._send, build, items[i: i + self._batch_size])
+                   for i in range(0, len(items), self._batch_size)]
+        wait(futures)
+        for future in futures:
+            future.result()
+
+    def flush(self):
+        if len(self._vertices) > 0:
+            self._send_all(self._upsert_vertices, list(self._vertices.values()))
+            self.n_vertices_written += len(self._vertices)
+            if self._cache is not None:
+                for key in self._vertices:
+                    self._cache.put(key, True)
+            self._vertices.clear()
+        if len(self._edges) > 0:
+            self._send_all(self._upsert_edges, list(self._edges.values()))
+            self.n_edges_written += len(self._edges)
+            self._edges.clear()
+
+    def close(self):
+        self.flush()
+        self._executor.shutdown()
+
+    def __enter__(self) -> "BatchWriter":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
 @dataclass
 class Person(Node):
     name: str
@@ -105,8 +241,44 @@ class Book(Node):
 
 
 class EntityExtractor:
-    def extract(self, row: Dict[str, str]):
-        pass
+    def extract(self, row: Dict[str, str]) -> Tuple[List[Node], List[Relation]]:
+        """extract all nodes of a row and the relations between them
+
+        :return: nodes and relations, a relation is a tuple of (source node, relation label, destination node)
+        """
+        book = self.extract_book(row)
+        nodes: List[Node] = [book]
+        relations: List[Relation] = list()
+
+        for relation, persons in self.extract_authors(row).items():
+            for person in persons:
+                nodes.append(person)
+                relations.append((person, relation, book))
+
+        book_series = self.extract_book_series(row)
+        if book_series is not None:
+            nodes.append(book_series)
+            relations.append((book, "IS_IN_SERIES", book_series))
+
+        publisher = self.extract_publisher(row)
+        nodes.append(publisher)
+        relations.append((publisher, "PUBLISH", book))
+
+        for topic in self.extract_topics(row):
+            nodes.append(topic)
+            relations.append((book, "HAS_TOPIC", topic))
+
+        cn_category = self.extract_cn_category(row)
+        if cn_category is not None:
+            nodes.append(cn_category)
+            relations.append((book, "IS_IN_CN_CATEGORY", cn_category))
+
+        category = self.extract_category(row)
+        if category is not None:
+            nodes.append(category)
+            relations.append((book, "IS_IN_CATEGORY", category))
+
+        return nodes, relations
 
     def extract_book(self, row: Dict[str, str]) -> Book:
         # assert row[ColumnHeader.BOOK_ID.value] == row[ColumnHeader.BOOK_ID2.value]
@@ -184,50 +356,56 @@ class EntityExtractor:
         )
 
 
-def main():
-    conn = DriverRemoteConnection(
-        "wss://liuxuefe-xinhua.cluster-cnmovwdys94f.us-east-1.neptune.amazonaws.com:8182/gremlin", "g")
-    g = traversal().withRemote(conn)
-
-    extractor = EntityExtractor()
-
-    with open("data/1000.csv") as f:
-        reader = csv.DictReader(f, fieldnames=[x.value for x in ColumnHeader])
-        next(reader)
-        for i, row in enumerate(reader):
+NEPTUNE_URL = "wss://liuxuefe-xinhua.cluster-cnmovwdys94f.us-east-1.neptune.amazonaws.com:8182/gremlin"
 
-            book = extractor.extract_book(row)
-            book.put(g)
-            authors = extractor.extract_authors(row)
-            for relation, persons in authors.items():
-                for person in persons:
-                    person.connect(book, g, relation)
 
-            book_series = extractor.extract_book_series(row)
-            if book_series is not None:
-                book.connect(book_series, g, "IS_IN_SERIES")
-
-            publisher = extractor.extract_publisher(row)
-            publisher.connect(book, g, "PUBLISH")
-
-            topics = extractor.extract_topics(row)
-            for topic in topics:
-                book.connect(topic, g, "HAS_TOPIC")
-
-            cn_category = extractor.extract_cn_category(row)
-            if cn_category is not None:
-                book.connect(cn_category, g, "IS_IN_CN_CATEGORY")
-
-            category = extractor.extract_category(row)
-            if category is not None:
-                book.connect(category, g, "IS_IN_CATEGORY")
-
-            if i % 100 == 0:
-                logger.info(f"processed {i} rows")
+def main(catalog: Path = Path("data/1000.csv"), url: str = NEPTUNE_URL, batch: bool = False, batch_size: int = 100,
+         max_in_flight: int = 8, n_workers: Optional[int] = None):
+    """load the catalog into a gremlin server, either vertex by vertex and edge by edge, or with a BatchWriter. Use
+    ws://localhost:8182/gremlin as url to load into a local Gremlin Server / TinkerGraph"""
+    conn = DriverRemoteConnection(url, "g", pool_size=max_in_flight if batch else None)
+    g = traversal().withRemote(conn)
 
+    cache = LRUCache()
+    writer = BatchWriter(g, batch_size, max_in_flight, cache=cache) if batch else None
+    # the per row path needs Node dataclasses, batched writes only need tuple backed entities
+    extractor = EntityExtractor() if writer is None else FastEntityExtractor()
+
+    for i, (_, nodes, relations) in enumerate(extract_catalog(catalog, extractor, n_workers)):
+        if writer is None:
+            with observe_write("gremlin", 1 + len(relations)):
+                book = nodes[0]
+                book.put(g, cache)
+                for src, relation, dst in relations:
+                    src.connect(dst, g, relation, cache)
+        else:
+            for node in nodes:
+                writer.add_vertex(node)
+            for src, relation, dst in relations:
+                writer.add_edge(src, relation, dst)
+
+        if i % 100 == 0:
+            logger.info(f"processed {i} rows")
+
+    if writer is not None:
+        writer.close()
+        logger.info(f"written {writer.n_vertices_written} vertices and {writer.n_edges_written} edges, "
+                    f"{writer.n_retries} retries")
+    logger.info(f"entity cache: {cache}")
+    logger.info(f"stage summary: {STAGE_SECONDS.summary()}")
+    logger.info(f"write batch sizes: {WRITE_BATCH_SIZE.summary()}")
     conn.close()
 
 
 if __name__ == '__main__':
     logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
-    main()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--catalog", type=Path, default=Path("data/1000.csv"), help="csv file, optionally gzipped")
+    parser.add_argument("--workers", type=int, default=None, help="extraction processes, 0 to extract in process")
+    parser.add_argument("--url", default=NEPTUNE_URL)
+    parser.add_argument("--batch", action="store_true", help="upsert many vertices and edges per request")
+    parser.add_argument("--batch-size", type=int, default=100)
+    parser.add_argument("--max-in-flight", type=int, default=8)
+    args = parser.parse_args()
+    main(catalog=args.catalog, url=args.url, batch=args.batch, batch_size=args.batch_size,
+         max_in_flight=args.max_in_flight, n_workers=args.workers)
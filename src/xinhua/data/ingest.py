@@ -0,0 +1,438 @@
+import argparse
+import logging
+import queue
+import threading
+import time
+from abc import ABC, abstractmethod
+from contextlib import ExitStack
+from pathlib import Path
+from typing import Dict, List, Optional, Set, Tuple
+
+from elasticsearch import Elasticsearch
+from gremlin_python.driver.driver_remote_connection import DriverRemoteConnection
+from gremlin_python.process.anonymous_traversal import traversal
+from neo4j import Driver, GraphDatabase
+
+from . import ColumnHeader
+from .bulk_import import BulkImportGenerator
+from .checkpoint import CheckpointStore, row_hash
+from .cql import BulkLoader, Node
+from .elasticsearch import book_document, bulk_load_settings, index_chunk
+from .extraction import FastEntityExtractor
+from .gremlin import BatchWriter
+from .pipeline import STAGE_SECONDS, WRITE_BATCH_SIZE, ExtractedRow, extract_catalog
+from .schema import ensure_schema
+from ..cache import LRUCache
+from ..metrics import REGISTRY, SIZE_BUCKETS
+
+
+logger = logging.getLogger(__name__)
+
+SINK_WRITE_SECONDS = REGISTRY.histogram("xinhua_ingest_sink_write_seconds", "seconds a sink takes to write one batch",
+                                        ["sink"])
+SINK_BATCH_ROWS = REGISTRY.histogram("xinhua_ingest_sink_batch_rows", "rows per batch written to a sink", ["sink"],
+                                     SIZE_BUCKETS)
+ROWS = REGISTRY.counter("xinhua_ingest_rows_total", "catalog rows extracted, written or skipped as unchanged",
+                        ["outcome"])
+
+
+class Sink(ABC):
+    """a destination of extracted catalog rows. write is called with batches of rows from n_threads threads at once,
+    a sink which is not thread safe keeps n_threads at 1"""
+    name = "sink"
+    n_threads = 1
+    # whether write needs ExtractedRow.row, the parsed csv row, besides the nodes and relations
+    needs_rows = False
+
+    @abstractmethod
+    def write(self, batch: List[ExtractedRow]):
+        pass
+
+    def flush(self):
+        """make everything written so far durable, called while no write runs"""
+
+    def pop_failed(self) -> Set[str]:
+        """book ids of the rows given to write since the last call which were dropped instead of written, called after
+        flush. Their hashes are not committed to the checkpoint, so the next run writes them again"""
+        return set()
+
+    def close(self):
+        """flush what is buffered, called once after the last write"""
+        self.flush()
+
+    def summary(self) -> Dict:
+        return dict()
+
+
+class Neo4jSink(Sink):
+    name = "neo4j"
+
+    def __init__(self, driver: Driver, batch_size: int = 1000, cache_size: int = 100_000,
+                 update_properties: bool = False):
+        ensure_schema(driver, Node.__subclasses__())
+        self._loader = BulkLoader(driver, batch_size, LRUCache(cache_size), update_properties)
+
+    def write(self, batch: List[ExtractedRow]):
+        for _, nodes, relations in batch:
+            for node in nodes:
+                self._loader.add_node(node)
+            for src, relation, dst in relations:
+                self._loader.add_edge(src, relation, dst)
+
+    def flush(self):
+        self._loader.flush()
+
+    def close(self):
+        self._loader.close()
+
+    def summary(self) -> Dict:
+        return {"nodes": self._loader.n_nodes_written, "edges": self._loader.n_edges_written}
+
+
+class GremlinSink(Sink):
+    name = "gremlin"
+
+    def __init__(self, g, batch_size: int = 100, max_in_flight: int = 8, cache_size: int = 100_000):
+        self._writer = BatchWriter(g, batch_size, max_in_flight, cache=LRUCache(cache_size))
+
+    def write(self, batch: List[ExtractedRow]):
+        for _, nodes, relations in batch:
+            for node in nodes:
+                self._writer.add_vertex(node)
+            for src, relation, dst in relations:
+                self._writer.add_edge(src, relation, dst)
+
+    def flush(self):
+        self._writer.flush()
+
+    def close(self):
+        self._writer.close()
+
+    def summary(self) -> Dict:
+        return {"vertices": self._writer.n_vertices_written, "edges": self._writer.n_edges_written,
+                "retries": self._writer.n_retries}
+
+
+class ElasticsearchSink(Sink):
+    """one _bulk request per batch, from n_threads threads. With tune_settings, refresh and replicas of the index are
+    turned off until close"""
+    name = "elasticsearch"
+    needs_rows = True
+
+    def __init__(self, es: Elasticsearch, n_threads: int = 4, max_retries: int = 5, index: str = "book",
+                 tune_settings: bool = True):
+        self._es = es
+        self.n_threads = n_threads
+        self._max_retries = max_retries
+        self._index = index
+        self._settings = ExitStack()
+        if tune_settings:
+            self._settings.enter_context(bulk_load_settings(es, index))
+        self._lock = threading.Lock()
+        self._failed: Set[str] = set()
+        self.n_ok = 0
+        self.n_failed = 0
+
+    def write(self, batch: List[ExtractedRow]):
+        # index, not create, a changed row of a checkpointed run overwrites the document of the previous run
+        actions = [{"_op_type": "index", "_index": self._index, "_id": x.row[ColumnHeader.BOOK_ID.value],
+                    "_source": book_document(x.row)}
+                   for x in batch]
+        ok, failed = index_chunk(self._es, actions, self._max_retries)
+        with self._lock:
+            self.n_ok, self.n_failed = self.n_ok + ok, self.n_failed + len(failed)
+            self._failed.update(failed)
+
+    def pop_failed(self) -> Set[str]:
+        with self._lock:
+            failed, self._failed = self._failed, set()
+        return failed
+
+    def close(self):
+        self._settings.close()
+
+    def summary(self) -> Dict:
+        return {"indexed": self.n_ok, "failed": self.n_failed}
+
+
+class BulkImportSink(Sink):
+    """the import files are only complete for a run over the whole catalog, do not combine it with a checkpoint"""
+    name = "bulk_import"
+
+    def __init__(self, generator: BulkImportGenerator):
+        self._generator = generator
+        self.arguments: List[str] = list()
+
+    def write(self, batch: List[ExtractedRow]):
+        for _, nodes, relations in batch:
+            self._generator.add(nodes, relations)
+
+    def close(self):
+        self.arguments = self._generator.close()
+
+    def summary(self) -> Dict:
+        return {"neo4j_admin_arguments": " ".join(self.arguments)}
+
+
+class SinkRunner:
+    """feeds one sink from a bounded queue of batches, drained by sink.n_threads threads. put blocks while the queue is
+    full, so a sink which falls behind slows the producer down instead of buffering without bound; the other sinks
+    keep draining their own queues meanwhile"""
+
+    def __init__(self, sink: Sink, batch_size: int = 500, queue_size: int = 8):
+        self.sink = sink
+        self._batch_size = batch_size
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._batch: List[ExtractedRow] = list()
+        self._error: Optional[BaseException] = None
+        self._lock = threading.Lock()
+        self.n_rows = 0
+        self.n_batches = 0
+        self.write_seconds = 0.
+        self.blocked_seconds = 0.
+        self._start = time.monotonic()
+        self._threads = [threading.Thread(target=self._work, name=f"sink-{sink.name}-{i}", daemon=True)
+                         for i in range(sink.n_threads)]
+        for thread in self._threads:
+            thread.start()
+
+    def _work(self):
+        while True:
+            batch = self._queue.get()
+            try:
+                if batch is None:
+                    return
+                # after an error the queue is still drained so the producer is not blocked, it raises on its next put
+                if self._error is None:
+                    self._write(batch)
+            finally:
+                self._queue.task_done()
+
+    def _write(self, batch: List[ExtractedRow]):
+        start = time.monotonic()
+        try:
+            self.sink.write(batch)
+        except BaseException as e:
+            logger.exception(f"sink {self.sink.name} failed")
+            self._error = e
+            return
+        seconds = time.monotonic() - start
+        SINK_WRITE_SECONDS.observe(seconds, sink=self.sink.name)
+        SINK_BATCH_ROWS.observe(len(batch), sink=self.sink.name)
+        with self._lock:
+            self.write_seconds += seconds
+            self.n_rows += len(batch)
+            self.n_batches += 1
+
+    def _raise_error(self):
+        if self._error is not None:
+            raise RuntimeError(f"sink {self.sink.name} failed") from self._error
+
+    def _enqueue(self, batch: List[ExtractedRow]):
+        start = time.monotonic()
+        self._queue.put(batch)
+        self.blocked_seconds += time.monotonic() - start
+
+    def put(self, row: ExtractedRow):
+        self._raise_error()
+        self._batch.append(row)
+        if len(self._batch) >= self._batch_size:
+            self._enqueue(self._batch)
+            self._batch = list()
+
+    def drain(self):
+        """wait until every row put so far is written and flush the sink"""
+        if len(self._batch) > 0:
+            self._enqueue(self._batch)
+            self._batch = list()
+        self._queue.join()
+        self._raise_error()
+        self.sink.flush()
+
+    def close(self) -> Dict:
+        """drain the queue, close the sink and return its throughput. A sink which failed is closed too, e.g. to restore
+        the index settings, before its error is raised"""
+        if len(self._batch) > 0:
+            self._enqueue(self._batch)
+            self._batch = list()
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        if self._error is not None:
+            try:
+                self.sink.close()
+            except Exception:
+                logger.exception(f"closing sink {self.sink.name} after its failure failed")
+            self._raise_error()
+        start = time.monotonic()
+        self.sink.close()
+        close_seconds = time.monotonic() - start
+        elapsed = time.monotonic() - self._start
+        return {
+            "sink": self.sink.name,
+            "rows": self.n_rows,
+            "batches": self.n_batches,
+            "seconds": round(elapsed, 1),
+            "rows_per_second": round(self.n_rows / elapsed, 1) if elapsed > 0 else None,
+            "write_seconds": round(self.write_seconds, 1),
+            "batch_write_p50_seconds": SINK_WRITE_SECONDS.quantile(.5, sink=self.sink.name),
+            "batch_write_p99_seconds": SINK_WRITE_SECONDS.quantile(.99, sink=self.sink.name),
+            "close_seconds": round(close_seconds, 1),
+            # time the producer waited for this sink, the sink which dominates it sets the pace of the ingestion
+            "backpressure_seconds": round(self.blocked_seconds, 1),
+            **self.sink.summary()
+        }
+
+
+def close_runners(runners: List[SinkRunner]) -> List[Dict]:
+    """close every runner, also after one of them raised, and raise the first error once all are closed
+
+    :return: the throughput summary of every sink
+    """
+    summaries, error = list(), None
+    for runner in runners:
+        try:
+            summaries.append(runner.close())
+        except BaseException as e:
+            logger.exception(f"closing sink {runner.sink.name} failed")
+            error = e if error is None else error
+    if error is not None:
+        raise error
+    return summaries
+
+
+def written_hashes(pending: List[Tuple[str, str, bytes]], sinks: List[Sink]) -> List[Tuple[str, str, bytes]]:
+    """the sink, book id and hash of the rows put since the last commit, without the rows a sink dropped"""
+    failed = {x.name: x.pop_failed() for x in sinks}
+    return [x for x in pending if x[1] not in failed[x[0]]]
+
+
+def ingest(catalog: Path, sinks: List[Sink], n_workers: Optional[int] = None, batch_size: int = 500,
+           queue_size: int = 8, checkpoint: Optional[CheckpointStore] = None,
+           commit_every: int = 50_000) -> List[Dict]:
+    """parse and extract every catalog row once and fan the results out to all sinks.
+
+    With a checkpoint, a row is only put to the sinks it was not written to with the same content hash, and every
+    commit_every rows the sinks are drained and flushed and the progress is committed; a run interrupted after that
+    resumes from the last commit instead of the first row.
+
+    :return: the throughput summary of every sink
+    """
+    keep_rows = checkpoint is not None or any(x.needs_rows for x in sinks)
+    start_row = checkpoint.resume_offset(catalog) if checkpoint is not None else 0
+    if start_row > 0:
+        logger.info(f"resuming {catalog} after row {start_row}")
+    runners = [SinkRunner(x, batch_size, queue_size) for x in sinks]
+    # sink, book id and hash of the rows put since the last commit
+    pending: List[Tuple[str, str, bytes]] = list()
+    n_rows, n_skipped = start_row, 0
+    start = time.monotonic()
+    try:
+        for extracted in extract_catalog(catalog, FastEntityExtractor(), n_workers, keep_rows=keep_rows,
+                                         start_row=start_row):
+            n_rows += 1
+            if checkpoint is not None:
+                digest = row_hash(extracted.row)
+                unchanged = checkpoint.unchanged_sinks(extracted.row, digest)
+                changed = [x for x in runners if x.sink.name not in unchanged]
+                if len(changed) == 0:
+                    n_skipped += 1
+                for runner in changed:
+                    runner.put(extracted)
+                    pending.append((runner.sink.name, extracted.row[ColumnHeader.BOOK_ID.value], digest))
+                if n_rows % commit_every == 0:
+                    for runner in runners:
+                        runner.drain()
+                    checkpoint.commit(catalog, n_rows, written_hashes(pending, sinks))
+                    pending = list()
+            else:
+                for runner in runners:
+                    runner.put(extracted)
+            if n_rows % 100_000 == 0:
+                logger.info(f"extracted {n_rows} rows, {n_skipped} unchanged, "
+                            f"{(n_rows - start_row) / (time.monotonic() - start):.0f} rows/s")
+    except BaseException:
+        # every sink is still closed, its threads stopped and e.g. the index settings restored, the error of the
+        # extraction or of the sink which failed first is the one raised
+        try:
+            close_runners(runners)
+        except BaseException:
+            pass
+        raise
+    summaries = close_runners(runners)
+    ROWS.inc(n_rows - start_row - n_skipped, outcome="written")
+    ROWS.inc(n_skipped, outcome="skipped")
+    if checkpoint is not None:
+        checkpoint.commit(catalog, n_rows, written_hashes(pending, sinks))
+        checkpoint.complete(catalog)
+        logger.info(f"{n_rows - start_row - n_skipped} new or changed rows written, {n_skipped} unchanged rows skipped")
+    for summary in summaries:
+        logger.info(f"sink summary: {summary}")
+    # seconds per chunk of rows, the parse and extract stages feed every sink
+    logger.info(f"stage summary: {STAGE_SECONDS.summary()}")
+    logger.info(f"write batch sizes: {WRITE_BATCH_SIZE.summary()}")
+    return summaries
+
+
+def main(catalog: Path, neo4j_url: Optional[str], gremlin_url: Optional[str], es_hosts: Optional[List[str]],
+         bulk_import_output: Optional[Path], n_workers: Optional[int], batch_size: int, queue_size: int,
+         checkpoint_path: Optional[Path] = None, commit_every: int = 50_000, metrics_output: Optional[Path] = None):
+    if bulk_import_output is not None and checkpoint_path is not None:
+        raise ValueError("the bulk import files are only complete for a run over the whole catalog, "
+                         "do not combine --bulk-import with --checkpoint")
+    with ExitStack() as resources:
+        checkpoint = None
+        if checkpoint_path is not None:
+            checkpoint = CheckpointStore(checkpoint_path)
+            resources.callback(checkpoint.close)
+        sinks: List[Sink] = list()
+        if neo4j_url is not None:
+            driver = GraphDatabase.driver(neo4j_url, auth=("neo4j", "2much4ME"))
+            resources.callback(driver.close)
+            # changed rows have to overwrite the properties written by an earlier run
+            sinks.append(Neo4jSink(driver, update_properties=checkpoint is not None))
+        if gremlin_url is not None:
+            conn = DriverRemoteConnection(gremlin_url, "g", pool_size=8)
+            resources.callback(conn.close)
+            sinks.append(GremlinSink(traversal().withRemote(conn)))
+        if es_hosts is not None:
+            es = Elasticsearch(es_hosts or None, maxsize=4)
+            resources.callback(es.close)
+            es_sink = ElasticsearchSink(es)
+            # restores the index settings also when a later sink fails to start, closing it again after ingest does
+            # nothing
+            resources.callback(es_sink.close)
+            sinks.append(es_sink)
+        if bulk_import_output is not None:
+            sinks.append(BulkImportSink(BulkImportGenerator(bulk_import_output)))
+        if len(sinks) == 0:
+            raise ValueError("no sink given")
+        ingest(catalog, sinks, n_workers, batch_size, queue_size, checkpoint, commit_every)
+    if metrics_output is not None:
+        REGISTRY.write(metrics_output)
+        logger.info(f"metrics written to {metrics_output}")
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    parser = argparse.ArgumentParser(description="load a catalog into several stores with one parse and extraction")
+    parser.add_argument("--catalog", type=Path, default=Path("data/1000.csv"), help="csv file, optionally gzipped")
+    parser.add_argument("--workers", type=int, default=None, help="extraction processes, 0 to extract in process")
+    parser.add_argument("--neo4j", default=None, help="e.g. neo4j://localhost:7687")
+    parser.add_argument("--gremlin", default=None, help="e.g. ws://localhost:8182/gremlin")
+    parser.add_argument("--elasticsearch", nargs="*", default=None, help="hosts, none for localhost:9200")
+    parser.add_argument("--bulk-import", type=Path, default=None, help="output directory of the import files")
+    parser.add_argument("--batch-size", type=int, default=500, help="rows per batch handed to a sink")
+    parser.add_argument("--queue-size", type=int, default=8, help="batches buffered per sink")
+    parser.add_argument("--checkpoint", type=Path, default=None,
+                        help="sqlite file of the book hashes written to each sink and of the progress, e.g. "
+                             "data/ingest.sqlite; reruns skip the books unchanged in a sink and resume interrupted "
+                             "runs")
+    parser.add_argument("--commit-every", type=int, default=50_000, help="rows between checkpoint commits")
+    parser.add_argument("--metrics-output", type=Path, default=None,
+                        help="write the stage and sink histograms in the prometheus text format to this file at the "
+                             "end, e.g. into the textfile directory of the node exporter")
+    args = parser.parse_args()
+    main(args.catalog, args.neo4j, args.gremlin, args.elasticsearch, args.bulk_import, args.workers, args.batch_size,
+         args.queue_size, args.checkpoint, args.commit_every, args.metrics_output)
@@ -0,0 +1,156 @@
+import csv
+import gzip
+import itertools
+import os
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Iterator, List, NamedTuple, Optional, TextIO, Tuple
+
+from . import ColumnHeader
+from ..metrics import REGISTRY, SIZE_BUCKETS
+
+
+FIELDNAMES = [x.value for x in ColumnHeader]
+
+# parse and extract feed every sink, their sink label is "all"
+STAGE_SECONDS = REGISTRY.histogram("xinhua_ingest_stage_seconds",
+                                   "seconds per chunk of catalog rows spent reading the csv (parse) or extracting, "
+                                   "and per write of a batch to a store (db_write)",
+                                   ["stage", "sink"])
+WRITE_BATCH_SIZE = REGISTRY.histogram("xinhua_ingest_write_batch_size",
+                                      "nodes, edges or documents per write of a batch to a store", ["sink"],
+                                      SIZE_BUCKETS)
+
+
+@contextmanager
+def observe_write(sink: str, n: int) -> Iterator[None]:
+    """time a write of n nodes, edges or documents to a store as the db_write stage of sink"""
+    WRITE_BATCH_SIZE.observe(n, sink=sink)
+    with STAGE_SECONDS.time(stage="db_write", sink=sink):
+        yield
+
+
+class ExtractedRow(NamedTuple):
+    row: Optional[Dict[str, str]]
+    nodes: List
+    relations: List
+
+
+def open_catalog(path: Path) -> TextIO:
+    """open a catalog csv file for reading, files ending with .gz are decompressed on the fly"""
+    if path.suffix == ".gz":
+        return gzip.open(str(path), "rt", encoding="utf-8", newline="")
+    return path.open("r", encoding="utf-8", newline="")
+
+
+def _to_dict(values: List[str]) -> Dict[str, str]:
+    if len(values) < len(FIELDNAMES):
+        values = values + [None] * (len(FIELDNAMES) - len(values))
+    return dict(zip(FIELDNAMES, values))
+
+
+def iter_catalog_rows(path: Path) -> Iterator[Dict[str, str]]:
+    """stream the rows of a catalog file as dicts keyed by ColumnHeader values, the header line is skipped"""
+    with open_catalog(path) as f:
+        reader = csv.reader(f)
+        next(reader)
+        for values in reader:
+            yield _to_dict(values)
+
+
+def iter_row_chunks(path: Path, chunk_size: int, start_row: int = 0) -> Iterator[List[List[str]]]:
+    """stream a catalog file in chunks of raw csv records, which are cheaper to send to another process than dicts.
+    The first start_row records are skipped"""
+    with open_catalog(path) as f:
+        reader = csv.reader(f)
+        next(reader)
+        for _ in itertools.islice(reader, start_row):
+            pass
+        chunk = list()
+        for values in reader:
+            chunk.append(values)
+            if len(chunk) == chunk_size:
+                yield chunk
+                chunk = list()
+        if len(chunk) > 0:
+            yield chunk
+
+
+_extractor = None
+
+
+def _init_worker(extractor):
+    global _extractor
+    _extractor = extractor
+
+
+def _extract_chunk(chunk: List[List[str]], keep_rows: bool) -> Tuple[List[ExtractedRow], float]:
+    """:return: the extracted rows and the seconds it took, measured in the worker"""
+    start = time.perf_counter()
+    results = list()
+    for values in chunk:
+        row = _to_dict(values)
+        nodes, relations = _extractor.extract(row)
+        results.append(ExtractedRow(row if keep_rows else None, nodes, relations))
+    return results, time.perf_counter() - start
+
+
+def _timed_chunks(path: Path, chunk_size: int, start_row: int) -> Iterator[List[List[str]]]:
+    chunks = iter_row_chunks(path, chunk_size, start_row)
+    while True:
+        start = time.perf_counter()
+        chunk = next(chunks, None)
+        if chunk is None:
+            return
+        STAGE_SECONDS.observe(time.perf_counter() - start, stage="parse", sink="all")
+        yield chunk
+
+
+def _observed(result: Tuple[List[ExtractedRow], float]) -> List[ExtractedRow]:
+    rows, seconds = result
+    STAGE_SECONDS.observe(seconds, stage="extract", sink="all")
+    return rows
+
+
+def extract_catalog(path: Path, extractor, n_workers: Optional[int] = None, chunk_size: int = 1000,
+                    max_pending_chunks: Optional[int] = None, ordered: bool = True,
+                    keep_rows: bool = False, start_row: int = 0) -> Iterator[ExtractedRow]:
+    """stream a catalog file and run extractor.extract on every row in a pool of n_workers processes.
+
+    At most max_pending_chunks chunks are read ahead of the consumer, so memory stays bounded while the workers keep
+    extracting during whatever the consumer does with the results, e.g. writing them to a database.
+
+    :param extractor: a picklable object with an extract(row) method returning nodes and relations
+    :param n_workers: number of worker processes, the default is the number of cpus, 0 extracts in this process
+    :param ordered: yield results in the order of the file; otherwise chunks are yielded as soon as they are done
+    :param keep_rows: also return the parsed row with every result
+    :param start_row: skip this many rows, they are parsed but not extracted, e.g. to resume
+    """
+    if n_workers == 0:
+        _init_worker(extractor)
+        for chunk in _timed_chunks(path, chunk_size, start_row):
+            yield from _observed(_extract_chunk(chunk, keep_rows))
+        return
+
+    n_workers = n_workers or os.cpu_count()
+    max_pending_chunks = max_pending_chunks or 2 * n_workers
+    with ProcessPoolExecutor(n_workers, initializer=_init_worker, initargs=(extractor,)) as pool:
+        pending = deque()
+
+        def drain(n_left: int) -> Iterator[ExtractedRow]:
+            while len(pending) > n_left:
+                if ordered:
+                    yield from _observed(pending.popleft().result())
+                else:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        pending.remove(future)
+                        yield from _observed(future.result())
+
+        for chunk in _timed_chunks(path, chunk_size, start_row):
+            pending.append(pool.submit(_extract_chunk, chunk, keep_rows))
+            yield from drain(max_pending_chunks - 1)
+        yield from drain(0)
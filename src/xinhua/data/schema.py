@@ -0,0 +1,50 @@
+import logging
+from dataclasses import fields
+from typing import Iterable, List, NamedTuple, Type
+
+from neo4j import Driver
+
+
+logger = logging.getLogger(__name__)
+
+
+class Constraint(NamedTuple):
+    label: str
+    property: str
+
+    @property
+    def name(self) -> str:
+        return f"{self.label.lower()}_{self.property}_unique"
+
+    @property
+    def cql(self) -> str:
+        return f"CREATE CONSTRAINT {self.name} ON (n:{self.label}) ASSERT n.{self.property} IS UNIQUE"
+
+
+def identifier_of(node_type: Type) -> str:
+    """the property a node type is identified by, id if the dataclass has this field, otherwise name"""
+    return "id" if "id" in {f.name for f in fields(node_type)} else "name"
+
+
+def required_constraints(node_types: Iterable[Type]) -> List[Constraint]:
+    """a uniqueness constraint, which is backed by an index, on the identifier of every node type"""
+    return [Constraint(label=x.__name__, property=identifier_of(x)) for x in node_types]
+
+
+def ensure_schema(driver: Driver, node_types: Iterable[Type], timeout: int = 300) -> List[Constraint]:
+    """create the missing constraints and wait until their indexes are online. Constraints are created with a fixed
+    name, so running it again against the same database is a no-op
+
+    :return: constraints created by this call
+    """
+    created = list()
+    with driver.session() as session:
+        existing = {record["name"] for record in session.run("CALL db.constraints()")}
+        for constraint in required_constraints(node_types):
+            if constraint.name in existing:
+                continue
+            session.run(constraint.cql).consume()
+            created.append(constraint)
+            logger.info(f"created constraint {constraint.name}")
+        session.run("CALL db.awaitIndexes($timeout)", timeout=timeout).consume()
+    return created
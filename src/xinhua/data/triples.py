@@ -0,0 +1,109 @@
+import argparse
+import gzip
+import logging
+import time
+from array import array
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Tuple
+
+import numpy as np
+
+from ..ids import IdTable, save_array
+
+
+logger = logging.getLogger(__name__)
+
+TRIPLES_FILE = "triples.npy"
+ENTITIES_DIR = "entities"
+RELATIONS_DIR = "relations"
+# the udd_hrt format of dglke, ids are assigned by us, so row i of the trained embeddings is entity i
+DGLKE_ENTITIES_FILE = "entities.dict"
+DGLKE_RELATIONS_FILE = "relations.dict"
+DGLKE_TRAIN_FILE = "train.tsv"
+
+
+def triplet_files(path: Path) -> List[Path]:
+    """a single triplet file, or the shards of a directory written by xinhua.data.export"""
+    if path.is_dir():
+        return sorted(path.glob("*.tsv.gz"))
+    return [path]
+
+
+def iter_triplets(paths: Iterable[Path]) -> Iterator[Tuple[str, str, str]]:
+    for path in paths:
+        with (gzip.open(str(path), "rt", encoding="utf-8") if path.suffix == ".gz"
+              else path.open("r", encoding="utf-8")) as f:
+            for line in f:
+                h, r, t = line.rstrip("\n").split("\t")
+                yield h, r, t
+
+
+class EncodedTriplets:
+    """triplets as an int32 (n, 3) array of head, relation and tail ids, with the entity and relation ids as IdTables.
+    Loaded with mmap nothing is parsed, the embedding training reads the triples and the backend the entity table"""
+
+    def __init__(self, triples: np.ndarray, entities: IdTable, relations: IdTable):
+        self.triples = triples
+        self.entities = entities
+        self.relations = relations
+
+    @classmethod
+    def load(cls, directory: Path, mmap: bool = True) -> "EncodedTriplets":
+        return cls(np.load(str(directory / TRIPLES_FILE), mmap_mode="r" if mmap else None),
+                   IdTable.load(directory / ENTITIES_DIR, mmap),
+                   IdTable.load(directory / RELATIONS_DIR, mmap))
+
+    def save(self, directory: Path):
+        directory.mkdir(parents=True, exist_ok=True)
+        self.entities.save(directory / ENTITIES_DIR)
+        self.relations.save(directory / RELATIONS_DIR)
+        save_array(directory / TRIPLES_FILE, self.triples)
+
+    def write_dglke(self, directory: Path, batch_size: int = 1_000_000):
+        """write the udd_hrt input of dglke_train, the triples are written as ids so dglke builds no dictionaries"""
+        for table, name in [(self.entities, DGLKE_ENTITIES_FILE), (self.relations, DGLKE_RELATIONS_FILE)]:
+            with (directory / name).open("w", encoding="utf-8") as f:
+                for start in range(0, len(table), batch_size):
+                    ids = table.ids[start: start + batch_size]
+                    f.write("".join(f"{start + i}\t{x.decode('utf-8')}\n" for i, x in enumerate(ids)))
+        with (directory / DGLKE_TRAIN_FILE).open("w") as f:
+            for start in range(0, self.triples.shape[0], batch_size):
+                np.savetxt(f, self.triples[start: start + batch_size], fmt="%d", delimiter="\t")
+
+
+def encode_triplets(triplets: Iterable[Tuple[str, str, str]]) -> EncodedTriplets:
+    """assign dense ids to the entities and relations in the order they first appear"""
+    entities: Dict[str, int] = dict()
+    relations: Dict[str, int] = dict()
+    triples = array("i")
+    start = time.monotonic()
+    for h, r, t in triplets:
+        triples.append(entities.setdefault(h, len(entities)))
+        triples.append(relations.setdefault(r, len(relations)))
+        triples.append(entities.setdefault(t, len(entities)))
+        if len(triples) % 30_000_000 == 0:
+            logger.info(f"{len(triples) // 3} triplets encoded, {len(triples) // 3 / (time.monotonic() - start):.0f}/s")
+    # dicts keep the insertion order, which is the id order
+    return EncodedTriplets(np.frombuffer(triples, dtype="int32").reshape(-1, 3),
+                           IdTable.from_ids(entities), IdTable.from_ids(relations))
+
+
+def main(input_path: Path, output: Path, dglke: bool):
+    encoded = encode_triplets(iter_triplets(triplet_files(input_path)))
+    encoded.save(output)
+    logger.info(f"{encoded.triples.shape[0]} triplets of {len(encoded.entities)} entities and "
+                f"{len(encoded.relations)} relations written to {output}")
+    if dglke:
+        encoded.write_dglke(output)
+        logger.info(f"dglke udd_hrt files written to {output}")
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    parser = argparse.ArgumentParser(description="encode text triplets as int32 triples with sorted id tables")
+    parser.add_argument("--input", type=Path, default=Path("data/triplets"),
+                        help="a triplet file or a directory of shards written by xinhua.data.export")
+    parser.add_argument("--output", type=Path, default=Path("data"))
+    parser.add_argument("--no-dglke", dest="dglke", action="store_false", help="skip the udd_hrt text files")
+    args = parser.parse_args()
+    main(args.input, args.output, args.dglke)
@@ -0,0 +1,103 @@
+import os
+from pathlib import Path
+from typing import Iterable, List, Optional
+
+import numpy as np
+
+
+IDS_FILE = "ids.npy"
+SORTED_IDS_FILE = "sorted_ids.npy"
+SORTED_POSITIONS_FILE = "sorted_positions.npy"
+
+
+def save_array(path: Path, array: np.ndarray):
+    """np.save through a temporary file and a rename, processes which memory map the previous file keep a valid
+    mapping instead of seeing it truncated"""
+    tmp = path.with_name(f".{path.name}.{os.getpid()}")
+    with tmp.open("wb") as f:
+        np.save(f, array)
+    os.replace(str(tmp), str(path))
+
+
+class IdTable:
+    """a compact string id <-> position table. The ids are kept as fixed width utf-8 bytes in position order and in
+    sorted order, a lookup is a binary search. Unlike a dict of str it costs a few bytes per id, and loaded with
+    mmap the arrays are shared by all processes through the page cache"""
+
+    def __init__(self, ids: np.ndarray, sorted_ids: np.ndarray, sorted_positions: np.ndarray):
+        self.ids = ids
+        self.sorted_ids = sorted_ids
+        self.sorted_positions = sorted_positions
+
+    @classmethod
+    def from_ids(cls, ids: Iterable[str]) -> "IdTable":
+        """:param ids: unique ids, in position order"""
+        ids = np.array([x.encode("utf-8") for x in ids], dtype="S")
+        if ids.dtype.itemsize == 0:
+            ids = ids.astype("S1")
+        return cls.from_bytes(ids)
+
+    @classmethod
+    def from_bytes(cls, ids: np.ndarray) -> "IdTable":
+        """:param ids: unique fixed width utf-8 ids, an S array, in position order"""
+        ids = np.ascontiguousarray(ids)
+        order = np.argsort(ids, kind="stable")
+        return cls(ids, ids[order], order.astype("int64"))
+
+    def __len__(self) -> int:
+        return self.ids.shape[0]
+
+    def __getitem__(self, position: int) -> str:
+        return self.ids[position].decode("utf-8")
+
+    def __contains__(self, id_: str) -> bool:
+        return self.position(id_) is not None
+
+    def position(self, id_: str) -> Optional[int]:
+        key = id_.encode("utf-8")
+        if len(key) > self.ids.dtype.itemsize:
+            return None
+        i = int(np.searchsorted(self.sorted_ids, key))
+        if i < len(self) and self.sorted_ids[i] == key:
+            return int(self.sorted_positions[i])
+        return None
+
+    def positions(self, ids: List[str]) -> np.ndarray:
+        """positions of many ids with one vectorized search, -1 for unknown ids"""
+        keys = np.array([x.encode("utf-8") for x in ids], dtype=self.ids.dtype)
+        if len(self) == 0 or len(keys) == 0:
+            return np.full(len(keys), -1, dtype="int64")
+        i = np.minimum(np.searchsorted(self.sorted_ids, keys), len(self) - 1)
+        # ids longer than the table width are truncated by the cast, compare the lengths as well
+        found = (self.sorted_ids[i] == keys) & np.array([len(x.encode("utf-8")) <= keys.dtype.itemsize for x in ids])
+        return np.where(found, self.sorted_positions[i], -1)
+
+    def prefix_mask(self, prefix: str) -> np.ndarray:
+        """a bool mask of the ids starting with prefix, compared as bytes without decoding an id"""
+        key = prefix.encode("utf-8")
+        width = self.ids.dtype.itemsize
+        if width < len(key):
+            return np.zeros(len(self), dtype=bool)
+        # the fixed width ids as a matrix of bytes, one row per id
+        chars = np.ascontiguousarray(self.ids).view("uint8").reshape(-1, width)
+        return (chars[:, :len(key)] == np.frombuffer(key, dtype="uint8")).all(axis=1)
+
+    def to_list(self) -> List[str]:
+        return [x.decode("utf-8") for x in self.ids]
+
+    def save(self, directory: Path):
+        directory.mkdir(parents=True, exist_ok=True)
+        save_array(directory / IDS_FILE, self.ids)
+        save_array(directory / SORTED_IDS_FILE, self.sorted_ids)
+        save_array(directory / SORTED_POSITIONS_FILE, self.sorted_positions)
+
+    @classmethod
+    def load(cls, directory: Path, mmap: bool = True) -> "IdTable":
+        mmap_mode = "r" if mmap else None
+        return cls(np.load(str(directory / IDS_FILE), mmap_mode=mmap_mode),
+                   np.load(str(directory / SORTED_IDS_FILE), mmap_mode=mmap_mode),
+                   np.load(str(directory / SORTED_POSITIONS_FILE), mmap_mode=mmap_mode))
+
+    @staticmethod
+    def exists(directory: Path) -> bool:
+        return all((directory / x).exists() for x in [IDS_FILE, SORTED_IDS_FILE, SORTED_POSITIONS_FILE])
@@ -0,0 +1,272 @@
+import collections
+import itertools
+import os
+import sys
+import threading
+import time
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+# seconds, from a cache hit to a slow elasticsearch query
+LATENCY_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1., 2.5, 5., 10., 30.)
+SIZE_BUCKETS = (1, 10, 50, 100, 250, 500, 1000, 2500, 5000, 10_000)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class _Metric(ABC):
+    type_name = "untyped"
+
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        if set(labels) != set(self.label_names):
+            raise ValueError(f"{self.name} takes the labels {self.label_names}, got {tuple(labels)}")
+        return tuple(str(labels[x]) for x in self.label_names)
+
+    @abstractmethod
+    def _samples(self) -> List[str]:
+        pass
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"] + self._samples()
+
+
+class Counter(_Metric):
+    type_name = "counter"
+
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str] = ()):
+        super().__init__(name, documentation, label_names)
+        self._values: Dict[Tuple[str, ...], float] = dict()
+
+    def inc(self, amount: float = 1., **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.) + amount
+
+    def set(self, value: float, **labels):
+        """mirror a count kept elsewhere, e.g. by the reloader"""
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0.)
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            values = sorted(self._values.items())
+        return [f"{self.name}{_format_labels(self.label_names, k)} {_format_value(v)}" for k, v in values]
+
+
+class Gauge(Counter):
+    type_name = "gauge"
+
+
+class _HistogramValues:
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self, n_buckets: int):
+        self.counts = [0] * n_buckets
+        self.sum = 0.
+        self.count = 0
+
+
+class Histogram(_Metric):
+    """counts of observations per bucket, the bucket of a value is the first upper bound not below it"""
+    type_name = "histogram"
+
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, label_names)
+        self.buckets = tuple(sorted(buckets))
+        self._values: Dict[Tuple[str, ...], _HistogramValues] = dict()
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            values = self._values.get(key)
+            if values is None:
+                values = self._values[key] = _HistogramValues(len(self.buckets) + 1)
+            values.counts[i] += 1
+            values.sum += value
+            values.count += 1
+
+    @contextmanager
+    def time(self, **labels) -> Iterator[None]:
+        """observe the seconds the block takes, also when it raises"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def quantile(self, q: float, **labels) -> Optional[float]:
+        """estimated by linear interpolation inside the bucket, like histogram_quantile of prometheus"""
+        values = self._values.get(self._key(labels))
+        if values is None or values.count == 0:
+            return None
+        with self._lock:
+            counts = list(values.counts)
+        rank, cumulative = q * values.count, 0
+        for i, n in enumerate(counts):
+            if cumulative + n >= rank and n > 0:
+                if i == len(self.buckets):
+                    return self.buckets[-1]
+                lower = self.buckets[i - 1] if i > 0 else 0.
+                return lower + (self.buckets[i] - lower) * (rank - cumulative) / n
+            cumulative += n
+        return self.buckets[-1]
+
+    def summary(self) -> Dict[str, Dict]:
+        """count, mean, p50 and p99 of every label combination, for the logs of a run"""
+        result = dict()
+        for key in sorted(self._values):
+            labels = dict(zip(self.label_names, key))
+            values = self._values[key]
+            result[",".join(key) or self.name] = {
+                "count": values.count,
+                "sum": round(values.sum, 3),
+                "mean": round(values.sum / values.count, 6),
+                "p50": round(self.quantile(.5, **labels), 6),
+                "p99": round(self.quantile(.99, **labels), 6)
+            }
+        return result
+
+    def _samples(self) -> List[str]:
+        lines = list()
+        with self._lock:
+            items = sorted((k, list(v.counts), v.sum, v.count) for k, v in self._values.items())
+        for key, counts, total, count in items:
+            cumulative = 0
+            for bound, n in zip(list(self.buckets) + ["+Inf"], counts):
+                cumulative += n
+                le = 'le="{}"'.format(bound if bound == "+Inf" else _format_value(bound))
+                lines.append(f"{self.name}_bucket{_format_labels(self.label_names, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.label_names, key)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.label_names, key)} {count}")
+        return lines
+
+
+class Registry:
+    """the metrics of a process, rendered in the prometheus text format. Each worker process of the backend has its own,
+    a scrape sees the worker which answers it, so run the backend with one worker per container or scrape each"""
+
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = dict()
+        self._lock = threading.Lock()
+
+    def _get(self, cls, name: str, *args, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, *args, **kwargs)
+            elif type(metric) is not cls:
+                raise ValueError(f"{name} is already registered as a {metric.type_name}")
+            return metric
+
+    def counter(self, name: str, documentation: str, label_names: Sequence[str] = ()) -> Counter:
+        return self._get(Counter, name, documentation, label_names)
+
+    def gauge(self, name: str, documentation: str, label_names: Sequence[str] = ()) -> Gauge:
+        return self._get(Gauge, name, documentation, label_names)
+
+    def histogram(self, name: str, documentation: str, label_names: Sequence[str] = (),
+                  buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+        return self._get(Histogram, name, documentation, label_names, buckets)
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = sorted(self._metrics.values(), key=lambda x: x.name)
+        return "".join(line + "\n" for metric in metrics for line in metric.render())
+
+    def write(self, path: Path):
+        """for batch jobs, e.g. into the textfile directory of the node exporter"""
+        tmp = path.with_name(f".{path.name}.{os.getpid()}")
+        tmp.write_text(self.render(), encoding="utf-8")
+        os.replace(str(tmp), str(path))
+
+
+REGISTRY = Registry()
+
+CONTENT_TYPE = "text/plain; version=0.0.4"
+
+
+def _collapse(frame) -> List[str]:
+    stack = list()
+    while frame is not None:
+        code = frame.f_code
+        stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+        frame = frame.f_back
+    stack.reverse()
+    return stack
+
+
+class SamplingProfiler:
+    """samples the stacks of all threads every interval seconds and keeps the last window seconds of samples. dump
+    writes the samples of a time range as collapsed stacks, the input of flamegraph.pl or speedscope, one file per
+    call. The samples cover every thread, e.g. the event loop and the thread pool, so a dump of a slow request also
+    shows what ran concurrently with it; each stack starts with the name of its thread.
+
+    Sampling costs some tens of microseconds per thread and sample, turn it on to investigate only.
+    """
+
+    def __init__(self, output: Path, interval: float = .005, window: float = 30.):
+        self._output = output
+        self._interval = interval
+        self._samples = collections.deque(maxlen=max(1, int(window / interval)))
+        self._thread: Optional[threading.Thread] = None
+        self._dump_ids = itertools.count()
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._output.mkdir(parents=True, exist_ok=True)
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        me = threading.get_ident()
+        while True:
+            names = {x.ident: x.name for x in threading.enumerate()}
+            now = time.monotonic()
+            stacks = [";".join([names.get(ident, str(ident))] + _collapse(frame))
+                      for ident, frame in sys._current_frames().items() if ident != me]
+            self._samples.append((now, stacks))
+            time.sleep(self._interval)
+
+    def dump(self, start: float, end: float, name: str) -> Optional[Path]:
+        """:param start: time.monotonic() at the start of the range
+        :return: the file written, None if no sample fell into the range"""
+        counts = collections.Counter()
+        for at, stacks in list(self._samples):
+            if start <= at <= end:
+                counts.update(stacks)
+        if len(counts) == 0:
+            return None
+        path = self._output / f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{next(self._dump_ids)}-{name}.folded"
+        with path.open("w", encoding="utf-8") as f:
+            for stack, n in counts.most_common():
+                f.write(f"{stack} {n}\n")
+        return path
@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# the package is not installed, the tests run against src
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
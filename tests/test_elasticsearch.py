@@ -0,0 +1,104 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+pytest.importorskip("elasticsearch")
+
+from elasticsearch import Elasticsearch  # noqa: E402
+
+from xinhua.data import ColumnHeader  # noqa: E402
+from xinhua.data.elasticsearch import bulk_index_books  # noqa: E402
+from xinhua.data.pipeline import FIELDNAMES, STAGE_SECONDS, WRITE_BATCH_SIZE  # noqa: E402
+
+
+class StubElasticsearch(BaseHTTPRequestHandler):
+    """answers _bulk like a single node: create fails for an existing id, and with reject_first every document is
+    rejected with 429 the first time it is sent"""
+    documents = dict()
+    rejected = set()
+    reject_first = False
+    lock = threading.Lock()
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, body: dict):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("X-Elastic-Product", "Elasticsearch")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        self._reply({"version": {"number": "7.8.0", "build_flavor": "default"}, "tagline": "You Know, for Search"})
+
+    def do_POST(self):
+        lines = self.rfile.read(int(self.headers["Content-Length"])).decode("utf-8").splitlines()
+        items = list()
+        with self.lock:
+            for action_line, source_line in zip(lines[::2], lines[1::2]):
+                (op_type, action), = json.loads(action_line).items()
+                doc_id = action["_id"]
+                if self.reject_first and doc_id not in self.rejected:
+                    self.rejected.add(doc_id)
+                    status = 429
+                elif op_type == "create" and doc_id in self.documents:
+                    status = 409
+                else:
+                    status = 201
+                    self.documents[doc_id] = json.loads(source_line)
+                item = {"_index": action["_index"], "_id": doc_id, "status": status}
+                if status >= 300:
+                    item["error"] = {"type": "stub_error"}
+                items.append({op_type: item})
+        self._reply({"took": 1, "errors": any(x[next(iter(x))]["status"] >= 300 for x in items), "items": items})
+
+
+@pytest.fixture
+def es():
+    StubElasticsearch.documents = dict()
+    StubElasticsearch.rejected = set()
+    StubElasticsearch.reject_first = False
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubElasticsearch)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    client = Elasticsearch([f"127.0.0.1:{server.server_address[1]}"])
+    yield client
+    client.close()
+    server.shutdown()
+
+
+def _rows(n: int):
+    for i in range(n):
+        row = {x: "" for x in FIELDNAMES}
+        row[ColumnHeader.BOOK_ID.value] = str(i)
+        row[ColumnHeader.BOOK_NAME_STR.value] = f"book {i}"
+        yield row
+
+
+def test_bulk_index_books(es):
+    assert bulk_index_books(es, _rows(1234), chunk_size=100, thread_count=3) == (1234, 0)
+    assert len(StubElasticsearch.documents) == 1234
+    assert StubElasticsearch.documents["7"]["name"] == "book 7"
+
+
+def test_rejected_documents_are_retried(es):
+    StubElasticsearch.reject_first = True
+    # the backoff of streaming_bulk starts at a second, keep it to one round
+    assert bulk_index_books(es, _rows(50), chunk_size=50, thread_count=1) == (50, 0)
+
+
+def test_create_does_not_overwrite(es):
+    bulk_index_books(es, _rows(10))
+    assert bulk_index_books(es, _rows(10)) == (0, 10)
+    assert bulk_index_books(es, _rows(10), op_type="index") == (10, 0)
+
+
+def test_chunks_are_timed_as_db_write(es):
+    before = STAGE_SECONDS.summary().get("db_write,elasticsearch", {"count": 0})["count"]
+    bulk_index_books(es, _rows(250), chunk_size=100, thread_count=2)
+    assert STAGE_SECONDS.summary()["db_write,elasticsearch"]["count"] == before + 3
+    assert WRITE_BATCH_SIZE.summary()["elasticsearch"]["count"] >= 3
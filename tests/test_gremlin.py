@@ -0,0 +1,65 @@
+import os
+
+import pytest
+
+pytest.importorskip("gremlin_python")
+
+from gremlin_python.driver.driver_remote_connection import DriverRemoteConnection  # noqa: E402
+from gremlin_python.process.anonymous_traversal import traversal  # noqa: E402
+
+from xinhua.data.gremlin import BatchWriter, Book, Person, Topic  # noqa: E402
+
+# a Gremlin Server with the default TinkerGraph, e.g. docker run -p 8182:8182 tinkerpop/gremlin-server:3.4.7
+GREMLIN_URL = os.environ.get("XINHUA_TEST_GREMLIN_URL", "ws://localhost:8182/gremlin")
+
+
+@pytest.fixture
+def g():
+    try:
+        conn = DriverRemoteConnection(GREMLIN_URL, "g")
+        g = traversal().withRemote(conn)
+        g.V().drop().iterate()
+    except Exception as e:
+        pytest.skip(f"no gremlin server at {GREMLIN_URL}: {e}")
+    yield g
+    g.V().drop().iterate()
+    conn.close()
+
+
+def _write_vertices(g, nodes):
+    with BatchWriter(g, batch_size=10, max_in_flight=1) as writer:
+        for node in nodes:
+            writer.add_vertex(node)
+
+
+def test_missing_endpoint_does_not_drop_the_following_edges(g):
+    book, author, topic = Book("1", "book"), Person("author"), Topic("topic")
+    _write_vertices(g, [book, author, topic])
+    writer = BatchWriter(g, batch_size=10, max_in_flight=1)
+    writer._upsert_edges([(Person("missing"), "WRITE", book), (author, "WRITE", book),
+                          (book, "HAS_TOPIC", topic)]).iterate()
+    writer.close()
+    assert g.E().hasLabel("WRITE").count().next() == 1
+    assert g.E().hasLabel("HAS_TOPIC").count().next() == 1
+
+
+def test_duplicated_edge_does_not_double_the_following_edges(g):
+    book, author, topic = Book("1", "book"), Person("author"), Topic("topic")
+    _write_vertices(g, [book, author, topic])
+    a, b = g.V().has("Person", "name", "author").next(), g.V().has("Book", "id", "1").next()
+    g.addE("WRITE").from_(a).to(b).iterate()
+    g.addE("WRITE").from_(a).to(b).iterate()
+    writer = BatchWriter(g, batch_size=10, max_in_flight=1)
+    writer._upsert_edges([(author, "WRITE", book), (book, "HAS_TOPIC", topic)]).iterate()
+    writer.close()
+    assert g.E().hasLabel("WRITE").count().next() == 2
+    assert g.E().hasLabel("HAS_TOPIC").count().next() == 1
+
+
+def test_upsert_is_idempotent(g):
+    book, author = Book("1", "book"), Person("author")
+    for _ in range(2):
+        with BatchWriter(g, batch_size=10, max_in_flight=1) as writer:
+            writer.add_edge(author, "WRITE", book)
+    assert g.V().count().next() == 2
+    assert g.E().count().next() == 1
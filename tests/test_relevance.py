@@ -0,0 +1,71 @@
+import asyncio
+
+import numpy as np
+import pytest
+
+faiss = pytest.importorskip("faiss")
+
+from xinhua.backend.relevance import RelevantBookExtractor  # noqa: E402
+from xinhua.backend.topk import TopKTable  # noqa: E402
+from xinhua.ids import IdTable  # noqa: E402
+
+
+def _extractor(n_books: int = 20, dim: int = 8) -> RelevantBookExtractor:
+    embeddings = np.random.RandomState(0).randn(n_books, dim).astype("float32")
+    return RelevantBookExtractor(IdTable.from_ids([str(i) for i in range(n_books)]), None, node_embeddings=embeddings)
+
+
+def test_nearest_k():
+    extractor = _extractor()
+    nearest = extractor.get_nearest_k("3", 5)
+    assert len(nearest) == 5 and "3" not in nearest
+    assert extractor.get_nearest_k_batch(["3", "unknown"], 5) == [nearest, list()]
+
+
+@pytest.mark.parametrize("k", [0, -1, -5])
+def test_nearest_k_not_positive(k):
+    extractor = _extractor()
+    assert extractor.get_nearest_k("3", k) == list()
+    assert extractor.get_nearest_k_batch(["3", "4"], k) == [list(), list()]
+    with pytest.raises(KeyError):
+        extractor.get_nearest_k("unknown", k)
+
+
+def test_nearest_k_not_positive_topk_table():
+    extractor = _extractor()
+    neighbours = np.array(extractor.get_nearest_k_batch([str(i) for i in range(20)], 3), dtype="int32")
+    table = RelevantBookExtractor(IdTable.from_ids([str(i) for i in range(20)]), None,
+                                  topk_table=TopKTable(neighbours, np.zeros(neighbours.shape, dtype="float16")))
+    assert table.get_nearest_k("3", -1) == list()
+    assert table.get_nearest_k_batch(["3"], -1) == [list()]
+
+
+def _get(app, path: str, query_string: bytes) -> int:
+    """the status of a GET answered by the asgi app, without a server"""
+    messages, requests = list(), [{"type": "http.request", "body": b"", "more_body": False}]
+
+    async def receive():
+        if len(requests) > 0:
+            return requests.pop()
+        # the client stays connected, a middleware waiting for the disconnect is cancelled with the response
+        await asyncio.Event().wait()
+
+    async def send(message):
+        messages.append(message)
+
+    scope = {"type": "http", "http_version": "1.1", "method": "GET", "scheme": "http", "path": path,
+             "raw_path": path.encode(), "root_path": "", "query_string": query_string, "headers": [],
+             "client": ("127.0.0.1", 1), "server": ("127.0.0.1", 80)}
+    asyncio.run(app(scope, receive, send))
+    return next(x["status"] for x in messages if x["type"] == "http.response.start")
+
+
+def test_negative_max_relevant_is_rejected():
+    pytest.importorskip("elasticsearch")
+    from xinhua.backend import app as backend
+    from pydantic import ValidationError
+
+    assert _get(backend.app, "/books", b"q=x&max_relevant=-1") == 422
+    with pytest.raises(ValidationError):
+        backend.BookQuery(q="x", max_relevant=-1)
+    assert backend.BookQuery(q="x", max_relevant=0).max_relevant == 0
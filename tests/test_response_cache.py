@@ -0,0 +1,77 @@
+import asyncio
+
+from xinhua.backend.response_cache import GENERATION_KEY, InProcessBackend, KeyValueBackend, ResponseCache
+
+
+class LocalRedis:
+    """a local stand-in for a redis client, shared by the workers of a test"""
+
+    def __init__(self):
+        self.data = dict()
+        self.ttls = dict()
+
+    async def get(self, key):
+        return self.data.get(key)
+
+    async def set(self, key, value, ex=None):
+        self.data[key] = value
+        self.ttls[key] = ex
+
+    async def incr(self, key):
+        self.data[key] = int(self.data.get(key, 0)) + 1
+        return self.data[key]
+
+
+def _workers(n: int, ttl: float = 300.):
+    client = LocalRedis()
+    return client, [ResponseCache(KeyValueBackend(client, ttl), generation_refresh=0.) for _ in range(n)]
+
+
+def test_workers_share_responses():
+    async def run():
+        client, (a, b) = _workers(2, ttl=60.)
+        key, value = await a.get("q", 1, 2)
+        assert value is None
+        await a.set(key, b"response")
+        assert (await b.get("q", 1, 2))[1] == b"response"
+        assert (await b.get("q", 1, 3))[1] is None
+        assert set(client.ttls.values()) == {60}
+        assert (a.hits, a.misses, b.hits, b.misses) == (0, 1, 1, 1)
+
+    asyncio.run(run())
+
+
+def test_invalidate_reaches_every_worker():
+    async def run():
+        client, (a, b) = _workers(2)
+        key, _ = await a.get("q", 1, 2)
+        await a.set(key, b"old")
+        await b.invalidate()
+        assert (await a.get("q", 1, 2))[1] is None
+        assert int(client.data["xinhua:books:" + GENERATION_KEY]) == 1
+
+    asyncio.run(run())
+
+
+def test_response_computed_before_invalidate_is_not_served():
+    async def run():
+        for backend in [KeyValueBackend(LocalRedis()), InProcessBackend()]:
+            cache = ResponseCache(backend, generation_refresh=0.)
+            key, _ = await cache.get("q", 1, 2)
+            # the embeddings are swapped while the response is computed
+            await cache.invalidate()
+            await cache.set(key, b"stale")
+            assert (await cache.get("q", 1, 2))[1] is None
+
+    asyncio.run(run())
+
+
+def test_sources_are_cached_apart():
+    async def run():
+        _, (cache,) = _workers(1)
+        key, _ = await cache.get("q", 1, 2, "graph")
+        await cache.set(key, b"graph")
+        assert (await cache.get("q", 1, 2, "embedding"))[1] is None
+        assert (await cache.get("q", 1, 2, "graph"))[1] == b"graph"
+
+    asyncio.run(run())